@@ -1,26 +1,46 @@
-from driftpy.pickle.vat import Vat
-from fastapi import APIRouter
+from typing import Optional
 
-from backend.state import BackendRequest
-from backend.utils.matrix import get_matrix
+from fastapi import APIRouter, HTTPException, Query
+
+from backend.state import BackendRequest, BackendState
+from backend.utils.matrix import (
+    ASSET_LIABILITY_PAGE_SIZE,
+    composition_to_wire,
+    filter_cube_users,
+    get_asset_liability_summary,
+    get_asset_liability_users,
+    load_asset_liability_cube,
+    slice_asset_liability_cube,
+)
 
 router = APIRouter()
 
 
 async def _get_asset_liability_matrix(
-    slot: int,
-    vat: Vat,
+    backend_state: BackendState,
     mode: int,
     perp_market_index: int,
 ) -> dict:
     print("==> Getting asset liability matrix...")
-    df = await get_matrix(vat, mode, perp_market_index)
-    df_dict = df.to_dict()
+    slot = backend_state.last_oracle_slot
+    # Every perp market is a slice of the same per-snapshot cube
+    cube = await backend_state.read_snapshot(
+        load_asset_liability_cube,
+        backend_state.current_pickle_path,
+        backend_state.vat,
+        mode,
+    )
+    df = slice_asset_liability_cube(cube, perp_market_index)
+    # The per-market compositions go out as sparse COO columns, not as a
+    # dict per user inside the frame
+    df_dict = df.drop(columns=["net_v", "net_p"]).to_dict()
     print("==> Asset liability matrix fetched")
 
     return {
         "slot": slot,
         "df": df_dict,
+        "net_v": composition_to_wire(df["net_v"].tolist()),
+        "net_p": composition_to_wire(df["net_p"].tolist()),
     }
 
 
@@ -28,9 +48,83 @@ async def _get_asset_liability_matrix(
 async def get_asset_liability_matrix(
     request: BackendRequest, mode: int, perp_market_index: int
 ):
-    return await _get_asset_liability_matrix(
-        request.state.backend_state.last_oracle_slot,
-        request.state.backend_state.vat,
-        mode,
-        perp_market_index,
-    )
+    try:
+        return await _get_asset_liability_matrix(
+            request.state.backend_state,
+            mode,
+            perp_market_index,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/summary")
+async def get_asset_liability_matrix_summary(
+    request: BackendRequest,
+    mode: int,
+    perp_market_index: int,
+    min_leverage: float = 0.0,
+    only_high_leverage: bool = False,
+):
+    try:
+        cube = await request.state.backend_state.read_snapshot(
+            load_asset_liability_cube,
+            request.state.backend_state.current_pickle_path,
+            request.state.backend_state.vat,
+            mode,
+        )
+        rows = filter_cube_users(cube, min_leverage, only_high_leverage)
+        summary = get_asset_liability_summary(cube, perp_market_index, rows)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "slot": request.state.backend_state.last_oracle_slot,
+        "n_users": len(cube.df),
+        "n_filtered": int(rows.sum()),
+        "net_usd_value": float(cube.df["net_usd_value"][rows].sum()),
+        "spot_asset": float(cube.df["spot_asset"][rows].sum()),
+        "spot_liability": float(cube.df["spot_liability"][rows].sum()),
+        "summary": summary.to_dict(),
+    }
+
+
+@router.get("/users")
+async def get_asset_liability_matrix_users(
+    request: BackendRequest,
+    mode: int,
+    perp_market_index: int,
+    min_leverage: float = 0.0,
+    only_high_leverage: bool = False,
+    spot_market_index: Optional[int] = None,
+    sort_by: Optional[str] = None,
+    ascending: bool = False,
+    page: int = Query(0, ge=0),
+    page_size: int = Query(ASSET_LIABILITY_PAGE_SIZE, ge=1, le=1000),
+):
+    try:
+        cube = await request.state.backend_state.read_snapshot(
+            load_asset_liability_cube,
+            request.state.backend_state.current_pickle_path,
+            request.state.backend_state.vat,
+            mode,
+        )
+        rows = filter_cube_users(cube, min_leverage, only_high_leverage)
+        df, total = get_asset_liability_users(
+            cube,
+            perp_market_index,
+            rows,
+            spot_market_index,
+            sort_by,
+            ascending,
+            page,
+            page_size,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "slot": request.state.backend_state.last_oracle_slot,
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "df": df.to_dict(orient="records"),
+    }
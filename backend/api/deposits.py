@@ -1,12 +1,12 @@
 from typing import Optional
 
-from driftpy.constants import PRICE_PRECISION, SPOT_BALANCE_PRECISION
+import numpy as np
+from driftpy.constants import SPOT_BALANCE_PRECISION
 from driftpy.constants.vaults import get_vaults_program
-from driftpy.pickle.vat import Vat
-from driftpy.types import is_variant
 from fastapi import APIRouter
 
 from backend.state import BackendRequest
+from backend.utils.position_store import get_oracle_prices
 
 router = APIRouter()
 
@@ -22,34 +22,34 @@ async def get_deposits(request: BackendRequest, market_index: Optional[int] = No
     Returns:
         dict: A dictionary containing deposits with total value and balance info
     """
-    vat: Vat = request.state.backend_state.vat
-    deposits = []
+    store = request.state.backend_state.get_position_store()
     vaults_program = await get_vaults_program(request.state.backend_state.connection)
     vaults = await vaults_program.account["Vault"].all()
     vault_pubkeys = [str(vault.account.pubkey) for vault in vaults]
 
-    for user in vat.users.values():
-        for position in user.get_user_account().spot_positions:
-            if (
-                position.scaled_balance > 0
-                and not is_variant(position.balance_type, "Borrow")
-                and (market_index is None or position.market_index == market_index)
-            ):
-                market_price = vat.spot_oracles.get(position.market_index)
-                if market_price is not None:
-                    market_price_ui = market_price.price / PRICE_PRECISION
-                    balance = position.scaled_balance / SPOT_BALANCE_PRECISION
-                    value = balance * market_price_ui
-
-                    deposits.append(
-                        {
-                            "authority": str(user.get_user_account().authority),
-                            "user_account": str(user.user_public_key),
-                            "market_index": position.market_index,
-                            "balance": balance,
-                            "value": value,
-                        }
-                    )
+    spot = store.spot
+    balance = spot.scaled_balance / SPOT_BALANCE_PRECISION
+    value = balance * get_oracle_prices(store.spot_oracle_prices, spot.market_index)
+    # Deposits in markets without an oracle have NaN values and are left out
+    is_deposit = (spot.scaled_balance > 0) & ~spot.is_borrow & (value >= 0)
+    if market_index is not None:
+        is_deposit &= spot.market_index == market_index
+    positions = np.flatnonzero(is_deposit)
+    deposits = [
+        {
+            "authority": store.get_authority(user_idx),
+            "user_account": store.user_keys[user_idx],
+            "market_index": market,
+            "balance": balance,
+            "value": value,
+        }
+        for user_idx, market, balance, value in zip(
+            spot.user_idx[positions].tolist(),
+            spot.market_index[positions].tolist(),
+            balance[positions].tolist(),
+            value[positions].tolist(),
+        )
+    ]
 
     deposits.sort(key=lambda x: x["value"], reverse=True)
     return {
@@ -1,12 +1,24 @@
-import heapq
+from typing import Optional
 
-import pandas as pd
-from driftpy.constants import BASE_PRECISION, PRICE_PRECISION, SPOT_BALANCE_PRECISION
-from driftpy.pickle.vat import Vat
-from driftpy.types import is_variant
-from fastapi import APIRouter
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query
 
 from backend.state import BackendRequest
+from backend.utils.health_histogram import (
+    DEFAULT_HEALTH_EDGES,
+    HistogramGroupBy,
+    HistogramWeight,
+    get_health_histogram,
+    parse_health_edges,
+)
+from backend.utils.leaderboard_index import (
+    PERP_SIDES,
+    SPOT_SIDES,
+    Leaderboard,
+    LeaderboardIndex,
+    LeaderboardSide,
+    get_top_positions,
+)
 
 router = APIRouter()
 
@@ -25,6 +37,44 @@ def to_financial(num: float):
     return num
 
 
+def get_leaderboard(
+    request: BackendRequest, side: str, sides: tuple[LeaderboardSide, ...]
+) -> tuple[LeaderboardIndex, Leaderboard]:
+    try:
+        leaderboard_side = LeaderboardSide(side)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if leaderboard_side not in sides:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Side must be one of {[side.value for side in sides]}",
+        )
+    index = request.state.backend_state.get_leaderboard_index()
+    return index, index.boards[leaderboard_side]
+
+
+def get_most_levered_rows(
+    board: Leaderboard,
+    k: int,
+    min_value: float,
+    market_index: Optional[int],
+    sort_by: str,
+) -> np.ndarray:
+    """
+    By default the `k` largest positions above `min_value` of users with
+    positive collateral, then ordered by leverage; with `sort_by` "leverage",
+    the `k` most levered positions above `min_value`.
+    """
+    if sort_by == "leverage":
+        return get_top_positions(board, k, min_value, market_index, by_leverage=True)
+    if sort_by != "notional":
+        raise HTTPException(
+            status_code=400, detail='sort_by must be "notional" or "leverage"'
+        )
+    rows = get_top_positions(board, k, min_value, market_index, levered_only=True)
+    return rows[np.argsort(-board.leverage[rows], kind="stable")]
+
+
 @router.get("/health_distribution")
 def get_account_health_distribution(request: BackendRequest):
     """
@@ -41,335 +91,226 @@ def get_account_health_distribution(request: BackendRequest):
         - Counts (int): The number of accounts in this range
         - Notional Values (float): The total collateral value in this range
     """
-    vat: Vat = request.state.backend_state.vat
-    health_notional_distributions = {
-        "0-10%": 0.0,
-        "10-20%": 0.0,
-        "20-30%": 0.0,
-        "30-40%": 0.0,
-        "40-50%": 0.0,
-        "50-60%": 0.0,
-        "60-70%": 0.0,
-        "70-80%": 0.0,
-        "80-90%": 0.0,
-        "90-100%": 0.0,
-    }
-    health_counts = {
-        "0-10%": 0.0,
-        "10-20%": 0.0,
-        "20-30%": 0.0,
-        "30-40%": 0.0,
-        "40-50%": 0.0,
-        "50-60%": 0.0,
-        "60-70%": 0.0,
-        "70-80%": 0.0,
-        "80-90%": 0.0,
-        "90-100%": 0.0,
-    }
-
-    for user in vat.users.values():
-        try:
-            total_collateral = user.get_total_collateral() / PRICE_PRECISION
-            current_health = user.get_health()
-        except Exception as e:
-            print(f"==> Error from health [{user.user_public_key}] ", e)
-            continue
-        match current_health:
-            case _ if current_health < 10:
-                health_notional_distributions["0-10%"] += total_collateral
-                health_counts["0-10%"] += 1
-            case _ if current_health < 20:
-                health_notional_distributions["10-20%"] += total_collateral
-                health_counts["10-20%"] += 1
-            case _ if current_health < 30:
-                health_notional_distributions["20-30%"] += total_collateral
-                health_counts["20-30%"] += 1
-            case _ if current_health < 40:
-                health_notional_distributions["30-40%"] += total_collateral
-                health_counts["30-40%"] += 1
-            case _ if current_health < 50:
-                health_notional_distributions["40-50%"] += total_collateral
-                health_counts["40-50%"] += 1
-            case _ if current_health < 60:
-                health_notional_distributions["50-60%"] += total_collateral
-                health_counts["50-60%"] += 1
-            case _ if current_health < 70:
-                health_notional_distributions["60-70%"] += total_collateral
-                health_counts["60-70%"] += 1
-            case _ if current_health < 80:
-                health_notional_distributions["70-80%"] += total_collateral
-                health_counts["70-80%"] += 1
-            case _ if current_health < 90:
-                health_notional_distributions["80-90%"] += total_collateral
-                health_counts["80-90%"] += 1
-            case _:
-                health_notional_distributions["90-100%"] += total_collateral
-                health_counts["90-100%"] += 1
-    df = pd.DataFrame(
-        {
-            "Health Range": list(health_counts.keys()),
-            "Counts": list(health_counts.values()),
-            "Notional Values": list(health_notional_distributions.values()),
-        }
+    table, store = request.state.backend_state.get_snapshot_tables()
+    df = get_health_histogram(
+        table,
+        store,
+        parse_health_edges(DEFAULT_HEALTH_EDGES),
+        HistogramWeight.COLLATERAL,
     )
+    df = df.rename(columns={"Values": "Notional Values"})
 
     return df.to_dict(orient="records")
 
 
+@router.get("/health_histogram")
+def get_health_histogram_by_group(
+    request: BackendRequest,
+    edges: str = DEFAULT_HEALTH_EDGES,
+    weight: str = HistogramWeight.COUNT.value,
+    group_by: Optional[str] = None,
+):
+    """
+    Get a histogram of account health with custom buckets.
+
+    Args:
+        edges (str): Comma-separated bucket edges in health percent, e.g.
+            "0,1,2,5,10,25,50,100" for finer buckets near liquidation
+        weight (str): What each bucket sums: "count", "collateral" or
+            "perp_notional"
+        group_by (str, optional): "perp_market", "spot_market" or
+            "high_leverage", for one histogram per group
+
+    Returns:
+        list[dict]: One record per bucket (and group), with keys:
+        - Group (int | bool): The market index or high leverage flag, if grouped
+        - Health Range (str): The health percentage range (e.g., '0-1%')
+        - Counts (int): The number of accounts (or positions) in this range
+        - Values (float): The summed weight of this range
+    """
+    try:
+        parsed_edges = parse_health_edges(edges)
+        histogram_weight = HistogramWeight(weight)
+        histogram_group_by = HistogramGroupBy(group_by) if group_by else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    table, store = request.state.backend_state.get_snapshot_tables()
+    df = get_health_histogram(
+        table,
+        store,
+        parsed_edges,
+        histogram_weight,
+        histogram_group_by,
+    )
+    return df.to_dict(orient="records")
+
+
 @router.get("/largest_perp_positions")
-def get_largest_perp_positions(request: BackendRequest):
+def get_largest_perp_positions(
+    request: BackendRequest,
+    k: int = Query(10, ge=1, le=1000),
+    market_index: Optional[int] = None,
+    side: str = LeaderboardSide.LONG.value,
+    min_value: Optional[float] = None,
+):
     """
-    Get the top 10 largest perpetual positions by value.
+    Get the top k largest perpetual positions by value.
 
     This endpoint retrieves the largest perpetual positions across all users,
     calculated based on the current market prices.
 
+    Args:
+        k (int): How many positions to return
+        market_index (int, optional): Only positions in this perp market
+        side (str): "long" or "short"
+        min_value (float, optional): Only positions worth more than this
+
     Returns:
-        dict: A dictionary containing lists of data for the top 10 positions:
+        dict: A dictionary containing lists of data for the top k positions:
         - Market Index (list[int]): The market indices of the top positions
         - Value (list[str]): The formatted dollar values of the positions
         - Base Asset Amount (list[str]): The formatted base asset amounts
         - Public Key (list[str]): The public keys of the position holders
     """
-    vat: Vat = request.state.backend_state.vat
-    top_positions: list[tuple[float, str, int, float]] = []
-
-    for user in vat.users.values():
-        for position in user.get_user_account().perp_positions:
-            if position.base_asset_amount > 0:
-                market_price = vat.perp_oracles.get(position.market_index)
-                if market_price is not None:
-                    market_price_ui = market_price.price / PRICE_PRECISION
-                    base_asset_value = (
-                        abs(position.base_asset_amount) / BASE_PRECISION
-                    ) * market_price_ui
-                    heap_item = (
-                        base_asset_value,
-                        user.user_public_key,
-                        position.market_index,
-                        position.base_asset_amount / BASE_PRECISION,
-                    )
-
-                    if len(top_positions) < 10:
-                        heapq.heappush(top_positions, heap_item)
-                    else:
-                        heapq.heappushpop(top_positions, heap_item)
-
-    positions = sorted(
-        (value, pubkey, market_idx, amt)
-        for value, pubkey, market_idx, amt in top_positions
-    )
-
-    positions.reverse()
+    index, board = get_leaderboard(request, side, PERP_SIDES)
+    rows = get_top_positions(board, k, min_value, market_index)
 
     data = {
-        "Market Index": [pos[2] for pos in positions],
-        "Value": [f"${pos[0]:,.2f}" for pos in positions],
-        "Base Asset Amount": [f"{pos[3]:,.2f}" for pos in positions],
-        "Public Key": [pos[1] for pos in positions],
+        "Market Index": board.market_index[rows].tolist(),
+        "Value": [f"${value:,.2f}" for value in board.notional[rows]],
+        "Base Asset Amount": [f"{amt:,.2f}" for amt in board.amount[rows]],
+        "Public Key": [index.user_keys[i] for i in board.user_idx[rows]],
     }
 
     return data
 
 
 @router.get("/most_levered_perp_positions_above_1m")
-def get_most_levered_perp_positions_above_1m(request: BackendRequest):
+def get_most_levered_perp_positions_above_1m(
+    request: BackendRequest,
+    k: int = Query(10, ge=1, le=1000),
+    market_index: Optional[int] = None,
+    side: str = LeaderboardSide.LONG.value,
+    min_value: float = 1_000_000,
+    sort_by: str = "notional",
+):
     """
-    Get the top 10 most leveraged perpetual positions with value above $1 million.
+    Get the top k most leveraged perpetual positions with value above $1 million.
 
     This endpoint calculates the leverage of each perpetual position with a value
-    over $1 million and returns the top 10 most leveraged positions.
+    over `min_value` and returns the top k most leveraged positions.
+
+    Args:
+        k (int): How many positions to return
+        market_index (int, optional): Only positions in this perp market
+        side (str): "long" or "short"
+        min_value (float): Only positions worth more than this
+        sort_by (str): "notional" picks the k largest positions and orders
+            them by leverage, "leverage" picks the k most levered ones
 
     Returns:
-        dict: A dictionary containing lists of data for the top 10 leveraged positions:
+        dict: A dictionary containing lists of data for the top k leveraged positions:
         - Market Index (list[int]): The market indices of the top positions
         - Value (list[str]): The formatted dollar values of the positions
         - Base Asset Amount (list[str]): The formatted base asset amounts
         - Leverage (list[str]): The formatted leverage ratios
         - Public Key (list[str]): The public keys of the position holders
     """
-    vat: Vat = request.state.backend_state.vat
-    top_positions: list[tuple[float, str, int, float, float]] = []
-
-    for user in vat.users.values():
-        try:
-            total_collateral = user.get_total_collateral() / PRICE_PRECISION
-        except Exception as e:
-            print(
-                f"==> Error from get_most_levered_perp_positions_above_1m [{user.user_public_key}] ",
-                e,
-            )
-            continue
-        if total_collateral > 0:
-            for position in user.get_user_account().perp_positions:
-                if position.base_asset_amount > 0:
-                    market_price = vat.perp_oracles.get(position.market_index)
-                    if market_price is not None:
-                        market_price_ui = market_price.price / PRICE_PRECISION
-                        base_asset_value = (
-                            abs(position.base_asset_amount) / BASE_PRECISION
-                        ) * market_price_ui
-                        leverage = base_asset_value / total_collateral
-                        if base_asset_value > 1_000_000:
-                            heap_item = (
-                                to_financial(base_asset_value),
-                                user.user_public_key,
-                                position.market_index,
-                                position.base_asset_amount / BASE_PRECISION,
-                                leverage,
-                            )
-
-                            if len(top_positions) < 10:
-                                heapq.heappush(top_positions, heap_item)
-                            else:
-                                heapq.heappushpop(top_positions, heap_item)
-
-    positions = sorted(
-        top_positions,  # We can sort directly the heap result
-        key=lambda x: x[
-            4
-        ],  # Sort by leverage, which is the fifth element in your tuple
-    )
-
-    positions.reverse()
+    index, board = get_leaderboard(request, side, PERP_SIDES)
+    rows = get_most_levered_rows(board, k, min_value, market_index, sort_by)
 
     data = {
-        "Market Index": [pos[2] for pos in positions],
-        "Value": [f"${pos[0]:,.2f}" for pos in positions],
-        "Base Asset Amount": [f"{pos[3]:,.2f}" for pos in positions],
-        "Leverage": [f"{pos[4]:,.2f}" for pos in positions],
-        "Public Key": [pos[1] for pos in positions],
+        "Market Index": board.market_index[rows].tolist(),
+        "Value": [f"${to_financial(value):,.2f}" for value in board.notional[rows]],
+        "Base Asset Amount": [f"{amt:,.2f}" for amt in board.amount[rows]],
+        "Leverage": [f"{value:,.2f}" for value in board.leverage[rows]],
+        "Public Key": [index.user_keys[i] for i in board.user_idx[rows]],
     }
 
     return data
 
 
 @router.get("/largest_spot_borrows")
-def get_largest_spot_borrows(request: BackendRequest):
+def get_largest_spot_borrows(
+    request: BackendRequest,
+    k: int = Query(10, ge=1, le=1000),
+    market_index: Optional[int] = None,
+    side: str = LeaderboardSide.BORROW.value,
+    min_value: Optional[float] = None,
+):
     """
-    Get the top 10 largest spot borrowing positions by value.
+    Get the top k largest spot borrowing positions by value.
 
     This endpoint retrieves the largest spot borrowing positions across all users,
     calculated based on the current market prices.
 
+    Args:
+        k (int): How many positions to return
+        market_index (int, optional): Only positions in this spot market
+        side (str): "borrow" or "deposit"
+        min_value (float, optional): Only positions worth more than this
+
     Returns:
-        dict: A dictionary containing lists of data for the top 10 borrowing positions:
+        dict: A dictionary containing lists of data for the top k borrowing positions:
         - Market Index (list[int]): The market indices of the top borrows
         - Value (list[str]): The formatted dollar values of the borrows
         - Scaled Balance (list[str]): The formatted scaled balances of the borrows
         - Public Key (list[str]): The public keys of the borrowers
     """
-    vat: Vat = request.state.backend_state.vat
-    top_borrows: list[tuple[float, str, int, float]] = []
-
-    for user in vat.users.values():
-        for position in user.get_user_account().spot_positions:
-            if position.scaled_balance > 0 and is_variant(
-                position.balance_type, "Borrow"
-            ):
-                market_price = vat.spot_oracles.get(position.market_index)
-                if market_price is not None:
-                    market_price_ui = market_price.price / PRICE_PRECISION
-                    borrow_value = (
-                        position.scaled_balance / SPOT_BALANCE_PRECISION
-                    ) * market_price_ui
-                    heap_item = (
-                        to_financial(borrow_value),
-                        user.user_public_key,
-                        position.market_index,
-                        position.scaled_balance / SPOT_BALANCE_PRECISION,
-                    )
-
-                    if len(top_borrows) < 10:
-                        heapq.heappush(top_borrows, heap_item)
-                    else:
-                        heapq.heappushpop(top_borrows, heap_item)
-
-    borrows = sorted(
-        (value, pubkey, market_idx, amt)
-        for value, pubkey, market_idx, amt in top_borrows
-    )
-
-    borrows.reverse()
+    index, board = get_leaderboard(request, side, SPOT_SIDES)
+    rows = get_top_positions(board, k, min_value, market_index)
 
     data = {
-        "Market Index": [pos[2] for pos in borrows],
-        "Value": [f"${pos[0]:,.2f}" for pos in borrows],
-        "Scaled Balance": [f"{pos[3]:,.2f}" for pos in borrows],
-        "Public Key": [pos[1] for pos in borrows],
+        "Market Index": board.market_index[rows].tolist(),
+        "Value": [f"${to_financial(value):,.2f}" for value in board.notional[rows]],
+        "Scaled Balance": [f"{amt:,.2f}" for amt in board.amount[rows]],
+        "Public Key": [index.user_keys[i] for i in board.user_idx[rows]],
     }
 
     return data
 
 
 @router.get("/most_levered_spot_borrows_above_1m")
-def get_most_levered_spot_borrows_above_1m(request: BackendRequest):
+def get_most_levered_spot_borrows_above_1m(
+    request: BackendRequest,
+    k: int = Query(10, ge=1, le=1000),
+    market_index: Optional[int] = None,
+    side: str = LeaderboardSide.BORROW.value,
+    min_value: float = 750_000,
+    sort_by: str = "notional",
+):
     """
-    Get the top 10 most leveraged spot borrowing positions with value above $750,000.
+    Get the top k most leveraged spot borrowing positions with value above $750,000.
 
     This endpoint calculates the leverage of each spot borrowing position with a value
-    over $750,000 and returns the top 10 most leveraged positions.
+    over `min_value` and returns the top k most leveraged positions.
+
+    Args:
+        k (int): How many positions to return
+        market_index (int, optional): Only positions in this spot market
+        side (str): "borrow" or "deposit"
+        min_value (float): Only positions worth more than this
+        sort_by (str): "notional" picks the k largest positions and orders
+            them by leverage, "leverage" picks the k most levered ones
 
     Returns:
-        dict: A dictionary containing lists of data for the top 10 leveraged borrowing positions:
+        dict: A dictionary containing lists of data for the top k leveraged borrowing positions:
         - Market Index (list[int]): The market indices of the top borrows
         - Value (list[str]): The formatted dollar values of the borrows
         - Scaled Balance (list[str]): The formatted scaled balances of the borrows
         - Leverage (list[str]): The formatted leverage ratios
         - Public Key (list[str]): The public keys of the borrowers
     """
-    vat: Vat = request.state.backend_state.vat
-    top_borrows: list[tuple[float, str, int, float, float]] = []
-
-    for user in vat.users.values():
-        try:
-            total_collateral = user.get_total_collateral() / PRICE_PRECISION
-        except Exception as e:
-            print(
-                f"==> Error from get_most_levered_spot_borrows_above_1m [{user.user_public_key}] ",
-                e,
-            )
-            raise e
-        if total_collateral > 0:
-            for position in user.get_user_account().spot_positions:
-                if (
-                    is_variant(position.balance_type, "Borrow")
-                    and position.scaled_balance > 0
-                ):
-                    market_price = vat.spot_oracles.get(position.market_index)
-                    if market_price is not None:
-                        market_price_ui = market_price.price / PRICE_PRECISION
-                        borrow_value = (
-                            position.scaled_balance / SPOT_BALANCE_PRECISION
-                        ) * market_price_ui
-                        leverage = borrow_value / total_collateral
-                        if borrow_value > 750_000:
-                            heap_item = (
-                                to_financial(borrow_value),
-                                user.user_public_key,
-                                position.market_index,
-                                position.scaled_balance / SPOT_BALANCE_PRECISION,
-                                leverage,
-                            )
-
-                            if len(top_borrows) < 10:
-                                heapq.heappush(top_borrows, heap_item)
-                            else:
-                                heapq.heappushpop(top_borrows, heap_item)
-
-    borrows = sorted(
-        top_borrows,
-        key=lambda x: x[4],
-    )
-
-    borrows.reverse()
+    index, board = get_leaderboard(request, side, SPOT_SIDES)
+    rows = get_most_levered_rows(board, k, min_value, market_index, sort_by)
 
     data = {
-        "Market Index": [pos[2] for pos in borrows],
-        "Value": [f"${pos[0]:,.2f}" for pos in borrows],
-        "Scaled Balance": [f"{pos[3]:,.2f}" for pos in borrows],
-        "Leverage": [f"{pos[4]:,.2f}" for pos in borrows],
-        "Public Key": [pos[1] for pos in borrows],
+        "Market Index": board.market_index[rows].tolist(),
+        "Value": [f"${to_financial(value):,.2f}" for value in board.notional[rows]],
+        "Scaled Balance": [f"{amt:,.2f}" for amt in board.amount[rows]],
+        "Leverage": [f"{value:,.2f}" for value in board.leverage[rows]],
+        "Public Key": [index.user_keys[i] for i in board.user_idx[rows]],
     }
 
     return data
@@ -1,8 +1,25 @@
-from driftpy.constants import BASE_PRECISION, PRICE_PRECISION
+from typing import Optional
+
+import numpy as np
+from driftpy.constants import PRICE_PRECISION
 from driftpy.pickle.vat import Vat
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Query
 
 from backend.state import BackendRequest
+from backend.utils.liquidation_curve import (
+    DEFAULT_PRICE_WINDOWS,
+    LIQUIDATION_CURVE_BINS,
+    LIQUIDATION_CURVE_PAGE_SIZE,
+    LiquidationSide,
+    bin_liquidation_curve,
+    get_curve_bins,
+    get_curve_entries,
+    get_curve_window,
+)
+from backend.utils.liquidation_index import (
+    LiquidationPriceIndex,
+    load_liquidation_price_index,
+)
 
 router = APIRouter()
 
@@ -10,42 +27,198 @@ router = APIRouter()
 @router.get("/liquidation-curve")
 def get_liquidation_curve(request: BackendRequest, market_index: int):
     vat: Vat = request.state.backend_state.vat
-    liquidations_long: list[tuple[float, float, str]] = []
-    liquidations_short: list[tuple[float, float, str]] = []
     market_price = vat.perp_oracles.get(market_index)
     if market_price is None:
         print("Market price is None")
         return {"liquidations_long": [], "liquidations_short": [], "market_price_ui": 0}
     market_price_ui = market_price.price / PRICE_PRECISION
-    for pubkey, user in vat.users.user_map.items():
-        perp_position = user.get_perp_position(market_index)
-        if perp_position is not None:
-            liquidation_price = user.get_perp_liq_price(market_index)
-            if liquidation_price is not None:
-                liquidation_price_ui = liquidation_price / PRICE_PRECISION
-                position_size = abs(perp_position.base_asset_amount) / BASE_PRECISION
-                position_notional = position_size * market_price_ui
-                is_zero = round(position_notional) == 0
-                is_short = perp_position.base_asset_amount < 0
-                is_long = perp_position.base_asset_amount > 0
-                if is_zero:
-                    continue
-                if is_short and liquidation_price_ui > market_price_ui:
-                    liquidations_short.append(
-                        (liquidation_price_ui, position_notional, str(pubkey))
-                    )
-                elif is_long and liquidation_price_ui < market_price_ui:
-                    liquidations_long.append(
-                        (liquidation_price_ui, position_notional, str(pubkey))
-                    )
-                else:
-                    pass
-
-    liquidations_long.sort(key=lambda x: x[0])
-    liquidations_short.sort(key=lambda x: x[0])
+    state = request.state.backend_state
+    index = load_liquidation_price_index(state.current_pickle_path, vat)
+    entries = index.get_market_slice(market_index)
+    liq_prices = index.liq_prices[entries]
+    base_asset_amounts = index.base_asset_amounts[entries]
+    user_idx = index.user_idx[entries]
+    notionals = index.notionals[entries]
+    # Only positions with a notional worth a dollar are on the curves
+    is_nonzero = np.round(notionals) != 0
+
+    def get_liquidations(rows: slice, is_side: np.ndarray) -> list:
+        keep = is_nonzero[rows] & is_side[rows]
+        return [
+            (liq_price, notional, index.user_keys[i])
+            for liq_price, notional, i in zip(
+                liq_prices[rows][keep].tolist(),
+                notionals[rows][keep].tolist(),
+                user_idx[rows][keep].tolist(),
+            )
+        ]
+
+    # Entries are sorted by price, so each side is a slice of the market
+    below = np.searchsorted(liq_prices, market_price_ui, side="left")
+    above = np.searchsorted(liq_prices, market_price_ui, side="right")
+    liquidations_long = get_liquidations(slice(0, below), base_asset_amounts > 0)
+    liquidations_short = get_liquidations(slice(above, None), base_asset_amounts < 0)
 
     return {
         "liquidations_long": liquidations_long,
         "liquidations_short": liquidations_short,
         "market_price_ui": market_price_ui,
     }
+
+
+def get_market_curve_data(
+    request: BackendRequest, market_index: int
+) -> Optional[tuple[LiquidationPriceIndex, float]]:
+    """
+    The snapshot's liquidation price index and the market's oracle price, or
+    None for markets without an oracle.
+    """
+    vat: Vat = request.state.backend_state.vat
+    market_price = vat.perp_oracles.get(market_index)
+    if market_price is None:
+        return None
+    index = load_liquidation_price_index(
+        request.state.backend_state.current_pickle_path, vat
+    )
+    return index, market_price.price / PRICE_PRECISION
+
+
+def get_window_multipliers(
+    side: LiquidationSide,
+    min_multiplier: Optional[float],
+    max_multiplier: Optional[float],
+) -> tuple[float, float]:
+    default_min, default_max = DEFAULT_PRICE_WINDOWS[side]
+    min_multiplier = default_min if min_multiplier is None else min_multiplier
+    max_multiplier = default_max if max_multiplier is None else max_multiplier
+    if not 0 <= min_multiplier < max_multiplier:
+        raise HTTPException(
+            status_code=400,
+            detail="Price window multipliers must satisfy 0 <= min < max",
+        )
+    # The window is cut at the oracle price, so it has to reach past it
+    if side == LiquidationSide.LONG and min_multiplier >= 1:
+        raise HTTPException(
+            status_code=400, detail="The long window's min multiplier must be < 1"
+        )
+    if side == LiquidationSide.SHORT and max_multiplier <= 1:
+        raise HTTPException(
+            status_code=400, detail="The short window's max multiplier must be > 1"
+        )
+    return min_multiplier, max_multiplier
+
+
+@router.get("/liquidation-curve-bins")
+def get_binned_liquidation_curves(
+    request: BackendRequest,
+    market_index: int,
+    n_bins: int = Query(LIQUIDATION_CURVE_BINS, ge=1, le=10_000),
+    long_min_multiplier: Optional[float] = None,
+    long_max_multiplier: Optional[float] = None,
+    short_min_multiplier: Optional[float] = None,
+    short_max_multiplier: Optional[float] = None,
+):
+    """
+    Get both cumulative liquidation curves of a perp market, binned.
+
+    Args:
+        market_index (int): The perp market
+        n_bins (int): The number of price bins per curve
+        long_min_multiplier, long_max_multiplier (float, optional): The long
+            curve's price window as multiples of the oracle price, 0.2x-2x by
+            default
+        short_min_multiplier, short_max_multiplier (float, optional): The
+            short curve's price window, 0.5x-5x by default
+
+    Returns:
+        dict: The oracle price as `market_price_ui`, and per side (`long`,
+        `short`) the bins ascending by price, with keys:
+        - prices (list[float]): The price at which each bin is crossed
+        - notional, accounts (list): The notional and positions in each bin
+        - cumulative_notional, cumulative_accounts (list): Liquidated once
+          the price crosses each bin
+        - total_accounts (int): The positions on the curve
+    """
+    windows = {
+        LiquidationSide.LONG: get_window_multipliers(
+            LiquidationSide.LONG, long_min_multiplier, long_max_multiplier
+        ),
+        LiquidationSide.SHORT: get_window_multipliers(
+            LiquidationSide.SHORT, short_min_multiplier, short_max_multiplier
+        ),
+    }
+    curve_data = get_market_curve_data(request, market_index)
+    if curve_data is None:
+        return {"market_price_ui": 0, "long": None, "short": None}
+    index, market_price_ui = curve_data
+
+    curves = {}
+    for side, (min_multiplier, max_multiplier) in windows.items():
+        lower, upper = get_curve_window(
+            side, market_price_ui, min_multiplier, max_multiplier
+        )
+        rows = get_curve_entries(
+            index, market_index, market_price_ui, side, lower, upper
+        )
+        curves[side.value] = bin_liquidation_curve(
+            index, rows, side, lower, upper, n_bins
+        )
+    return {"market_price_ui": market_price_ui, **curves}
+
+
+@router.get("/liquidation-curve-accounts")
+def get_liquidation_curve_accounts(
+    request: BackendRequest,
+    market_index: int,
+    side: str = LiquidationSide.LONG.value,
+    min_multiplier: Optional[float] = None,
+    max_multiplier: Optional[float] = None,
+    n_bins: int = Query(LIQUIDATION_CURVE_BINS, ge=1, le=10_000),
+    bin_index: Optional[int] = Query(None, ge=0),
+    page: int = Query(0, ge=0),
+    page_size: int = Query(LIQUIDATION_CURVE_PAGE_SIZE, ge=1, le=1000),
+):
+    """
+    Get one page of the positions on a liquidation curve, in the order they
+    liquidate, optionally only those in one bin of
+    `/liquidation-curve-bins` (with the same window and `n_bins`).
+
+    Returns:
+        dict: `total` positions and the page's `accounts`, each with the
+        liquidation `price`, `notional` and `user_key`
+    """
+    try:
+        liquidation_side = LiquidationSide(side)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    min_multiplier, max_multiplier = get_window_multipliers(
+        liquidation_side, min_multiplier, max_multiplier
+    )
+    curve_data = get_market_curve_data(request, market_index)
+    if curve_data is None:
+        return {"total": 0, "page": page, "page_size": page_size, "accounts": []}
+    index, market_price_ui = curve_data
+
+    lower, upper = get_curve_window(
+        liquidation_side, market_price_ui, min_multiplier, max_multiplier
+    )
+    rows = get_curve_entries(
+        index, market_index, market_price_ui, liquidation_side, lower, upper
+    )
+    if bin_index is not None:
+        _, bins = get_curve_bins(index.liq_prices[rows], lower, upper, n_bins)
+        rows = rows[bins == bin_index]
+    page_rows = rows[page * page_size : (page + 1) * page_size]
+    return {
+        "total": len(rows),
+        "page": page,
+        "page_size": page_size,
+        "accounts": [
+            {"price": price, "notional": notional, "user_key": index.user_keys[i]}
+            for price, notional, i in zip(
+                index.liq_prices[page_rows].tolist(),
+                index.notionals[page_rows].tolist(),
+                index.user_idx[page_rows].tolist(),
+            )
+        ],
+    }
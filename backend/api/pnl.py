@@ -1,4 +1,3 @@
-from driftpy.pickle.vat import Vat
 from fastapi import APIRouter
 
 from backend.state import BackendRequest
@@ -8,28 +7,24 @@ router = APIRouter()
 
 @router.get("/top_pnl")
 def get_top_pnl(request: BackendRequest, limit: int = 1000):
-    vat: Vat = request.state.backend_state.vat
+    table, store = request.state.backend_state.get_snapshot_tables()
 
     pnl_data = []
-    for user in vat.users.values():
-        try:
-            realized_pnl = user.get_user_account().settled_perp_pnl / 1e6
-            unrealized_pnl = user.get_unrealized_pnl(True) / 1e6
-            total_pnl = realized_pnl + unrealized_pnl
+    for i in table.valid.nonzero()[0].tolist():
+        realized_pnl = float(table.settled_perp_pnl[i])
+        unrealized_pnl = float(table.upnl[i])
+        total_pnl = realized_pnl + unrealized_pnl
 
-            pnl_data.append(
-                {
-                    "authority": str(user.get_user_account().authority),
-                    "user_key": str(user.user_public_key),
-                    "realized_pnl": realized_pnl,
-                    "unrealized_pnl": unrealized_pnl,
-                    "total_pnl": total_pnl,
-                    # "collateral": user.get_total_collateral() / 1e6,
-                }
-            )
-        except Exception as e:
-            print(f"Error calculating PnL for {user.user_public_key}: {e}")
-            continue
+        pnl_data.append(
+            {
+                "authority": store.get_authority(i),
+                "user_key": table.user_keys[i],
+                "realized_pnl": realized_pnl,
+                "unrealized_pnl": unrealized_pnl,
+                "total_pnl": total_pnl,
+                # "collateral": table.total_collateral_initial[i],
+            }
+        )
 
     pnl_data.sort(key=lambda x: x["total_pnl"], reverse=True)
     return pnl_data[:limit]
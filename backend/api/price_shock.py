@@ -1,32 +1,112 @@
-from driftpy.drift_client import DriftClient
-from driftpy.pickle.vat import Vat
-from fastapi import APIRouter
+from typing import Optional
 
-from backend.state import BackendRequest
-from backend.utils.price_shock import PriceShockAssetGroup, get_price_shock_df
+from fastapi import APIRouter, HTTPException, Query, Response
+from pydantic import BaseModel, Field
+
+from backend.state import BackendRequest, BackendState
+from backend.utils.bankruptcy_frontier import get_bankruptcy_frontier
+from backend.utils.price_shock import (
+    MONTE_CARLO_CONFIDENCE_LEVELS,
+    PRICE_SHOCK_FRAMES,
+    PriceShockAssetGroup,
+    PriceShockEngine,
+    encode_price_shock_frame,
+    get_monte_carlo_price_shock,
+    get_price_shock_df,
+    get_shock_matrix_df,
+    price_shock_frames_to_json,
+)
+from backend.utils.shock_surface import get_price_shock_frames_from_surface
+from shared.frames import FRAME_MEDIA_TYPES, get_frame_format
+from shared.types import FrameFormat
 
 router = APIRouter()
 
 
-async def _get_price_shock(
-    slot: int,
-    vat: Vat,
-    drift_client: DriftClient,
+class ShockScenario(BaseModel):
+    """
+    Relative moves (e.g. -0.2 for a 20% drop) keyed by oracle id or market index.
+    Oracles that are not mentioned stay at their current price.
+    """
+
+    name: Optional[str] = None
+    oracle_moves: dict[str, float] = Field(default_factory=dict)
+    spot_moves: dict[int, float] = Field(default_factory=dict)
+    perp_moves: dict[int, float] = Field(default_factory=dict)
+
+
+class ShockMatrix(BaseModel):
+    scenarios: list[ShockScenario]
+
+
+class MonteCarloShock(BaseModel):
+    """
+    Covariance of log-returns, with rows and columns ordered as `oracle_ids`,
+    then `spot_markets`, then `perp_markets`.
+    """
+
+    covariance: list[list[float]]
+    oracle_ids: list[str] = Field(default_factory=list)
+    spot_markets: list[int] = Field(default_factory=list)
+    perp_markets: list[int] = Field(default_factory=list)
+    n_samples: int = Field(default=10_000, gt=0, le=100_000)
+    seed: int = 0
+    confidence_levels: list[float] = Field(
+        default_factory=lambda: list(MONTE_CARLO_CONFIDENCE_LEVELS)
+    )
+
+
+async def _get_price_shock_frames(
+    backend_state: BackendState,
     oracle_distortion: float = 0.1,
     asset_group: str = PriceShockAssetGroup.IGNORE_STABLES.value,
     n_scenarios: int = 5,
+    engine: str = PriceShockEngine.VECTORIZED.value,
+    n_workers: Optional[int] = None,
+    net_usd_value_threshold: float = 100.0,
+    health_threshold: float = 5,
 ) -> dict:
     asset_group = asset_group.replace("+", " ")
     price_shock_asset_group = PriceShockAssetGroup(asset_group)
+    price_shock_engine = PriceShockEngine(engine)
 
-    return get_price_shock_df(
-        slot=slot,
-        drift_client=drift_client,
-        vat=vat,
+    # Off the event loop, so other routes keep serving while scenarios run
+    return await backend_state.read_snapshot(
+        get_price_shock_df,
+        slot=backend_state.last_oracle_slot,
+        drift_client=backend_state.dc,
+        vat=backend_state.vat,
         oracle_distortion=oracle_distortion,
         asset_group=price_shock_asset_group,
         n_scenarios=n_scenarios,
+        engine=price_shock_engine,
+        n_workers=n_workers,
+        net_usd_value_threshold=net_usd_value_threshold,
+        health_threshold=health_threshold,
+    )
+
+
+async def _get_price_shock(
+    backend_state: BackendState,
+    oracle_distortion: float = 0.1,
+    asset_group: str = PriceShockAssetGroup.IGNORE_STABLES.value,
+    n_scenarios: int = 5,
+    engine: str = PriceShockEngine.VECTORIZED.value,
+    n_workers: Optional[int] = None,
+    net_usd_value_threshold: float = 100.0,
+    health_threshold: float = 5,
+) -> dict:
+    frames = await _get_price_shock_frames(
+        backend_state,
+        oracle_distortion,
+        asset_group,
+        n_scenarios,
+        engine,
+        n_workers,
+        net_usd_value_threshold,
+        health_threshold,
     )
+    return price_shock_frames_to_json(frames)
 
 
 @router.get("/usermap")
@@ -35,12 +115,105 @@ async def get_price_shock(
     oracle_distortion: float = 0.1,
     asset_group: str = PriceShockAssetGroup.IGNORE_STABLES.value,
     n_scenarios: int = 5,
+    engine: str = PriceShockEngine.VECTORIZED.value,
+    n_workers: Optional[int] = None,
+    net_usd_value_threshold: float = 100.0,
+    health_threshold: float = 5,
+    format: Optional[str] = None,
+    frame: str = "result",
+    users: bool = True,
 ):
-    return await _get_price_shock(
-        request.state.backend_state.last_oracle_slot,
-        request.state.backend_state.vat,
-        request.state.backend_state.dc,
-        oracle_distortion,
-        asset_group,
-        n_scenarios,
+    """
+    JSON by default. With `format=arrow|parquet`, or a matching `Accept`
+    header, returns only the `frame` DataFrame in that format, with the other
+    response fields in its schema metadata.
+
+    With `users=false` only the scenario table is returned, read off the
+    snapshot's precomputed shock surface when one exists. Other frames are
+    always computed.
+    """
+    try:
+        frame_format = get_frame_format(format, request.headers.get("accept"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if frame_format != FrameFormat.JSON and frame not in PRICE_SHOCK_FRAMES:
+        raise HTTPException(
+            status_code=400, detail=f"frame must be one of {PRICE_SHOCK_FRAMES}"
+        )
+
+    frames = None
+    # The surface only holds the scenario table
+    if not users and (frame_format == FrameFormat.JSON or frame == "result"):
+        frames = get_price_shock_frames_from_surface(
+            request.state.backend_state.current_pickle_path,
+            PriceShockAssetGroup(asset_group.replace("+", " ")),
+            oracle_distortion,
+            n_scenarios,
+        )
+    if frames is None:
+        frames = await _get_price_shock_frames(
+            request.state.backend_state,
+            oracle_distortion,
+            asset_group,
+            n_scenarios,
+            engine,
+            n_workers,
+            net_usd_value_threshold,
+            health_threshold,
+        )
+    if frame_format == FrameFormat.JSON:
+        return price_shock_frames_to_json(frames)
+    return Response(
+        content=encode_price_shock_frame(frames, frame, frame_format),
+        media_type=FRAME_MEDIA_TYPES[frame_format],
+    )
+
+
+@router.post("/scenarios")
+async def post_price_shock_scenarios(
+    request: BackendRequest, shock_matrix: ShockMatrix
+):
+    try:
+        return await request.state.backend_state.read_snapshot(
+            get_shock_matrix_df,
+            slot=request.state.backend_state.last_oracle_slot,
+            drift_client=request.state.backend_state.dc,
+            vat=request.state.backend_state.vat,
+            scenarios=[scenario.model_dump() for scenario in shock_matrix.scenarios],
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/monte-carlo")
+async def post_price_shock_monte_carlo(
+    request: BackendRequest, monte_carlo_shock: MonteCarloShock
+):
+    try:
+        return await request.state.backend_state.read_snapshot(
+            get_monte_carlo_price_shock,
+            slot=request.state.backend_state.last_oracle_slot,
+            drift_client=request.state.backend_state.dc,
+            vat=request.state.backend_state.vat,
+            **monte_carlo_shock.model_dump(),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/frontier")
+async def get_price_shock_frontier(
+    request: BackendRequest,
+    threshold: float = 1_000_000,
+    tolerance: float = Query(0.001, gt=0),
+    max_up_move: float = Query(4.0, gt=0),
+):
+    return await request.state.backend_state.read_snapshot(
+        get_bankruptcy_frontier,
+        slot=request.state.backend_state.last_oracle_slot,
+        drift_client=request.state.backend_state.dc,
+        vat=request.state.backend_state.vat,
+        threshold=threshold,
+        tolerance=tolerance,
+        max_up_move=max_up_move,
     )
@@ -46,11 +46,11 @@ async def lifespan(app: FastAPI):
     cached_vat_path = sorted(glob.glob("pickles/*"))
     if len(cached_vat_path) > 0:
         logger.info("Loading cached vat")
-        await state.load_pickle_snapshot(cached_vat_path[-1])
+        await state.load_pickle_snapshot(cached_vat_path[-1], build_indexes=True)
     else:
         logger.info("No cached vat found, bootstrapping")
         await state.bootstrap()
-        await state.take_pickle_snapshot()
+        await state.take_pickle_snapshot(build_indexes=True)
     state.ready = True
 
     time.sleep(random.randint(1, 10))
@@ -1,4 +1,5 @@
 import asyncio
+import base64
 import glob
 import hashlib
 import json
@@ -11,6 +12,7 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.types import ASGIApp
 
 from backend.state import BackendRequest, BackendState
+from shared.frames import FRAME_MEDIA_TYPES
 
 
 class CacheMiddleware(BaseHTTPMiddleware):
@@ -30,6 +32,9 @@ class CacheMiddleware(BaseHTTPMiddleware):
             return await call_next(request)
         if not request.url.path.startswith("/api"):
             return await call_next(request)
+        # Cache keys don't include the body, so only GETs can be served from cache
+        if request.method != "GET":
+            return await call_next(request)
 
         current_pickle = self.state.current_pickle_path
         previous_pickles = self._get_previous_pickles(4)  # Get last 4 pickles
@@ -64,7 +69,10 @@ class CacheMiddleware(BaseHTTPMiddleware):
         with open(cache_file, "r") as f:
             response_data = json.load(f)
 
-        content = json.dumps(response_data["content"]).encode("utf-8")
+        if "body" in response_data:
+            content = base64.b64decode(response_data["body"])
+        else:
+            content = json.dumps(response_data["content"]).encode("utf-8")
         headers = {
             k: v
             for k, v in response_data["headers"].items()
@@ -78,7 +86,7 @@ class CacheMiddleware(BaseHTTPMiddleware):
             content=content,
             status_code=response_data["status_code"],
             headers=headers,
-            media_type="application/json",
+            media_type=headers.get("content-type", "application/json"),
         )
 
     async def _serve_stale_response(
@@ -147,9 +155,7 @@ class CacheMiddleware(BaseHTTPMiddleware):
                     async for chunk in response.body_iterator:
                         response_body += chunk
 
-                    body_content = json.loads(response_body.decode())
                     response_data = {
-                        "content": body_content,
                         "status_code": response.status_code,
                         "headers": {
                             k: v
@@ -157,6 +163,12 @@ class CacheMiddleware(BaseHTTPMiddleware):
                             if k.lower() != "content-length"
                         },
                     }
+                    content_type = response.headers.get("content-type", "")
+                    if content_type.startswith("application/json"):
+                        response_data["content"] = json.loads(response_body.decode())
+                    else:
+                        # Columnar (Arrow/Parquet) responses are stored as-is
+                        response_data["body"] = base64.b64encode(response_body).decode()
 
                     os.makedirs(os.path.dirname(cache_file), exist_ok=True)
                     with open(cache_file, "w") as f:
@@ -178,6 +190,12 @@ class CacheMiddleware(BaseHTTPMiddleware):
         hash_input = (
             f"{pickle_path}:{request.method}:{request.url.path}:{request.url.query}"
         )
+        # Columnar formats can also be negotiated through Accept
+        accept = request.headers.get("accept", "")
+        for media_type in FRAME_MEDIA_TYPES.values():
+            if media_type in accept:
+                hash_input = f"{hash_input}:{media_type}"
+                break
         logging.info("Hash input: %s", hash_input)
         return hashlib.md5(hash_input.encode()).hexdigest()
 
@@ -10,9 +10,20 @@ from dotenv import load_dotenv
 from fastapi.responses import JSONResponse
 
 from backend.api.asset_liability import _get_asset_liability_matrix
-from backend.api.price_shock import _get_price_shock
 from backend.state import BackendState
-from shared.types import PriceShockAssetGroup
+from backend.utils.price_shock import (
+    PRICE_SHOCK_FRAMES,
+    build_price_shock_frames,
+    encode_price_shock_frame,
+    price_shock_frames_to_json,
+)
+from backend.utils.shock_surface import (
+    compute_shock_surface,
+    get_surface_scenario_levels,
+    get_user_leverages_from_surface,
+    save_shock_surface,
+)
+from shared.types import FrameFormat, PriceShockAssetGroup
 
 load_dotenv()
 
@@ -78,6 +89,32 @@ async def process_multiple_endpoints(state_pickle_path: str, endpoints: list[End
 
     results = []
 
+    # One shock surface per asset group, computed once and shared by all of its
+    # scenario sets since their shock levels overlap
+    surfaces = {}
+    price_shock_endpoints = [
+        endpoint for endpoint in endpoints if isinstance(endpoint, PriceShockEndpoint)
+    ]
+    for asset_group in {endpoint.asset_group for endpoint in price_shock_endpoints}:
+        user_levels = set()
+        for endpoint in price_shock_endpoints:
+            if endpoint.asset_group == asset_group:
+                user_levels.update(
+                    get_surface_scenario_levels(
+                        endpoint.oracle_distortion, endpoint.n_scenarios
+                    )
+                )
+        surface, user_metrics = compute_shock_surface(
+            state.last_oracle_slot,
+            state.dc,
+            state.vat,
+            PriceShockAssetGroup(asset_group.replace("+", " ")),
+            user_levels,
+        )
+        save_shock_surface(surface, state_pickle_path)
+        surfaces[asset_group] = (surface, user_metrics)
+    user_keys = list(state.vat.users.user_map.keys())
+
     for endpoint_object in endpoints:
         endpoint = endpoint_object.endpoint
         query_params = endpoint_object.params
@@ -90,21 +127,42 @@ async def process_multiple_endpoints(state_pickle_path: str, endpoints: list[End
 
         request = MockRequest(f"/api/{endpoint}", query_params)
 
+        ucache_key = f"{request.method}{request.url.path}"
+        if request.url.query:
+            safe_query = request.url.query.replace("&", "_").replace("=", "-")
+            ucache_key = f"{ucache_key}__{safe_query}"
+        ucache_key = ucache_key.replace("/", "_")
+        ucache_file = os.path.join("ucache", f"{ucache_key}.json")
+
         async def mock_call_next(request):
             if endpoint == "price-shock/usermap":
-                content = await _get_price_shock(
+                surface, user_metrics = surfaces[query_params["asset_group"]]
+                frames = build_price_shock_frames(
                     state.last_oracle_slot,
-                    state.vat,
-                    state.dc,
-                    oracle_distortion=query_params["oracle_distortion"],
-                    asset_group=query_params["asset_group"],
-                    n_scenarios=query_params["n_scenarios"],
+                    get_user_leverages_from_surface(
+                        surface,
+                        user_metrics,
+                        user_keys,
+                        query_params["oracle_distortion"],
+                        query_params["n_scenarios"],
+                    ),
+                    query_params["oracle_distortion"],
+                    query_params["n_scenarios"],
                 )
+                # Arrow copies of each frame, read by the frontend instead of the JSON
+                for frame in PRICE_SHOCK_FRAMES:
+                    with open(
+                        os.path.join("ucache", f"{ucache_key}__frame-{frame}.arrow"),
+                        "wb",
+                    ) as f:
+                        f.write(
+                            encode_price_shock_frame(frames, frame, FrameFormat.ARROW)
+                        )
+                content = price_shock_frames_to_json(frames)
 
             if endpoint == "asset-liability/matrix":
                 content = await _get_asset_liability_matrix(
-                    state.last_oracle_slot,
-                    state.vat,
+                    state,
                     mode=query_params["mode"],
                     perp_market_index=query_params["perp_market_index"],
                 )
@@ -114,13 +172,6 @@ async def process_multiple_endpoints(state_pickle_path: str, endpoints: list[End
         print(request.url.path)
         print(request.url.query)
 
-        ucache_key = f"{request.method}{request.url.path}"
-        if request.url.query:
-            safe_query = request.url.query.replace("&", "_").replace("=", "-")
-            ucache_key = f"{ucache_key}__{safe_query}"
-        ucache_key = ucache_key.replace("/", "_")
-        ucache_file = os.path.join("ucache", f"{ucache_key}.json")
-
         async def run_request():
             response = await mock_call_next(request)
             if response.status_code == 200:
@@ -165,8 +216,9 @@ async def main():
 
     ps_parser = subparsers.add_parser("price-shock")
     ps_parser.add_argument("--asset-group", type=str, required=True)
-    ps_parser.add_argument("--oracle-distortion", type=float, required=True)
-    ps_parser.add_argument("--n-scenarios", type=int, required=True)
+    # Pairs up: --oracle-distortion 0.05 0.1 --n-scenarios 5 10
+    ps_parser.add_argument("--oracle-distortion", type=float, nargs="+", required=True)
+    ps_parser.add_argument("--n-scenarios", type=int, nargs="+", required=True)
 
     args = parser.parse_args()
 
@@ -186,13 +238,18 @@ async def main():
             )
         )
     elif args.command == "price-shock":
-        endpoints.append(
-            PriceShockEndpoint(
-                asset_group=args.asset_group,
-                oracle_distortion=args.oracle_distortion,
-                n_scenarios=args.n_scenarios,
+        if len(args.oracle_distortion) != len(args.n_scenarios):
+            parser.error("--oracle-distortion and --n-scenarios must pair up")
+        for oracle_distortion, n_scenarios in zip(
+            args.oracle_distortion, args.n_scenarios
+        ):
+            endpoints.append(
+                PriceShockEndpoint(
+                    asset_group=args.asset_group,
+                    oracle_distortion=oracle_distortion,
+                    n_scenarios=n_scenarios,
+                )
             )
-        )
 
     await generate_ucache(endpoints)
 
@@ -202,4 +259,4 @@ if __name__ == "__main__":
 
 # Usage example:
 # python -m backend.scripts.generate_ucache --use-snapshot asset-liability --mode 0 --perp-market-index 0
-# python -m backend.scripts.generate_ucache --use-snapshot price-shock --asset-group "ignore+stables" --oracle-distortion 0.05 --n-scenarios 5
+# python -m backend.scripts.generate_ucache --use-snapshot price-shock --asset-group "ignore+stables" --oracle-distortion 0.05 0.1 --n-scenarios 5 10
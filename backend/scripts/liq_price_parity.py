@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import glob
+import os
+import sys
+
+import numpy as np
+from dotenv import load_dotenv
+
+from backend.state import BackendState
+from backend.utils.liq_price_solver import (
+    compare_perp_liq_prices,
+    solve_perp_liq_prices,
+)
+
+load_dotenv()
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the vectorized liquidation price solver with driftpy"
+    )
+    parser.add_argument("--pickle-path", type=str, help="Defaults to the latest")
+    parser.add_argument(
+        "--sample", type=int, help="Compare a random sample of this many positions"
+    )
+    parser.add_argument("--market-index", type=int, help="Only this perp market")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0,
+        help="Largest accepted deviation, in PRICE_PRECISION units",
+    )
+    parser.add_argument("--output", type=str, help="Write every position to a csv")
+    args = parser.parse_args()
+
+    pickle_path = args.pickle_path or sorted(glob.glob("pickles/*"))[-1]
+    state = BackendState()
+    state.initialize(os.getenv("RPC_URL") or "")
+    await state.load_pickle_snapshot(pickle_path)
+
+    users = list(state.vat.users.values())
+    store = state.get_position_store()
+    liq_prices, is_exact = solve_perp_liq_prices(state.vat.drift_client, users, store)
+    perp = store.perp
+    is_compared = (perp.base_asset_amount != 0) & is_exact
+    if args.market_index is not None:
+        is_compared &= perp.market_index == args.market_index
+    positions = np.flatnonzero(is_compared)
+    if args.sample is not None and args.sample < len(positions):
+        positions = np.sort(
+            np.random.default_rng(0).choice(positions, args.sample, replace=False)
+        )
+    df = compare_perp_liq_prices(users, store, liq_prices, is_exact, positions)
+    await state.close()
+
+    n_fallback = int(((perp.base_asset_amount != 0) & ~is_exact).sum())
+    print(f"{len(df)} positions compared, {n_fallback} left to driftpy")
+    if args.output:
+        df.to_csv(args.output, index=False)
+
+    print(f"Max deviation: {df['deviation'].max()}")
+    print("Worst positions:")
+    print(df.nlargest(10, "deviation").to_string(index=False))
+
+    failing = df["deviation"] > args.tolerance
+    if failing.any():
+        print(f"{failing.sum()} positions deviate by more than {args.tolerance}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+
+# Usage example:
+# python -m backend.scripts.liq_price_parity --sample 5000 --tolerance 0 --output liq_parity.csv
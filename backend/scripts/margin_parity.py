@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import glob
+import os
+import sys
+
+import numpy as np
+from dotenv import load_dotenv
+
+from backend.state import BackendState
+from backend.utils.margin_calculator import (
+    MARGIN_METRICS,
+    build_margin_arrays,
+    calculate_margin_metrics,
+    compare_margin_metrics,
+)
+
+load_dotenv()
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the vectorized margin calculator with driftpy"
+    )
+    parser.add_argument("--pickle-path", type=str, help="Defaults to the latest")
+    parser.add_argument(
+        "--sample", type=int, help="Compare a random sample of this many users"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0,
+        help="Largest accepted deviation, in driftpy's integer units",
+    )
+    parser.add_argument("--output", type=str, help="Write every deviation to a csv")
+    parser.add_argument(
+        "--include-fallback",
+        action="store_true",
+        help="Also hold users the table prices with driftpy to the tolerance",
+    )
+    args = parser.parse_args()
+
+    pickle_path = args.pickle_path or sorted(glob.glob("pickles/*"))[-1]
+    state = BackendState()
+    state.initialize(os.getenv("RPC_URL") or "")
+    await state.load_pickle_snapshot(pickle_path)
+
+    users = list(state.vat.users.values())
+    arrays = build_margin_arrays(
+        state.vat.drift_client, users, state.get_position_store()
+    )
+    metrics = calculate_margin_metrics(arrays)
+    user_indexes = None
+    if args.sample is not None and args.sample < len(users):
+        user_indexes = np.sort(
+            np.random.default_rng(0).choice(len(users), args.sample, replace=False)
+        )
+    df = compare_margin_metrics(arrays, metrics, user_indexes)
+    await state.close()
+
+    print(f"{len(df)} users compared, {df['is_fallback'].sum()} fallback")
+    if args.output:
+        df.to_csv(args.output, index=False)
+
+    checked = df if args.include_fallback else df[~df["is_fallback"]]
+    print("Max deviation per metric:")
+    print(checked[MARGIN_METRICS].max().to_string())
+    print("Worst users:")
+    print(checked.nlargest(10, "max_deviation").to_string(index=False))
+
+    failing = (checked[MARGIN_METRICS] > args.tolerance).any(axis=1)
+    if failing.any():
+        print(f"{failing.sum()} users deviate by more than {args.tolerance}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+
+# Usage example:
+# python -m backend.scripts.margin_parity --sample 5000 --tolerance 0 --output parity.csv
@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import glob
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from backend.state import BackendState
+from backend.utils.price_shock import compare_price_shock_leverages
+from backend.utils.user_metrics import get_user_leverages_for_price_shock
+from backend.utils.vectorized_price_shock import (
+    PRICE_SHOCK_COLUMNS,
+    get_user_leverages_for_price_shock_vectorized,
+)
+from shared.types import PriceShockAssetGroup
+
+load_dotenv()
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the vectorized price shock engine with driftpy"
+    )
+    parser.add_argument("--pickle-path", type=str, help="Defaults to the latest")
+    parser.add_argument(
+        "--asset-group",
+        type=str,
+        default=PriceShockAssetGroup.IGNORE_STABLES.value,
+    )
+    parser.add_argument("--oracle-distortion", type=float, default=0.1)
+    parser.add_argument("--n-scenarios", type=int, default=5)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.01,
+        help="Largest accepted deviation of any user column or bankruptcy total",
+    )
+    parser.add_argument("--output", type=str, help="Write every deviation to a csv")
+    args = parser.parse_args()
+
+    pickle_path = args.pickle_path or sorted(glob.glob("pickles/*"))[-1]
+    state = BackendState()
+    state.initialize(os.getenv("RPC_URL") or "")
+    await state.load_pickle_snapshot(pickle_path)
+
+    engine_args = (
+        state.last_oracle_slot,
+        state.dc,
+        state.vat.users,
+        args.oracle_distortion,
+        PriceShockAssetGroup(args.asset_group.replace("+", " ")),
+        args.n_scenarios,
+    )
+    start = time.time()
+    expected = get_user_leverages_for_price_shock(*engine_args)
+    print(f"driftpy engine: {time.time() - start:.1f}s")
+    start = time.time()
+    actual = get_user_leverages_for_price_shock_vectorized(*engine_args)
+    print(f"vectorized engine: {time.time() - start:.1f}s")
+    totals, deviations = compare_price_shock_leverages(
+        expected, actual, args.oracle_distortion, args.n_scenarios
+    )
+    await state.close()
+
+    print(f"{deviations['user_key'].nunique()} users over {len(totals)} scenarios")
+    if args.output:
+        deviations.to_csv(args.output, index=False)
+
+    print("Bankruptcy per scenario:")
+    print(totals.to_string(index=False))
+    print("Max deviation per column:")
+    print(deviations[PRICE_SHOCK_COLUMNS[1:]].max().to_string())
+    print("Worst users:")
+    print(deviations.nlargest(10, "max_deviation").to_string(index=False))
+
+    failing_users = deviations["max_deviation"] > args.tolerance
+    failing_totals = (
+        totals[["Total Deviation ($)", "Spot Deviation ($)"]] > args.tolerance
+    ).any(axis=1)
+    if failing_users.any() or failing_totals.any():
+        print(
+            f"{failing_users.sum()} user scenarios and {failing_totals.sum()} "
+            f"bankruptcy totals deviate by more than {args.tolerance}"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+
+# Usage example:
+# python -m backend.scripts.price_shock_parity --asset-group "ignore+stables" --oracle-distortion 0.1 --n-scenarios 5 --output price_shock_parity.csv
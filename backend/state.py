@@ -1,6 +1,11 @@
+import asyncio
+import functools
 import os
 from asyncio import create_task, gather
+from concurrent.futures import Future, wait
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Any, Callable, Optional
 
 from anchorpy.provider import Wallet
 from driftpy.account_subscription_config import AccountSubscriptionConfig
@@ -21,10 +26,52 @@ from driftpy.user_map.userstats_map import UserStatsMap
 from fastapi import Request
 from solana.rpc.async_api import AsyncClient
 
+from backend.utils.leaderboard_index import (
+    LeaderboardIndex,
+    build_leaderboard_index,
+    load_leaderboard_index,
+    start_leaderboard_index,
+)
+from backend.utils.liquidation_index import start_liquidation_price_index
+from backend.utils.matrix import start_asset_liability_cube
+from backend.utils.metrics_cache import metrics_cache
+from backend.utils.position_store import PositionStore, build_position_store
+from backend.utils.user_metrics_table import (
+    UserMetricsTable,
+    build_user_metrics_table,
+    clear_user_metrics_table,
+    start_user_metrics_table,
+)
 from backend.utils.vat import load_newest_files
 from backend.utils.waiting_for import waiting_for
 
 
+@dataclass
+class SnapshotTables:
+    """
+    The position store of the loaded snapshot and its background builds,
+    swapped in together so no reader pairs one snapshot's store with another
+    snapshot's table. Without `build_indexes` there are no builds, and the
+    tables are built when asked for.
+    """
+
+    position_store: PositionStore
+    user_metrics_table: Optional[Future] = None
+    liquidation_index: Optional[Future] = None
+    asset_liability_cube: Optional[Future] = None
+
+    def get_builds(self) -> list[Future]:
+        return [
+            future
+            for future in (
+                self.user_metrics_table,
+                self.liquidation_index,
+                self.asset_liability_cube,
+            )
+            if future is not None
+        ]
+
+
 class BackendState:
     connection: AsyncClient
     dc: DriftClient
@@ -36,6 +83,11 @@ class BackendState:
     current_pickle_path: str
     last_oracle_slot: int
     vat: Vat
+    snapshot_tables: Optional[SnapshotTables]
+    # Reads of the vat running off the event loop, and whether a snapshot is
+    # fully loaded (i.e. new reads may start)
+    snapshot_reads: set[asyncio.Future]
+    snapshot_loaded: asyncio.Event
     ready: bool
 
     def initialize(
@@ -75,6 +127,10 @@ class BackendState:
         )
         self.ready = False
         self.current_pickle_path = "bootstrap"
+        self.snapshot_tables = None
+        self.snapshot_reads = set()
+        self.snapshot_loaded = asyncio.Event()
+        self.snapshot_loaded.set()
 
     async def bootstrap(self):
         with waiting_for("drift client"):
@@ -87,8 +143,11 @@ class BackendState:
                 create_task(self.stats_map.subscribe()),
             )
         self.current_pickle_path = "bootstrap"
+        metrics_cache.switch_snapshot(None)
+        clear_user_metrics_table()
+        self.snapshot_tables = None
 
-    async def take_pickle_snapshot(self):
+    async def take_pickle_snapshot(self, build_indexes: bool = False):
         now = datetime.now()
         folder_name = now.strftime("vat-%Y-%m-%d-%H-%M-%S")
         if not os.path.exists("pickles"):
@@ -99,26 +158,137 @@ class BackendState:
         with waiting_for("pickling"):
             result = await self.vat.pickle(path)
         with waiting_for("unpickling"):
-            await self.load_pickle_snapshot(path)
+            await self.load_pickle_snapshot(path, build_indexes)
         return result
 
-    async def load_pickle_snapshot(self, directory: str):
+    async def read_snapshot(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Runs `func` off the event loop, like `asyncio.to_thread`, for work that
+        reads the vat in place. It starts once any snapshot being loaded is
+        in, and the next load waits for it to finish, even if the request
+        awaiting it is cancelled.
+        """
+        await self.snapshot_loaded.wait()
+        future = asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(func, *args, **kwargs)
+        )
+        self.snapshot_reads.add(future)
+        future.add_done_callback(self.snapshot_reads.discard)
+        return await asyncio.shield(future)
+
+    async def wait_for_snapshot_reads(self):
+        """
+        Stops new snapshot reads from starting and waits for the running ones.
+        """
+        self.snapshot_loaded.clear()
+        if self.snapshot_reads:
+            with waiting_for("snapshot reads"):
+                await asyncio.wait(set(self.snapshot_reads))
+
+    async def wait_for_snapshot_builds(self):
+        """
+        Waits, off the event loop, for the loaded snapshot's background builds
+        to finish, since they read the vat in place.
+        """
+        if self.snapshot_tables is None:
+            return
+        builds = self.snapshot_tables.get_builds()
+        if builds:
+            with waiting_for("previous snapshot's builds"):
+                await asyncio.to_thread(wait, builds)
+
+    async def load_pickle_snapshot(self, directory: str, build_indexes: bool = False):
+        """
+        Unpickles `directory` into the vat. With `build_indexes`, the metrics
+        table, leaderboards, liquidation price index and asset-liability cube
+        of the snapshot are built in the background right away, as the app
+        does.
+        """
         pickle_map = load_newest_files(directory)
-        self.current_pickle_path = os.path.realpath(directory)
-        with waiting_for("unpickling"):
-            await self.vat.unpickle(
-                users_filename=pickle_map["usermap"],
-                user_stats_filename=pickle_map["userstats"],
-                spot_markets_filename=pickle_map["spot"],
-                perp_markets_filename=pickle_map["perp"],
-                spot_oracles_filename=pickle_map["spotoracles"],
-                perp_oracles_filename=pickle_map["perporacles"],
+        await self.wait_for_snapshot_reads()
+        try:
+            await self.wait_for_snapshot_builds()
+            self.current_pickle_path = os.path.realpath(directory)
+            with waiting_for("unpickling"):
+                await self.vat.unpickle(
+                    users_filename=pickle_map["usermap"],
+                    user_stats_filename=pickle_map["userstats"],
+                    spot_markets_filename=pickle_map["spot"],
+                    perp_markets_filename=pickle_map["perp"],
+                    spot_oracles_filename=pickle_map["spotoracles"],
+                    perp_oracles_filename=pickle_map["perporacles"],
+                )
+
+            self.last_oracle_slot = int(
+                pickle_map["perporacles"].split("_")[-1].split(".")[0]
             )
+            metrics_cache.switch_snapshot(self.current_pickle_path)
+            with waiting_for("position store"):
+                tables = SnapshotTables(build_position_store(self.vat))
+            if build_indexes:
+                tables.user_metrics_table = start_user_metrics_table(
+                    self.current_pickle_path, self.vat, tables.position_store
+                )
+                start_leaderboard_index(
+                    tables.position_store, tables.user_metrics_table
+                )
+                tables.liquidation_index = start_liquidation_price_index(
+                    self.current_pickle_path, self.vat, tables.position_store
+                )
+                tables.asset_liability_cube = start_asset_liability_cube(
+                    self.current_pickle_path, self.vat
+                )
+            else:
+                clear_user_metrics_table()
+            self.snapshot_tables = tables
+        finally:
+            self.snapshot_loaded.set()
+        return pickle_map
 
-        self.last_oracle_slot = int(
-            pickle_map["perporacles"].split("_")[-1].split(".")[0]
+    def get_user_metrics_table(self) -> UserMetricsTable:
+        """
+        The metrics table of the loaded snapshot, waiting for it if it's still
+        being built. Built on the spot if it isn't built in the background.
+        """
+        return self.get_snapshot_tables()[0]
+
+    def get_position_store(self) -> PositionStore:
+        """
+        The position store of the loaded snapshot. Without a snapshot, it's
+        built from the live user map.
+        """
+        if self.snapshot_tables is None:
+            return build_position_store(self.vat)
+        return self.snapshot_tables.position_store
+
+    def get_snapshot_tables(self) -> tuple[UserMetricsTable, PositionStore]:
+        """
+        The metrics table and position store of the same snapshot, even if a
+        new one is being swapped in.
+        """
+        tables = self.snapshot_tables
+        if tables is None:
+            store = build_position_store(self.vat)
+        else:
+            store = tables.position_store
+        if tables is None or tables.user_metrics_table is None:
+            table = build_user_metrics_table(self.current_pickle_path, self.vat, store)
+        else:
+            table = tables.user_metrics_table.result()
+        return table, store
+
+    def get_leaderboard_index(self) -> LeaderboardIndex:
+        """
+        The health leaderboards of the loaded snapshot. Built on the spot if
+        they aren't built in the background.
+        """
+        tables = self.snapshot_tables
+        if tables is None or tables.user_metrics_table is None:
+            table, store = self.get_snapshot_tables()
+            return build_leaderboard_index(store, table)
+        return load_leaderboard_index(
+            tables.position_store, tables.user_metrics_table.result()
         )
-        return pickle_map
 
     async def close(self):
         await self.dc.unsubscribe()
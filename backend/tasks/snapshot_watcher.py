@@ -44,7 +44,9 @@ class SnapshotWatcher:
                 newest_pickle = self._get_newest_pickle()
                 if newest_pickle and newest_pickle != self.last_loaded_snapshot:
                     logger.info(f"Found newer pickle snapshot: {newest_pickle}")
-                    await self.state.load_pickle_snapshot(newest_pickle)
+                    await self.state.load_pickle_snapshot(
+                        newest_pickle, build_indexes=True
+                    )
                     self.last_loaded_snapshot = newest_pickle
                     logger.info("Successfully switched to new snapshot")
 
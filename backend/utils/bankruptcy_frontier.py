@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+from driftpy.decode.utils import decode_name
+from driftpy.drift_client import DriftClient
+from driftpy.oracles.oracle_id import get_oracle_id
+from driftpy.pickle.vat import Vat
+
+from backend.utils.user_metrics import (
+    calculate_leverages_for_price_shock,
+    get_user_oracles,
+)
+from backend.utils.vectorized_price_shock import (
+    PriceShockArrays,
+    build_price_shock_arrays,
+    evaluate_fallback_users,
+    evaluate_price_shock,
+    select_users,
+)
+
+# Enough halvings to exhaust float precision on any move range
+MAX_BISECTION_STEPS = 64
+
+
+def get_oracle_exposed_users(
+    arrays: PriceShockArrays, oracle: int, fallback_oracles: list[set[int]]
+) -> np.ndarray:
+    """
+    Sorted indexes of the users whose margin moves with `oracle`.
+    """
+    exposed = [
+        arrays.spot_user[arrays.spot_oracle == oracle],
+        arrays.perp_user[arrays.perp_oracle == oracle],
+        arrays.fallback_users[[oracle in oracles for oracles in fallback_oracles]],
+    ]
+    if oracle == arrays.quote_oracle:
+        # perp pnl and margin are converted at the quote oracle price
+        exposed.append(arrays.perp_user)
+    return np.unique(np.concatenate(exposed)).astype(np.int64)
+
+
+def bisect_bankruptcy_moves(
+    total_bankruptcy,
+    threshold: float,
+    max_moves: np.ndarray,
+    tolerance: float,
+) -> list:
+    """
+    Smallest move in each direction at which `total_bankruptcy(moves)` exceeds
+    `threshold`, or None if it doesn't even at `max_moves`.
+
+    `total_bankruptcy` takes signed moves, one per direction, and the
+    directions are bisected in lockstep so each step is a single evaluation.
+    Stops after `MAX_BISECTION_STEPS` even if `tolerance` isn't reached.
+    """
+    signs = np.sign(max_moves)
+    lo = np.zeros(len(max_moves))
+    hi = np.abs(max_moves)
+    reached = total_bankruptcy(max_moves) > threshold
+    for _ in range(MAX_BISECTION_STEPS):
+        if not np.any(reached & (hi - lo > tolerance)):
+            break
+        mid = (lo + hi) / 2
+        exceeded = total_bankruptcy(signs * mid) > threshold
+        hi = np.where(exceeded, mid, hi)
+        lo = np.where(exceeded, lo, mid)
+    return [float(s * h) if r else None for s, h, r in zip(signs, hi, reached)]
+
+
+def get_bankruptcy_frontier(
+    slot: int,
+    drift_client: DriftClient,
+    vat: Vat,
+    threshold: float,
+    tolerance: float = 0.001,
+    max_up_move: float = 4.0,
+):
+    """
+    For every spot and perp market, the smallest single-oracle move down and up
+    at which total bankruptcy exceeds `threshold` dollars.
+
+    Each bisection step re-evaluates only the users exposed to the shocked
+    oracle; everyone else keeps their baseline bankruptcy. Markets sharing an
+    oracle share the search.
+    """
+    arrays = build_price_shock_arrays(drift_client, vat.users)
+    oracle_index = {oracle_id: i for i, oracle_id in enumerate(arrays.oracle_ids)}
+
+    fallback_users = [arrays.users[i] for i in arrays.fallback_users]
+    fallback_baseline = dict(
+        zip(
+            arrays.fallback_users,
+            calculate_leverages_for_price_shock(fallback_users, None),
+        )
+    )
+    fallback_oracles = [
+        {oracle_index[oracle_id] for oracle_id in get_user_oracles(user)}
+        for user in fallback_users
+    ]
+
+    unshocked = np.ones((1, len(arrays.oracle_ids)))
+    baseline = evaluate_price_shock(arrays, unshocked)
+    evaluate_fallback_users(
+        drift_client, arrays, unshocked, baseline, list(fallback_baseline.values())
+    )
+    baseline_bankruptcy = np.maximum(-baseline["net_usd_value"][0], 0)
+    baseline_total = baseline_bankruptcy.sum()
+    print(
+        f"Searching bankruptcy frontier at ${threshold:,.0f} "
+        f"(baseline ${baseline_total:,.0f}) over {arrays.n_users} users"
+    )
+
+    def search_oracle(oracle: int) -> tuple[int, list]:
+        exposed = get_oracle_exposed_users(arrays, oracle, fallback_oracles)
+        if baseline_total > threshold:
+            return len(exposed), [0.0, 0.0]
+
+        subset = select_users(arrays, exposed)
+        subset_fallback_baseline = [
+            fallback_baseline[exposed[i]] for i in subset.fallback_users
+        ]
+        unexposed_total = baseline_total - baseline_bankruptcy[exposed].sum()
+
+        def total_bankruptcy(moves: np.ndarray) -> np.ndarray:
+            oracle_multipliers = np.ones((len(moves), len(arrays.oracle_ids)))
+            oracle_multipliers[:, oracle] = 1 + moves
+            metrics = evaluate_price_shock(subset, oracle_multipliers)
+            evaluate_fallback_users(
+                drift_client,
+                subset,
+                oracle_multipliers,
+                metrics,
+                subset_fallback_baseline,
+            )
+            return unexposed_total + np.maximum(-metrics["net_usd_value"], 0).sum(
+                axis=1
+            )
+
+        moves = bisect_bankruptcy_moves(
+            total_bankruptcy, threshold, np.array([-1.0, max_up_move]), tolerance
+        )
+        return len(exposed), moves
+
+    markets = [
+        ("spot", market.market_index, market.name, market.oracle, market.oracle_source)
+        for market in drift_client.get_spot_market_accounts()
+    ] + [
+        (
+            "perp",
+            market.market_index,
+            market.name,
+            market.amm.oracle,
+            market.amm.oracle_source,
+        )
+        for market in drift_client.get_perp_market_accounts()
+    ]
+
+    searched: dict[int, tuple[int, list]] = {}
+    rows = []
+    for market_type, market_index, name, oracle, oracle_source in markets:
+        oracle = oracle_index[get_oracle_id(oracle, oracle_source)]
+        if oracle not in searched:
+            searched[oracle] = search_oracle(oracle)
+        n_exposed, (down_move, up_move) = searched[oracle]
+        rows.append(
+            {
+                "Market Type": market_type,
+                "Market Index": market_index,
+                "Market": decode_name(name),
+                "Exposed Users": n_exposed,
+                "Down Move (%)": None if down_move is None else down_move * 100,
+                "Up Move (%)": None if up_move is None else up_move * 100,
+            }
+        )
+
+    return {
+        "slot": slot,
+        "threshold": threshold,
+        "baseline_bankruptcy": float(baseline_total),
+        "result": pd.DataFrame(rows).to_json(),
+    }
@@ -0,0 +1,130 @@
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from driftpy.constants import BASE_PRECISION
+
+from backend.utils.position_store import PositionStore, get_oracle_prices
+from backend.utils.user_metrics_table import UserMetricsTable
+
+DEFAULT_HEALTH_EDGES = "0,10,20,30,40,50,60,70,80,90,100"
+
+
+class HistogramWeight(Enum):
+    COUNT = "count"
+    COLLATERAL = "collateral"
+    PERP_NOTIONAL = "perp_notional"
+
+
+class HistogramGroupBy(Enum):
+    PERP_MARKET = "perp_market"
+    SPOT_MARKET = "spot_market"
+    HIGH_LEVERAGE = "high_leverage"
+
+
+def parse_health_edges(edges: str) -> np.ndarray:
+    """
+    Comma-separated, strictly increasing bucket edges, e.g. "0,1,2,5,10,100".
+    """
+    try:
+        parsed = np.array([float(edge) for edge in edges.split(",")])
+    except ValueError:
+        raise ValueError(f"Bucket edges must be numbers: {edges}")
+    if len(parsed) < 2 or (np.diff(parsed) <= 0).any():
+        raise ValueError("Bucket edges must be at least two increasing numbers")
+    return parsed
+
+
+def get_health_buckets(health: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """
+    Bucket `i` holds health in [edges[i], edges[i + 1]). Health below the
+    first edge lands in the first bucket and health from the last edge up in
+    the last one, so every user is counted.
+    """
+    buckets = np.searchsorted(edges, health, side="right") - 1
+    return np.clip(buckets, 0, len(edges) - 2)
+
+
+def get_bucket_labels(edges: np.ndarray) -> list[str]:
+    return [f"{low:g}-{high:g}%" for low, high in zip(edges[:-1], edges[1:])]
+
+
+def get_perp_notional(store: PositionStore) -> np.ndarray:
+    """
+    Dollar notional of every perp position, 0 for markets without an oracle.
+    """
+    perp = store.perp
+    notional = np.abs(perp.base_asset_amount / BASE_PRECISION) * get_oracle_prices(
+        store.perp_oracle_prices, perp.market_index
+    )
+    return np.nan_to_num(notional)
+
+
+def get_health_histogram(
+    table: UserMetricsTable,
+    store: PositionStore,
+    edges: np.ndarray,
+    weight: HistogramWeight = HistogramWeight.COUNT,
+    group_by: Optional[HistogramGroupBy] = None,
+) -> pd.DataFrame:
+    """
+    Users (or, grouped by market, positions) per health bucket, with their
+    summed `weight`, in one binning pass over the metrics table. Users whose
+    metrics couldn't be computed are left out.
+
+    Grouped by market, a user counts once in every market they hold a
+    position in, weighted by that position's notional for PERP_NOTIONAL and
+    by their own collateral or total notional otherwise.
+    """
+    n_users = len(table.user_keys)
+    perp_notional = get_perp_notional(store)
+    user_weights = {
+        HistogramWeight.COUNT: np.ones(n_users),
+        HistogramWeight.COLLATERAL: table.total_collateral_initial,
+        HistogramWeight.PERP_NOTIONAL: np.bincount(
+            store.perp.user_idx, weights=perp_notional, minlength=n_users
+        ),
+    }[weight]
+
+    if group_by == HistogramGroupBy.PERP_MARKET:
+        user_idx = store.perp.user_idx
+        groups = store.perp.market_index
+        if weight == HistogramWeight.PERP_NOTIONAL:
+            weights = perp_notional
+        else:
+            weights = user_weights[user_idx]
+    elif group_by == HistogramGroupBy.SPOT_MARKET:
+        user_idx = store.spot.user_idx
+        groups = store.spot.market_index
+        weights = user_weights[user_idx]
+    else:
+        user_idx = np.arange(n_users)
+        groups = table.is_high_leverage
+        weights = user_weights
+
+    is_valid = table.valid[user_idx]
+    buckets = get_health_buckets(table.health[user_idx[is_valid]], edges)
+    if group_by is None:
+        # A single group, so empty buckets still show up
+        group_values, group_ids = np.zeros(1, dtype=np.int64), np.zeros_like(buckets)
+    else:
+        group_values, group_ids = np.unique(groups[is_valid], return_inverse=True)
+    n_buckets = len(edges) - 1
+    cells = group_ids * n_buckets + buckets
+    size = len(group_values) * n_buckets
+    counts = np.bincount(cells, minlength=size).reshape(-1, n_buckets)
+    values = np.bincount(cells, weights=weights[is_valid], minlength=size).reshape(
+        -1, n_buckets
+    )
+
+    df = pd.DataFrame(
+        {
+            "Health Range": np.tile(get_bucket_labels(edges), len(group_values)),
+            "Counts": counts.ravel(),
+            "Values": values.ravel(),
+        }
+    )
+    if group_by is not None:
+        df.insert(0, "Group", np.repeat(group_values, n_buckets))
+    return df
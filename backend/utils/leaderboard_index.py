@@ -0,0 +1,214 @@
+from concurrent.futures import Future
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+from driftpy.constants import BASE_PRECISION, SPOT_BALANCE_PRECISION
+
+from backend.utils.position_store import PositionStore, get_oracle_prices
+from backend.utils.user_metrics_table import UserMetricsTable, get_user_metrics_table
+
+
+class LeaderboardSide(Enum):
+    LONG = "long"
+    SHORT = "short"
+    BORROW = "borrow"
+    DEPOSIT = "deposit"
+
+
+PERP_SIDES = (LeaderboardSide.LONG, LeaderboardSide.SHORT)
+SPOT_SIDES = (LeaderboardSide.BORROW, LeaderboardSide.DEPOSIT)
+
+
+@dataclass
+class Ranking:
+    """
+    Leaderboard rows, best first, next to the value they are ranked by.
+    """
+
+    rows: np.ndarray
+    values: np.ndarray
+
+
+@dataclass
+class Leaderboard:
+    """
+    The positions of one side (e.g. perp shorts) in one snapshot, ranked by
+    notional and by leverage, over all markets (key None) and per market.
+
+    Row `i` is position `positions[i]` of the store's perp or spot positions.
+    Leverage is the notional over the user's initial collateral, so only
+    users with positive collateral have one and appear in the `levered_*`
+    rankings. Positions in markets without an oracle are left out.
+    """
+
+    positions: np.ndarray
+    user_idx: np.ndarray
+    market_index: np.ndarray
+    amount: np.ndarray
+    notional: np.ndarray
+    leverage: np.ndarray
+    by_notional: dict[Optional[int], Ranking]
+    levered_by_notional: dict[Optional[int], Ranking]
+    by_leverage: dict[Optional[int], Ranking]
+
+
+@dataclass
+class LeaderboardIndex:
+    snapshot_id: str
+    user_keys: list[str]
+    boards: dict[LeaderboardSide, Leaderboard]
+
+
+def rank_by_market(
+    rows: np.ndarray, values: np.ndarray, market_index: np.ndarray
+) -> dict[Optional[int], Ranking]:
+    """
+    `rows` ranked by `values`, descending, over all markets and per market.
+    Ties keep position order.
+    """
+    order = np.argsort(-values[rows], kind="stable")
+    rankings = {None: Ranking(rows[order], values[rows[order]])}
+    ranked = rows[np.lexsort((-values[rows], market_index[rows]))]
+    markets, starts = np.unique(market_index[ranked], return_index=True)
+    ends = np.append(starts[1:], len(ranked))
+    for market, start, end in zip(markets.tolist(), starts, ends):
+        rankings[market] = Ranking(ranked[start:end], values[ranked[start:end]])
+    return rankings
+
+
+def build_leaderboard(
+    positions: np.ndarray,
+    user_idx: np.ndarray,
+    market_index: np.ndarray,
+    amount: np.ndarray,
+    notional: np.ndarray,
+    collateral: np.ndarray,
+) -> Leaderboard:
+    rows = np.arange(len(positions))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        leverage = np.where(collateral > 0, notional / collateral, np.nan)
+    levered_rows = rows[~np.isnan(leverage)]
+    return Leaderboard(
+        positions=positions,
+        user_idx=user_idx,
+        market_index=market_index,
+        amount=amount,
+        notional=notional,
+        leverage=leverage,
+        by_notional=rank_by_market(rows, notional, market_index),
+        levered_by_notional=rank_by_market(levered_rows, notional, market_index),
+        by_leverage=rank_by_market(levered_rows, leverage, market_index),
+    )
+
+
+def build_leaderboard_index(
+    store: PositionStore, table: UserMetricsTable
+) -> LeaderboardIndex:
+    """
+    All four leaderboards in one pass over the position store.
+    """
+    perp = store.perp
+    base_asset_amount = perp.base_asset_amount / BASE_PRECISION
+    perp_notional = np.abs(base_asset_amount) * get_oracle_prices(
+        store.perp_oracle_prices, perp.market_index
+    )
+    spot = store.spot
+    scaled_balance = spot.scaled_balance / SPOT_BALANCE_PRECISION
+    spot_notional = scaled_balance * get_oracle_prices(
+        store.spot_oracle_prices, spot.market_index
+    )
+    has_perp_notional = ~np.isnan(perp_notional)
+    has_spot_notional = (spot.scaled_balance > 0) & ~np.isnan(spot_notional)
+    sides = {
+        LeaderboardSide.LONG: has_perp_notional & (perp.base_asset_amount > 0),
+        LeaderboardSide.SHORT: has_perp_notional & (perp.base_asset_amount < 0),
+        LeaderboardSide.BORROW: has_spot_notional & spot.is_borrow,
+        LeaderboardSide.DEPOSIT: has_spot_notional & ~spot.is_borrow,
+    }
+
+    boards = {}
+    for side, mask in sides.items():
+        if side in PERP_SIDES:
+            kind, amount, notional = perp, base_asset_amount, perp_notional
+        else:
+            kind, amount, notional = spot, scaled_balance, spot_notional
+        positions = np.flatnonzero(mask)
+        user_idx = kind.user_idx[positions]
+        boards[side] = build_leaderboard(
+            positions,
+            user_idx,
+            kind.market_index[positions],
+            amount[positions],
+            notional[positions],
+            table.total_collateral_initial[user_idx],
+        )
+    return LeaderboardIndex(
+        snapshot_id=table.snapshot_id, user_keys=store.user_keys, boards=boards
+    )
+
+
+def get_top_positions(
+    board: Leaderboard,
+    k: int,
+    min_notional: Optional[float] = None,
+    market_index: Optional[int] = None,
+    by_leverage: bool = False,
+    levered_only: bool = False,
+) -> np.ndarray:
+    """
+    Rows of the `k` largest positions with a notional above `min_notional`,
+    optionally in one market. Ranked by notional this is a slice of a sorted
+    ranking; ranked by leverage the notional floor filters the ranking first.
+    """
+    if by_leverage:
+        ranking = board.by_leverage.get(market_index)
+    elif levered_only:
+        ranking = board.levered_by_notional.get(market_index)
+    else:
+        ranking = board.by_notional.get(market_index)
+    if ranking is None:
+        return np.array([], dtype=np.int64)
+    if min_notional is None:
+        return ranking.rows[:k]
+    if by_leverage:
+        rows = ranking.rows
+        return rows[board.notional[rows] > min_notional][:k]
+    above = np.searchsorted(-ranking.values, -min_notional, side="left")
+    return ranking.rows[: min(k, above)]
+
+
+_loaded_indexes: dict[str, LeaderboardIndex] = {}
+
+
+def load_leaderboard_index(
+    store: PositionStore, table: UserMetricsTable
+) -> LeaderboardIndex:
+    """
+    The index of the table's snapshot, built on first use.
+    """
+    global _loaded_indexes
+    index = _loaded_indexes.get(table.snapshot_id)
+    if index is None:
+        index = build_leaderboard_index(store, table)
+        # Indexes of older snapshots are never asked for again
+        _loaded_indexes = {table.snapshot_id: index}
+    return index
+
+
+def start_leaderboard_index(store: PositionStore, table_future: Future):
+    """
+    Builds the index as soon as the snapshot's metrics table is done, on the
+    thread that built it. Skipped if another snapshot's table has been
+    started since.
+    """
+
+    def build(future: Future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        table = future.result()
+        if get_user_metrics_table(wait=False) is table:
+            load_leaderboard_index(store, table)
+
+    table_future.add_done_callback(build)
@@ -0,0 +1,204 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from driftpy.constants.numeric_constants import (
+    BASE_PRECISION,
+    MARGIN_PRECISION,
+    QUOTE_PRECISION,
+    SPOT_WEIGHT_PRECISION,
+)
+from driftpy.drift_client import DriftClient
+from driftpy.drift_user import DriftUser
+from driftpy.math.margin import MarginCategory
+
+from backend.utils.margin_calculator import (
+    MarginArrays,
+    build_margin_arrays,
+    calculate_free_collateral,
+    calculate_size_discount_asset_weight,
+    calculate_size_premium_liability_weight,
+    get_market_params,
+    get_size_in_amm_precision,
+)
+from backend.utils.position_store import PositionStore
+
+
+def calculate_perp_free_collateral_delta(arrays: MarginArrays) -> np.ndarray:
+    """
+    Vectorized `calculate_free_collateral_delta_for_perp` of every perp
+    position at maintenance, without open orders: how much free collateral
+    moves per unit of price. Zero where driftpy returns none.
+    """
+    base_asset_amount = arrays.perp_base_asset_amount
+    margin_ratio = calculate_size_premium_liability_weight(
+        np.abs(base_asset_amount),
+        arrays.perp_imf_factor,
+        arrays.perp_margin_ratio_maintenance,
+        MARGIN_PRECISION,
+    )
+    margin_ratio = np.where(arrays.perp_is_settled, 0, margin_ratio)
+    margin_ratio_quote_precision = (margin_ratio * QUOTE_PRECISION) // MARGIN_PRECISION
+    free_collateral_delta = np.where(
+        base_asset_amount > 0,
+        (QUOTE_PRECISION - margin_ratio_quote_precision)
+        * base_asset_amount
+        // BASE_PRECISION,
+        (-QUOTE_PRECISION - margin_ratio_quote_precision)
+        * np.abs(base_asset_amount)
+        // BASE_PRECISION,
+    )
+    # Without open orders, prediction market pnl and margin net out
+    return np.where(arrays.perp_is_prediction, 0, free_collateral_delta)
+
+
+def calculate_spot_free_collateral_delta(arrays: MarginArrays) -> np.ndarray:
+    """
+    Vectorized `calculate_free_collateral_delta_for_spot` of every spot
+    position.
+    """
+    token_amount = arrays.spot_token_amount
+    size = get_size_in_amm_precision(np.abs(token_amount), arrays.spot_precision)
+    asset_weight = calculate_size_discount_asset_weight(
+        size, arrays.spot_imf_factor, arrays.spot_maintenance_asset_weight
+    )
+    liability_weight = calculate_size_premium_liability_weight(
+        size,
+        arrays.spot_imf_factor,
+        arrays.spot_maintenance_liability_weight,
+        SPOT_WEIGHT_PRECISION,
+    )
+    return np.where(
+        token_amount > 0,
+        ((QUOTE_PRECISION * asset_weight) // SPOT_WEIGHT_PRECISION)
+        * token_amount
+        // arrays.spot_precision,
+        ((-QUOTE_PRECISION * liability_weight) // SPOT_WEIGHT_PRECISION)
+        * np.abs(token_amount)
+        // arrays.spot_precision,
+    )
+
+
+def get_sister_spot_positions(
+    drift_client: DriftClient, store: PositionStore
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    For every perp position, the owner's spot position in the first spot
+    market sharing the perp market's oracle, as (oracle price of the perp
+    market, spot position or -1).
+    """
+    sister_markets = {}
+    for spot_market in drift_client.get_spot_market_accounts():
+        sister_markets.setdefault(spot_market.oracle, spot_market.market_index)
+
+    def get_perp_params(market_index: int) -> dict:
+        market = drift_client.get_perp_market_account(market_index)
+        return {
+            "oracle_price": drift_client.get_oracle_price_data_for_perp_market(
+                market_index
+            ).price,
+            "sister_market": sister_markets.get(market.amm.oracle, -1),
+        }
+
+    perp, spot = store.perp, store.spot
+    perp_params, _ = get_market_params(perp.market_index, get_perp_params)
+    sister_market = perp_params["sister_market"].astype(np.int64)
+
+    # Spot positions keyed by (user, market), sorted for lookups
+    n_markets = max(int(spot.market_index.max(initial=0)), sister_market.max(initial=0))
+    n_markets += 1
+    spot_keys = spot.user_idx * n_markets + spot.market_index
+    order = np.argsort(spot_keys, kind="stable")
+    perp_keys = perp.user_idx * n_markets + sister_market
+    found = np.minimum(np.searchsorted(spot_keys[order], perp_keys), len(order) - 1)
+    sister_positions = np.full(len(perp), -1, dtype=np.int64)
+    if len(order):
+        is_match = (sister_market >= 0) & (spot_keys[order][found] == perp_keys)
+        sister_positions[is_match] = order[found[is_match]]
+    return perp_params["oracle_price"], sister_positions
+
+
+def calculate_perp_liq_prices(
+    drift_client: DriftClient, arrays: MarginArrays, store: PositionStore
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized `DriftUser.get_perp_liq_price` of every perp position in the
+    store, in PRICE_PRECISION and -1 where there is none, and a mask of the
+    positions it is exact for.
+
+    driftpy's liquidation price is linear in the oracle price: the user's
+    free collateral, cross-margined over all markets, divided by how fast
+    the position (and a spot position on the same oracle) eats it. That
+    closed form holds for every account the margin calculator can price;
+    positions of `arrays.fallback_users` have to come from driftpy.
+    """
+    perp = store.perp
+    free_collateral = calculate_free_collateral(arrays, MarginCategory.MAINTENANCE)
+    oracle_price, sister_positions = get_sister_spot_positions(drift_client, store)
+
+    perp_delta = calculate_perp_free_collateral_delta(arrays)
+    spot_delta = np.append(calculate_spot_free_collateral_delta(arrays), 0)
+    free_collateral_delta = perp_delta + spot_delta[sister_positions]
+
+    has_liq_price = (perp_delta != 0) & (free_collateral_delta != 0)
+    liq_price_delta = (free_collateral[perp.user_idx] * QUOTE_PRECISION) // np.where(
+        has_liq_price, free_collateral_delta, 1
+    )
+    liq_prices = oracle_price - liq_price_delta
+    liq_prices = np.where(has_liq_price & (liq_prices >= 0), liq_prices, -1)
+
+    is_exact = ~np.isin(perp.user_idx, arrays.fallback_users)
+    return liq_prices, is_exact
+
+
+def solve_perp_liq_prices(
+    drift_client: DriftClient, users: list[DriftUser], store: PositionStore
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    `calculate_perp_liq_prices` straight from the position store.
+    """
+    arrays = build_margin_arrays(drift_client, users, store)
+    return calculate_perp_liq_prices(drift_client, arrays, store)
+
+
+def compare_perp_liq_prices(
+    users: list[DriftUser],
+    store: PositionStore,
+    liq_prices: np.ndarray,
+    is_exact: np.ndarray,
+    positions: Optional[np.ndarray] = None,
+) -> pd.DataFrame:
+    """
+    Parity harness: the solver's liquidation price of every open perp
+    position (or `positions`) next to `DriftUser.get_perp_liq_price`, with
+    their absolute deviation in PRICE_PRECISION units.
+    """
+    perp = store.perp
+    if positions is None:
+        positions = np.flatnonzero(perp.base_asset_amount != 0)
+
+    rows = []
+    for position in positions.tolist():
+        user_idx = int(perp.user_idx[position])
+        market_index = int(perp.market_index[position])
+        user = users[user_idx]
+        try:
+            expected = user.get_perp_liq_price(market_index)
+        except Exception as e:
+            print(f"==> Error from liq price parity [{user.user_public_key}] ", e)
+            expected = np.nan
+        rows.append(
+            {
+                "user_key": store.user_keys[user_idx],
+                "market_index": market_index,
+                "solved": float(liq_prices[position]),
+                "driftpy": np.nan if expected is None else float(expected),
+                "is_exact": bool(is_exact[position]),
+            }
+        )
+
+    df = pd.DataFrame(
+        rows, columns=["user_key", "market_index", "solved", "driftpy", "is_exact"]
+    )
+    df["deviation"] = (df["solved"] - df["driftpy"]).abs()
+    return df
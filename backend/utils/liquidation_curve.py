@@ -0,0 +1,115 @@
+from enum import Enum
+
+import numpy as np
+
+from backend.utils.liquidation_index import LiquidationPriceIndex
+
+LIQUIDATION_CURVE_BINS = 200
+LIQUIDATION_CURVE_PAGE_SIZE = 100
+
+
+class LiquidationSide(Enum):
+    LONG = "long"
+    SHORT = "short"
+
+
+# Liquidation price windows, as multiples of the oracle price
+DEFAULT_PRICE_WINDOWS = {
+    LiquidationSide.LONG: (0.2, 2.0),
+    LiquidationSide.SHORT: (0.5, 5.0),
+}
+
+
+def get_curve_window(
+    side: LiquidationSide,
+    market_price: float,
+    min_multiplier: float,
+    max_multiplier: float,
+) -> tuple[float, float]:
+    """
+    The price range of one side's curve. Longs only liquidate below the
+    oracle price and shorts above it, so the window is cut there.
+    """
+    lower = min_multiplier * market_price
+    upper = max_multiplier * market_price
+    if side == LiquidationSide.LONG:
+        return lower, min(upper, market_price)
+    return max(lower, market_price), upper
+
+
+def get_curve_entries(
+    index: LiquidationPriceIndex,
+    market_index: int,
+    market_price: float,
+    side: LiquidationSide,
+    lower: float,
+    upper: float,
+) -> np.ndarray:
+    """
+    Index entries on one side's curve within [lower, upper], in the order
+    they liquidate: longs from the highest liquidation price down, shorts from
+    the lowest up. Only positions with a notional worth a dollar count.
+    """
+    entries = index.get_market_slice(market_index)
+    liq_prices = index.liq_prices[entries]
+    start = np.searchsorted(liq_prices, lower, side="left")
+    end = np.searchsorted(liq_prices, upper, side="right")
+    # Longs strictly below the oracle price, shorts strictly above
+    if side == LiquidationSide.LONG:
+        end = min(end, np.searchsorted(liq_prices, market_price, side="left"))
+        is_side = index.base_asset_amounts[entries][start:end] > 0
+    else:
+        start = max(start, np.searchsorted(liq_prices, market_price, side="right"))
+        is_side = index.base_asset_amounts[entries][start:end] < 0
+    rows = entries.start + np.arange(start, end)
+    rows = rows[is_side & (np.round(index.notionals[rows]) != 0)]
+    if side == LiquidationSide.LONG:
+        rows = rows[np.argsort(-index.liq_prices[rows], kind="stable")]
+    return rows
+
+
+def get_curve_bins(
+    liq_prices: np.ndarray, lower: float, upper: float, n_bins: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    `n_bins` equal-width bins over [lower, upper], as (edges, bin of every
+    price).
+    """
+    edges = np.linspace(lower, upper, n_bins + 1)
+    bins = np.searchsorted(edges, liq_prices, side="right") - 1
+    return edges, np.clip(bins, 0, n_bins - 1)
+
+
+def bin_liquidation_curve(
+    index: LiquidationPriceIndex,
+    rows: np.ndarray,
+    side: LiquidationSide,
+    lower: float,
+    upper: float,
+    n_bins: int,
+) -> dict:
+    """
+    The cumulative curve of `rows` (from `get_curve_entries`) in `n_bins`
+    price bins, ascending by price. Each point is the notional and number of
+    positions liquidated once the price crosses that bin: its lower edge for
+    longs, its upper edge for shorts.
+    """
+    edges, bins = get_curve_bins(index.liq_prices[rows], lower, upper, n_bins)
+    notional = np.bincount(bins, weights=index.notionals[rows], minlength=n_bins)
+    accounts = np.bincount(bins, minlength=n_bins)
+    if side == LiquidationSide.LONG:
+        prices = edges[:-1]
+        cumulative_notional = np.cumsum(notional[::-1])[::-1]
+        cumulative_accounts = np.cumsum(accounts[::-1])[::-1]
+    else:
+        prices = edges[1:]
+        cumulative_notional = np.cumsum(notional)
+        cumulative_accounts = np.cumsum(accounts)
+    return {
+        "prices": prices.tolist(),
+        "notional": notional.tolist(),
+        "accounts": accounts.tolist(),
+        "cumulative_notional": cumulative_notional.tolist(),
+        "cumulative_accounts": cumulative_accounts.tolist(),
+        "total_accounts": len(rows),
+    }
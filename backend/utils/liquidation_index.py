@@ -0,0 +1,229 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from driftpy.constants import BASE_PRECISION, PRICE_PRECISION
+from driftpy.drift_user import DriftUser
+from driftpy.pickle.vat import Vat
+
+from backend.utils.liq_price_solver import solve_perp_liq_prices
+from backend.utils.position_store import PositionStore, build_position_store
+from backend.utils.user_metrics_table import MARGIN_ENGINE
+from backend.utils.waiting_for import waiting_for
+
+# Set in the parent right before the pool forks, like the parallel price shock
+_shared_users: list[DriftUser] = []
+# Builds take turns publishing the users their workers read
+_shared_lock = threading.Lock()
+
+
+@dataclass
+class LiquidationPriceIndex:
+    """
+    Every user's perp liquidation prices in one snapshot, grouped by market
+    and sorted by price within each market.
+
+    Market `market_indexes[i]` owns entries `offsets[i]:offsets[i + 1]`, and
+    `user_idx` points into `user_keys`. Positions without a liquidation price
+    are left out. The sign of `base_asset_amounts` is the side, and
+    `notionals` are at the snapshot's oracle price.
+    """
+
+    user_keys: list[str]
+    market_indexes: np.ndarray
+    offsets: np.ndarray
+    oracle_prices: np.ndarray
+    user_idx: np.ndarray
+    liq_prices: np.ndarray
+    base_asset_amounts: np.ndarray
+    notionals: np.ndarray
+
+    def get_market_slice(self, market_index: int) -> slice:
+        """
+        The entries of `market_index`, empty if none of its positions has a
+        liquidation price.
+        """
+        i = np.searchsorted(self.market_indexes, market_index)
+        if i == len(self.market_indexes) or self.market_indexes[i] != market_index:
+            return slice(0, 0)
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+
+# With more than one worker, the pool is forked from a threaded server, so a
+# child can inherit a lock some other thread held at that moment and deadlock
+# on it. A pool that doesn't finish within LIQUIDATION_INDEX_POOL_TIMEOUT
+# seconds is terminated and the index is built serially instead.
+def get_liquidation_index_workers() -> int:
+    return int(os.getenv("LIQUIDATION_INDEX_WORKERS", 1))
+
+
+def get_liquidation_index_pool_timeout() -> float:
+    return float(os.getenv("LIQUIDATION_INDEX_POOL_TIMEOUT", 300))
+
+
+def _get_liq_prices(task: tuple[int, list[int]]) -> list[Optional[int]]:
+    """
+    Liquidation prices of the given users in one market, None where driftpy
+    fails. Runs in a forked worker unless the index is built serially.
+    """
+    market_index, user_idx = task
+    liq_prices = []
+    for i in user_idx:
+        user = _shared_users[i]
+        try:
+            liq_prices.append(user.get_perp_liq_price(market_index))
+        except Exception as e:
+            print(f"==> Error from liquidation index [{user.user_public_key}] ", e)
+            liq_prices.append(None)
+    return liq_prices
+
+
+def build_liquidation_price_index(
+    vat: Vat,
+    store: Optional[PositionStore] = None,
+    n_workers: Optional[int] = None,
+) -> LiquidationPriceIndex:
+    """
+    With the vectorized margin engine, solves every open perp position's
+    liquidation price at once and only calls `get_perp_liq_price` for the
+    positions the solver can't price. Those calls run as one task per market,
+    spread over `n_workers` forked workers.
+    """
+    global _shared_users
+
+    if store is None:
+        store = build_position_store(vat)
+    users = list(vat.users.values())
+    perp = store.perp
+    is_open = perp.base_asset_amount != 0
+    all_liq_prices = np.full(len(perp), np.nan)
+    needs_driftpy = is_open.copy()
+    if MARGIN_ENGINE == "vectorized":
+        try:
+            solved, is_exact = solve_perp_liq_prices(vat.drift_client, users, store)
+            all_liq_prices[is_exact] = solved[is_exact].astype(float)
+            needs_driftpy &= ~is_exact
+        except Exception as e:
+            print("==> Error from liquidation price solver ", e)
+
+    market_positions = [
+        np.flatnonzero(needs_driftpy & (perp.market_index == market_index))
+        for market_index in np.unique(perp.market_index[needs_driftpy]).tolist()
+    ]
+    tasks = [
+        (int(perp.market_index[positions[0]]), perp.user_idx[positions].tolist())
+        for positions in market_positions
+    ]
+
+    n_workers = min(n_workers or get_liquidation_index_workers(), len(tasks))
+    with _shared_lock:
+        _shared_users = users
+        try:
+            results = None
+            if n_workers > 1:
+                try:
+                    with multiprocessing.get_context("fork").Pool(n_workers) as pool:
+                        results = pool.map_async(
+                            _get_liq_prices, tasks, chunksize=1
+                        ).get(get_liquidation_index_pool_timeout())
+                except multiprocessing.TimeoutError:
+                    print("==> Liquidation index pool timed out, building serially")
+            if results is None:
+                results = [_get_liq_prices(task) for task in tasks]
+        finally:
+            _shared_users = []
+    for positions, task_liq_prices in zip(market_positions, results):
+        all_liq_prices[positions] = [
+            np.nan if liq_price is None else liq_price for liq_price in task_liq_prices
+        ]
+
+    positions = np.flatnonzero(is_open & (all_liq_prices >= 0))
+    liq_prices = all_liq_prices[positions] / PRICE_PRECISION
+
+    # Users with the same liquidation price keep the user map's order
+    market_indexes = perp.market_index[positions]
+    order = np.lexsort((positions, liq_prices, market_indexes))
+    positions, liq_prices = positions[order], liq_prices[order]
+    markets, offsets = np.unique(market_indexes[order], return_index=True)
+    oracle_prices = (
+        np.array(
+            [vat.perp_oracles[market_index].price for market_index in markets],
+            dtype=float,
+        )
+        / PRICE_PRECISION
+    )
+    base_asset_amounts = perp.base_asset_amount[positions] / BASE_PRECISION
+    position_oracle_prices = oracle_prices[
+        np.searchsorted(markets, perp.market_index[positions])
+    ]
+
+    return LiquidationPriceIndex(
+        user_keys=store.user_keys,
+        market_indexes=markets,
+        offsets=np.append(offsets, len(positions)),
+        oracle_prices=oracle_prices,
+        user_idx=perp.user_idx[positions],
+        liq_prices=liq_prices,
+        base_asset_amounts=base_asset_amounts,
+        notionals=np.abs(base_asset_amounts) * position_oracle_prices,
+    )
+
+
+def get_users_with_liq_price_within(
+    index: LiquidationPriceIndex, max_distance: float
+) -> np.ndarray:
+    """
+    Sorted indexes of the users with a liquidation price within
+    `max_distance` (a fraction) of the oracle in any of their perp markets.
+    """
+    lower = index.oracle_prices * (1 - max_distance)
+    upper = index.oracle_prices * (1 + max_distance)
+    ranges = []
+    for i in range(len(index.market_indexes)):
+        start, end = index.offsets[i], index.offsets[i + 1]
+        liq_prices = index.liq_prices[start:end]
+        lo = start + np.searchsorted(liq_prices, lower[i], side="left")
+        hi = start + np.searchsorted(liq_prices, upper[i], side="right")
+        ranges.append(index.user_idx[lo:hi])
+    if not ranges:
+        return np.array([], dtype=np.int64)
+    return np.unique(np.concatenate(ranges))
+
+
+# One index at a time, built off the event loop right after a snapshot loads
+_index_executor = ThreadPoolExecutor(max_workers=1)
+_loaded_indexes: dict[str, Future] = {}
+
+
+def _build_liquidation_price_index(
+    pickle_path: str, vat: Vat, store: Optional[PositionStore]
+) -> LiquidationPriceIndex:
+    with waiting_for(f"liquidation price index of {pickle_path}"):
+        return build_liquidation_price_index(vat, store)
+
+
+def start_liquidation_price_index(
+    pickle_path: str, vat: Vat, store: Optional[PositionStore] = None
+) -> Future:
+    global _loaded_indexes
+    future = _index_executor.submit(
+        _build_liquidation_price_index, pickle_path, vat, store
+    )
+    # Indexes of older snapshots are never asked for again
+    _loaded_indexes = {pickle_path: future}
+    return future
+
+
+def load_liquidation_price_index(pickle_path: str, vat: Vat) -> LiquidationPriceIndex:
+    """
+    The index of the loaded snapshot, waiting for it if it's still being
+    built. Built on first use if it was never started.
+    """
+    future = _loaded_indexes.get(pickle_path)
+    if future is None:
+        future = start_liquidation_price_index(pickle_path, vat)
+    return future.result()
@@ -0,0 +1,715 @@
+import math
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+from driftpy.constants.numeric_constants import (
+    AMM_RESERVE_PRECISION,
+    BASE_PRECISION,
+    FUNDING_RATE_BUFFER,
+    MARGIN_PRECISION,
+    MAX_PREDICTION_PRICE,
+    OPEN_ORDER_MARGIN_REQUIREMENT,
+    PRICE_PRECISION,
+    QUOTE_SPOT_MARKET_INDEX,
+    SPOT_IMF_PRECISION,
+    SPOT_WEIGHT_PRECISION,
+)
+from driftpy.drift_client import DriftClient
+from driftpy.drift_user import DriftUser
+from driftpy.math.margin import (
+    MarginCategory,
+    calculate_net_user_pnl_imbalance,
+    calculate_scaled_initial_asset_weight,
+)
+from driftpy.types import is_variant
+
+from backend.utils.position_store import PositionStore
+from backend.utils.user_metrics import get_init_health
+from backend.utils.vectorized_price_shock import calculate_health
+
+# Every metric of `calculate_margin_metrics`, in driftpy's integer units
+MARGIN_METRICS = [
+    "total_collateral_initial",
+    "total_collateral_maintenance",
+    "margin_requirement_initial",
+    "margin_requirement_maintenance",
+    "health",
+    "init_health",
+    "leverage",
+    "upnl",
+    "spot_asset",
+    "spot_liability",
+    "perp_liability",
+]
+
+# Elementwise Python builtins, for object arrays
+ceil = np.frompyfunc(math.ceil, 1, 1)
+trunc = np.frompyfunc(int, 1, 1)
+
+
+@dataclass
+class MarginArrays:
+    """
+    Every spot and perp position of a snapshot next to the market parameters
+    its margin depends on, in driftpy's integer units.
+
+    Amounts, prices and weights are object arrays of Python ints (and of the
+    floats driftpy itself produces, e.g. funding pnl), so every operation
+    rounds exactly like driftpy's scalar math instead of overflowing int64 or
+    losing precision in float64.
+
+    Users whose margin needs an order fill simulation (spot open orders) or
+    an lp settle (perp lp shares) are listed in `fallback_users`, and so are
+    users with positions in markets the drift client doesn't know. Their
+    metrics have to come from `DriftUser`.
+    """
+
+    users: list[DriftUser]
+    being_liquidated: np.ndarray
+    max_margin_ratio: np.ndarray
+    fallback_users: np.ndarray
+    quote_price: int
+
+    spot_user: np.ndarray
+    spot_is_quote: np.ndarray
+    spot_token_amount: np.ndarray
+    spot_precision: np.ndarray
+    spot_price: np.ndarray
+    spot_imf_factor: np.ndarray
+    spot_initial_asset_weight: np.ndarray
+    spot_maintenance_asset_weight: np.ndarray
+    spot_initial_liability_weight: np.ndarray
+    spot_maintenance_liability_weight: np.ndarray
+    spot_open_orders_margin: np.ndarray
+
+    perp_user: np.ndarray
+    perp_base_asset_amount: np.ndarray
+    perp_open_bids: np.ndarray
+    perp_open_asks: np.ndarray
+    perp_quote_asset_amount: np.ndarray
+    perp_funding_pnl: np.ndarray
+    perp_price: np.ndarray
+    perp_is_settled: np.ndarray
+    perp_is_prediction: np.ndarray
+    perp_margin_ratio_initial: np.ndarray
+    perp_margin_ratio_maintenance: np.ndarray
+    perp_imf_factor: np.ndarray
+    perp_unrealized_initial_weight: np.ndarray
+    perp_unrealized_maintenance_weight: np.ndarray
+    perp_unrealized_imf_factor: np.ndarray
+    perp_open_orders_margin: np.ndarray
+
+    @property
+    def n_users(self) -> int:
+        return len(self.users)
+
+
+def get_market_params(
+    market_indexes: np.ndarray, get_params: Callable[[int], dict]
+) -> tuple[dict[str, np.ndarray], np.ndarray]:
+    """
+    `get_params` of every market in `market_indexes`, as arrays aligned with
+    it, and a mask of the entries whose market couldn't be resolved.
+    """
+    params = {}
+    unknown = set()
+    for market_index in np.unique(market_indexes).tolist():
+        try:
+            params[market_index] = get_params(market_index)
+        except Exception as e:
+            print(f"==> Error from margin calculator [market {market_index}] ", e)
+            unknown.add(market_index)
+
+    is_unknown = np.isin(market_indexes, list(unknown))
+    keys = next(iter(params.values())).keys() if params else []
+    # Without any resolved market every column is empty, whatever its name
+    columns = defaultdict(lambda: np.zeros(len(market_indexes), dtype=object))
+    columns |= {
+        key: np.array(
+            [
+                params[market_index][key] if market_index in params else 0
+                for market_index in market_indexes.tolist()
+            ],
+            dtype=object,
+        )
+        for key in keys
+    }
+    return columns, is_unknown
+
+
+def build_margin_arrays(
+    drift_client: DriftClient, users: list[DriftUser], store: PositionStore
+) -> MarginArrays:
+    """
+    Market parameters are resolved once per market, everything else comes
+    straight from the position store.
+    """
+    quote_market = drift_client.get_spot_market_account(QUOTE_SPOT_MARKET_INDEX)
+    quote_price = drift_client.get_oracle_price_data_for_spot_market(
+        QUOTE_SPOT_MARKET_INDEX
+    ).price
+
+    def get_spot_params(market_index: int) -> dict:
+        market = drift_client.get_spot_market_account(market_index)
+        price = drift_client.get_oracle_price_data_for_spot_market(market_index).price
+        return {
+            "decimals": market.decimals,
+            "cumulative_deposit_interest": market.cumulative_deposit_interest,
+            "cumulative_borrow_interest": market.cumulative_borrow_interest,
+            "price": price,
+            "imf_factor": market.imf_factor,
+            "initial_asset_weight": calculate_scaled_initial_asset_weight(
+                market, price
+            ),
+            "maintenance_asset_weight": market.maintenance_asset_weight,
+            "initial_liability_weight": market.initial_liability_weight,
+            "maintenance_liability_weight": market.maintenance_liability_weight,
+        }
+
+    def get_perp_params(market_index: int) -> dict:
+        market = drift_client.get_perp_market_account(market_index)
+        oracle_price_data = drift_client.get_oracle_price_data_for_perp_market(
+            market_index
+        )
+        is_settled = is_variant(market.status, "Settlement")
+        unrealized_initial_weight = market.unrealized_pnl_initial_asset_weight
+        if market.unrealized_pnl_max_imbalance > 0:
+            net_unsettled_pnl = calculate_net_user_pnl_imbalance(
+                market, quote_market, oracle_price_data
+            )
+            if net_unsettled_pnl > market.unrealized_pnl_max_imbalance:
+                unrealized_initial_weight = (
+                    unrealized_initial_weight
+                    * market.unrealized_pnl_max_imbalance
+                    / net_unsettled_pnl
+                )
+        return {
+            "price": market.expiry_price if is_settled else oracle_price_data.price,
+            "is_settled": is_settled,
+            "is_prediction": is_variant(market.contract_type, "Prediction"),
+            "margin_ratio_initial": market.margin_ratio_initial,
+            "margin_ratio_maintenance": market.margin_ratio_maintenance,
+            "imf_factor": market.imf_factor,
+            "cumulative_funding_rate_long": market.amm.cumulative_funding_rate_long,
+            "cumulative_funding_rate_short": market.amm.cumulative_funding_rate_short,
+            "unrealized_initial_weight": unrealized_initial_weight,
+            "unrealized_maintenance_weight": (
+                market.unrealized_pnl_maintenance_asset_weight
+            ),
+            "unrealized_imf_factor": market.unrealized_pnl_imf_factor,
+        }
+
+    spot = store.spot
+    spot_params, spot_unknown = get_market_params(spot.market_index, get_spot_params)
+    perp = store.perp
+    perp_params, perp_unknown = get_market_params(perp.market_index, get_perp_params)
+
+    # Token amounts: deposits truncate and borrows round up, like get_token_amount
+    scaled_balance = spot.scaled_balance.astype(object)
+    precision_decrease = 10 ** (19 - spot_params["decimals"])
+    borrow_amount = -(
+        -(scaled_balance * spot_params["cumulative_borrow_interest"])
+        // precision_decrease
+    )
+    deposit_amount = trunc(
+        scaled_balance * spot_params["cumulative_deposit_interest"] / precision_decrease
+    )
+    spot_token_amount = np.where(spot.is_borrow, -borrow_amount, deposit_amount)
+    spot_is_quote = spot.market_index == QUOTE_SPOT_MARKET_INDEX
+
+    base_asset_amount = perp.base_asset_amount.astype(object)
+    cumulative_funding_rate = np.where(
+        perp.base_asset_amount > 0,
+        perp_params["cumulative_funding_rate_long"],
+        perp_params["cumulative_funding_rate_short"],
+    )
+    funding_pnl = np.where(
+        perp.base_asset_amount == 0,
+        0,
+        (cumulative_funding_rate - perp.last_cumulative_funding_rate.astype(object))
+        * base_asset_amount
+        / AMM_RESERVE_PRECISION
+        / FUNDING_RATE_BUFFER
+        * -1,
+    )
+
+    fallback = np.zeros(len(users), dtype=bool)
+    fallback[spot.user_idx[(spot.open_bids != 0) | (spot.open_asks != 0)]] = True
+    fallback[spot.user_idx[spot_unknown]] = True
+    fallback[perp.user_idx[(perp.lp_shares != 0) | perp_unknown]] = True
+
+    user_accounts = [user.get_user_account() for user in users]
+    return MarginArrays(
+        users=users,
+        being_liquidated=np.array(
+            [user.is_being_liquidated() for user in users], dtype=bool
+        ),
+        max_margin_ratio=np.array(
+            [user_account.max_margin_ratio for user_account in user_accounts],
+            dtype=object,
+        ),
+        fallback_users=np.flatnonzero(fallback),
+        quote_price=quote_price,
+        spot_user=spot.user_idx,
+        spot_is_quote=spot_is_quote,
+        spot_token_amount=spot_token_amount,
+        spot_precision=10 ** spot_params["decimals"],
+        spot_price=spot_params["price"],
+        spot_imf_factor=spot_params["imf_factor"],
+        spot_initial_asset_weight=spot_params["initial_asset_weight"],
+        spot_maintenance_asset_weight=spot_params["maintenance_asset_weight"],
+        spot_initial_liability_weight=spot_params["initial_liability_weight"],
+        spot_maintenance_liability_weight=spot_params["maintenance_liability_weight"],
+        spot_open_orders_margin=np.where(
+            spot_is_quote,
+            0,
+            spot.open_orders.astype(object) * OPEN_ORDER_MARGIN_REQUIREMENT,
+        ),
+        perp_user=perp.user_idx,
+        perp_base_asset_amount=base_asset_amount,
+        perp_open_bids=perp.open_bids.astype(object),
+        perp_open_asks=perp.open_asks.astype(object),
+        perp_quote_asset_amount=perp.quote_asset_amount.astype(object),
+        perp_funding_pnl=funding_pnl,
+        perp_price=perp_params["price"],
+        perp_is_settled=perp_params["is_settled"].astype(bool),
+        perp_is_prediction=perp_params["is_prediction"].astype(bool),
+        perp_margin_ratio_initial=perp_params["margin_ratio_initial"],
+        perp_margin_ratio_maintenance=perp_params["margin_ratio_maintenance"],
+        perp_imf_factor=perp_params["imf_factor"],
+        perp_unrealized_initial_weight=perp_params["unrealized_initial_weight"],
+        perp_unrealized_maintenance_weight=perp_params["unrealized_maintenance_weight"],
+        perp_unrealized_imf_factor=perp_params["unrealized_imf_factor"],
+        perp_open_orders_margin=perp.open_orders.astype(object)
+        * OPEN_ORDER_MARGIN_REQUIREMENT,
+    )
+
+
+def sum_by_user(values: np.ndarray, user_idx: np.ndarray, n_users: int) -> np.ndarray:
+    """
+    Per-user sums of position values, added in position order like driftpy.
+    Positions are stored user by user, so a `reduceat` over the run starts is
+    enough.
+    """
+    out = np.zeros(n_users, dtype=object)
+    if len(user_idx) == 0:
+        return out
+    starts = np.flatnonzero(np.r_[True, np.diff(user_idx) != 0])
+    out[user_idx[starts]] = np.add.reduceat(values.astype(object), starts)
+    return out
+
+
+def get_size_in_amm_precision(amount: np.ndarray, precision: np.ndarray) -> np.ndarray:
+    return np.where(
+        precision > AMM_RESERVE_PRECISION,
+        amount / (precision / AMM_RESERVE_PRECISION),
+        amount * AMM_RESERVE_PRECISION / precision,
+    )
+
+
+def calculate_size_discount_asset_weight(
+    size: np.ndarray, imf_factor: np.ndarray, asset_weight: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized `calculate_size_discount_asset_weight`.
+    """
+    size_sqrt = ceil((np.abs(size) * 10) ** 0.5) + 1
+    imf_num = SPOT_IMF_PRECISION + (SPOT_IMF_PRECISION / 10)
+    size_discount_asset_weight = ceil(
+        imf_num
+        * SPOT_WEIGHT_PRECISION
+        / (SPOT_IMF_PRECISION + size_sqrt * imf_factor / 100_000)
+    )
+    return np.where(
+        imf_factor == 0,
+        asset_weight,
+        np.minimum(asset_weight, size_discount_asset_weight),
+    )
+
+
+def calculate_size_premium_liability_weight(
+    size: np.ndarray,
+    imf_factor: np.ndarray,
+    liability_weight: np.ndarray,
+    precision: int,
+) -> np.ndarray:
+    """
+    Vectorized `calculate_size_premium_liability_weight`, bounded below by
+    `liability_weight`.
+    """
+    size_sqrt = (np.abs(size) * 10 + 1) ** 0.5
+    liability_weight_numerator = liability_weight - (liability_weight // 5)
+    denom = (100_000 * SPOT_IMF_PRECISION) // precision
+    size_premium_liability_weight = liability_weight_numerator + (
+        (size_sqrt * imf_factor) // denom
+    )
+    return np.where(
+        imf_factor == 0,
+        liability_weight,
+        np.maximum(liability_weight, size_premium_liability_weight),
+    )
+
+
+def calculate_perp_liability_value(
+    base_asset_amount: np.ndarray, price: np.ndarray, is_prediction: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized `calculate_perp_liability_value`.
+    """
+    regular = (np.abs(base_asset_amount) * price) // BASE_PRECISION
+    prediction = np.where(
+        base_asset_amount > 0,
+        (base_asset_amount * price) // BASE_PRECISION,
+        (np.abs(base_asset_amount) * (MAX_PREDICTION_PRICE - price)) // BASE_PRECISION,
+    )
+    return np.where(is_prediction, prediction, regular)
+
+
+def calculate_spot_values(
+    arrays: MarginArrays, margin_category: Optional[MarginCategory]
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized `DriftUser.get_spot_market_asset_and_liability_value`, with
+    open orders.
+    """
+    token_amount = arrays.spot_token_amount
+    value = (token_amount * arrays.spot_price) // arrays.spot_precision
+
+    if margin_category is None:
+        weighted_value = value
+    else:
+        size = get_size_in_amm_precision(token_amount, arrays.spot_precision)
+        if margin_category == MarginCategory.INITIAL:
+            asset_weight = arrays.spot_initial_asset_weight
+            liability_weight = arrays.spot_initial_liability_weight
+        else:
+            asset_weight = arrays.spot_maintenance_asset_weight
+            liability_weight = arrays.spot_maintenance_liability_weight
+        asset_weight = calculate_size_discount_asset_weight(
+            size, arrays.spot_imf_factor, asset_weight
+        )
+        liability_weight = calculate_size_premium_liability_weight(
+            size, arrays.spot_imf_factor, liability_weight, SPOT_WEIGHT_PRECISION
+        )
+        if margin_category == MarginCategory.INITIAL:
+            # The user's custom margin ratio tightens every market but quote
+            max_margin_ratio = arrays.max_margin_ratio[arrays.spot_user]
+            asset_weight = np.where(
+                arrays.spot_is_quote,
+                asset_weight,
+                np.minimum(
+                    asset_weight,
+                    np.maximum(0, SPOT_WEIGHT_PRECISION - max_margin_ratio),
+                ),
+            )
+            liability_weight = np.where(
+                arrays.spot_is_quote,
+                liability_weight,
+                np.maximum(liability_weight, SPOT_WEIGHT_PRECISION + max_margin_ratio),
+            )
+        weight = np.where(token_amount < 0, liability_weight, asset_weight)
+        # Rounds liabilities away from zero, like driftpy
+        weighted_value = (value * weight) // SPOT_WEIGHT_PRECISION
+
+    # Quote balances are netted before they count as an asset or a liability
+    base = np.where(arrays.spot_is_quote, 0, weighted_value)
+    net_quote = sum_by_user(
+        np.where(arrays.spot_is_quote, weighted_value, 0),
+        arrays.spot_user,
+        arrays.n_users,
+    )
+    spot_asset = sum_by_user(
+        np.maximum(base, 0), arrays.spot_user, arrays.n_users
+    ) + np.maximum(net_quote, 0)
+    spot_liability = sum_by_user(
+        np.maximum(-base, 0) + arrays.spot_open_orders_margin,
+        arrays.spot_user,
+        arrays.n_users,
+    ) + np.maximum(-net_quote, 0)
+    return spot_asset, spot_liability
+
+
+def calculate_position_upnl(arrays: MarginArrays) -> np.ndarray:
+    """
+    Each perp position's unrealized pnl with funding, in the quote asset.
+    """
+    base_asset_amount = arrays.perp_base_asset_amount
+    base_asset_value = (
+        np.abs(base_asset_amount) * arrays.perp_price
+    ) // AMM_RESERVE_PRECISION
+    position_upnl = np.where(
+        base_asset_amount == 0,
+        arrays.perp_quote_asset_amount,
+        np.where(base_asset_amount < 0, -1, 1) * base_asset_value
+        + arrays.perp_quote_asset_amount
+        + arrays.perp_funding_pnl,
+    )
+    return (position_upnl * arrays.quote_price) // PRICE_PRECISION
+
+
+def calculate_worst_case_perp_liability(
+    arrays: MarginArrays,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized `calculate_worst_case_perp_liability_value`, as (worst case
+    base asset amount, liability value).
+    """
+    all_bids = arrays.perp_base_asset_amount + arrays.perp_open_bids
+    all_asks = arrays.perp_base_asset_amount + arrays.perp_open_asks
+    all_bids_liability = calculate_perp_liability_value(
+        all_bids, arrays.perp_price, arrays.perp_is_prediction
+    )
+    all_asks_liability = calculate_perp_liability_value(
+        all_asks, arrays.perp_price, arrays.perp_is_prediction
+    )
+    asks_are_worse = all_asks_liability >= all_bids_liability
+    return (
+        np.where(asks_are_worse, all_asks, all_bids),
+        np.where(asks_are_worse, all_asks_liability, all_bids_liability),
+    )
+
+
+def calculate_perp_margin_requirement(
+    arrays: MarginArrays,
+    margin_category: MarginCategory,
+    worst_case_base_asset_amount: np.ndarray,
+    worst_case_liability: np.ndarray,
+) -> np.ndarray:
+    """
+    Vectorized `DriftUser.get_total_perp_position_liability` for a margin
+    category, with open orders.
+    """
+    if margin_category == MarginCategory.INITIAL:
+        default_margin_ratio = arrays.perp_margin_ratio_initial
+    else:
+        default_margin_ratio = arrays.perp_margin_ratio_maintenance
+    margin_ratio = calculate_size_premium_liability_weight(
+        np.abs(worst_case_base_asset_amount),
+        arrays.perp_imf_factor,
+        default_margin_ratio,
+        MARGIN_PRECISION,
+    )
+    if margin_category == MarginCategory.INITIAL:
+        margin_ratio = np.maximum(
+            margin_ratio, arrays.max_margin_ratio[arrays.perp_user]
+        )
+    margin_ratio = np.where(arrays.perp_is_settled, 0, margin_ratio)
+
+    margin_requirement = (
+        (worst_case_liability * arrays.quote_price) // PRICE_PRECISION * margin_ratio
+    ) // MARGIN_PRECISION
+    return sum_by_user(
+        margin_requirement + arrays.perp_open_orders_margin,
+        arrays.perp_user,
+        arrays.n_users,
+    )
+
+
+def calculate_weighted_upnl(
+    arrays: MarginArrays, margin_category: MarginCategory, position_upnl: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized `DriftUser.get_unrealized_pnl` weighted for a margin category.
+    """
+    if margin_category == MarginCategory.INITIAL:
+        weight = calculate_size_discount_asset_weight(
+            position_upnl,
+            arrays.perp_unrealized_imf_factor,
+            arrays.perp_unrealized_initial_weight,
+        )
+    else:
+        weight = arrays.perp_unrealized_maintenance_weight
+    weighted_upnl = np.where(
+        position_upnl > 0,
+        (position_upnl * weight) // SPOT_WEIGHT_PRECISION,
+        position_upnl,
+    )
+    return sum_by_user(weighted_upnl, arrays.perp_user, arrays.n_users)
+
+
+def calculate_collateral_and_requirement(
+    arrays: MarginArrays,
+    margin_category: MarginCategory,
+    position_upnl: np.ndarray,
+    worst_case_base_asset_amount: np.ndarray,
+    worst_case_liability: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Every user's `get_total_collateral` and `get_margin_requirement` for a
+    margin category, exact.
+    """
+    spot_asset, spot_liability = calculate_spot_values(arrays, margin_category)
+    total_collateral = spot_asset + calculate_weighted_upnl(
+        arrays, margin_category, position_upnl
+    )
+    margin_requirement = (
+        calculate_perp_margin_requirement(
+            arrays,
+            margin_category,
+            worst_case_base_asset_amount,
+            worst_case_liability,
+        )
+        + spot_liability
+    )
+    return total_collateral, margin_requirement
+
+
+def calculate_free_collateral(
+    arrays: MarginArrays, margin_category: MarginCategory
+) -> np.ndarray:
+    """
+    Every user's collateral above their margin requirement, floored at 0 as
+    in `DriftUser.get_perp_liq_price`, exact.
+    """
+    total_collateral, margin_requirement = calculate_collateral_and_requirement(
+        arrays,
+        margin_category,
+        calculate_position_upnl(arrays),
+        *calculate_worst_case_perp_liability(arrays),
+    )
+    return np.maximum(total_collateral - margin_requirement, 0)
+
+
+def calculate_margin_metrics(arrays: MarginArrays) -> dict[str, np.ndarray]:
+    """
+    `MARGIN_METRICS` of every user, as driftpy computes them without strict
+    pricing or a liquidation buffer, as float64 (health as int64). Rows of
+    `arrays.fallback_users` are approximations and should be replaced with
+    driftpy's values.
+    """
+    n_users = arrays.n_users
+    position_upnl = calculate_position_upnl(arrays)
+    upnl = sum_by_user(position_upnl, arrays.perp_user, n_users)
+    (
+        worst_case_base_asset_amount,
+        worst_case_liability,
+    ) = calculate_worst_case_perp_liability(arrays)
+
+    metrics = {}
+    for margin_category, suffix in (
+        (MarginCategory.INITIAL, "initial"),
+        (MarginCategory.MAINTENANCE, "maintenance"),
+    ):
+        (
+            metrics[f"total_collateral_{suffix}"],
+            metrics[f"margin_requirement_{suffix}"],
+        ) = calculate_collateral_and_requirement(
+            arrays,
+            margin_category,
+            position_upnl,
+            worst_case_base_asset_amount,
+            worst_case_liability,
+        )
+
+    spot_asset, spot_liability = calculate_spot_values(arrays, None)
+    perp_liability_worst_case = sum_by_user(
+        worst_case_liability, arrays.perp_user, n_users
+    )
+    total_liabilities = perp_liability_worst_case + spot_liability
+    net_assets = spot_asset + upnl - spot_liability
+    metrics["leverage"] = np.where(
+        net_assets == 0,
+        0,
+        (total_liabilities * MARGIN_PRECISION)
+        // np.where(net_assets == 0, 1, net_assets),
+    )
+    metrics["upnl"] = upnl
+    metrics["spot_asset"] = spot_asset
+    metrics["spot_liability"] = spot_liability
+    metrics["perp_liability"] = sum_by_user(
+        calculate_perp_liability_value(
+            arrays.perp_base_asset_amount, arrays.perp_price, arrays.perp_is_prediction
+        ),
+        arrays.perp_user,
+        n_users,
+    )
+    metrics = {key: value.astype(np.float64) for key, value in metrics.items()}
+
+    metrics["health"] = calculate_health(
+        metrics["total_collateral_maintenance"],
+        metrics["margin_requirement_maintenance"],
+        arrays.being_liquidated,
+    )
+    metrics["init_health"] = calculate_health(
+        metrics["total_collateral_initial"],
+        metrics["margin_requirement_initial"],
+        arrays.being_liquidated,
+    )
+    return metrics
+
+
+def get_driftpy_margin_metrics(user: DriftUser) -> dict[str, int]:
+    """
+    `MARGIN_METRICS` of one user, straight from driftpy.
+    """
+    spot_asset, spot_liability = user.get_spot_market_asset_and_liability_value(
+        None, None
+    )
+    return {
+        "total_collateral_initial": user.get_total_collateral(MarginCategory.INITIAL),
+        "total_collateral_maintenance": user.get_total_collateral(
+            MarginCategory.MAINTENANCE
+        ),
+        "margin_requirement_initial": user.get_margin_requirement(
+            MarginCategory.INITIAL
+        ),
+        "margin_requirement_maintenance": user.get_margin_requirement(
+            MarginCategory.MAINTENANCE
+        ),
+        "health": user.get_health(),
+        "init_health": get_init_health(user),
+        "leverage": user.get_leverage(),
+        "upnl": user.get_unrealized_pnl(True),
+        "spot_asset": spot_asset,
+        "spot_liability": spot_liability,
+        "perp_liability": user.get_total_perp_position_liability(None),
+    }
+
+
+def compare_margin_metrics(
+    arrays: MarginArrays,
+    metrics: dict[str, np.ndarray],
+    user_indexes: Optional[np.ndarray] = None,
+) -> pd.DataFrame:
+    """
+    Parity harness: the absolute deviation of every vectorized metric from
+    `DriftUser`'s, one row per user (all of them, or `user_indexes`).
+
+    `max_deviation` is the largest deviation of the dollar metrics, in
+    QUOTE_PRECISION units. Fallback users are included and compared as
+    computed, so they show how far off the vectorized path would be for them.
+    """
+    if user_indexes is None:
+        user_indexes = np.arange(arrays.n_users)
+    is_fallback = np.isin(user_indexes, arrays.fallback_users)
+
+    rows = []
+    for user_idx in user_indexes.tolist():
+        user = arrays.users[user_idx]
+        row = {"user_key": str(user.user_public_key)}
+        try:
+            expected = get_driftpy_margin_metrics(user)
+        except Exception as e:
+            print(f"==> Error from margin parity [{user.user_public_key}] ", e)
+            row.update({metric: np.nan for metric in MARGIN_METRICS})
+        else:
+            row.update(
+                {
+                    metric: abs(float(metrics[metric][user_idx]) - expected[metric])
+                    for metric in MARGIN_METRICS
+                }
+            )
+        rows.append(row)
+
+    df = pd.DataFrame(rows, columns=["user_key", *MARGIN_METRICS])
+    df["is_fallback"] = is_fallback
+    dollar_metrics = [
+        metric
+        for metric in MARGIN_METRICS
+        if metric not in ("health", "init_health", "leverage")
+    ]
+    df["max_deviation"] = df[dollar_metrics].max(axis=1)
+    return df
@@ -1,12 +1,29 @@
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, fields, replace
+from typing import Optional
+
+import numpy as np
 import pandas as pd
+from driftpy.constants.perp_markets import mainnet_perp_market_configs
 from driftpy.constants.spot_markets import mainnet_spot_market_configs
+from driftpy.math.margin import MarginCategory
 from driftpy.pickle.vat import Vat
 
+from backend.utils.liquidation_index import (
+    LiquidationPriceIndex,
+    get_users_with_liq_price_within,
+    load_liquidation_price_index,
+)
 from backend.utils.user_metrics import (
-    get_user_metrics_initial,
-    get_user_metrics_maintenance,
-    get_user_metrics_none,
+    combine_asset_liability_metrics,
+    get_category_metrics_for_asset_liability,
+    get_health_for_asset_liability,
+    get_stable_metrics,
 )
+from backend.utils.user_metrics_table import UserMetricsTable, get_user_metrics_table
+from backend.utils.waiting_for import waiting_for
 
 
 def calculate_effective_leverage(assets: float, liabilities: float) -> float:
@@ -23,91 +40,436 @@ def format_metric(
     return f"{formatted} ✅" if should_highlight and mode > 0 else formatted
 
 
-async def get_matrix(
-    vat: Vat, mode: int = 0, perp_market_index: int = 0, toggle_upnl: bool = True
-):
-    NUMBER_OF_SPOT = len(mainnet_spot_market_configs)
+def get_composition_coo(
+    compositions: list[dict],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (row, market index, value) triplets of sparse `{market_index: value}` dicts.
+    """
+    lengths = np.fromiter(map(len, compositions), dtype=int, count=len(compositions))
+    market_indexes = np.fromiter(
+        itertools.chain.from_iterable(compositions), dtype=int, count=lengths.sum()
+    )
+    values = np.fromiter(
+        itertools.chain.from_iterable(c.values() for c in compositions),
+        dtype=float,
+        count=lengths.sum(),
+    )
+    rows = np.repeat(np.arange(len(compositions)), lengths)
+    return rows, market_indexes, values
 
-    # The modes are:
-    # 0: None
-    # 1: liq within 50% of oracle
-    # 2: maint. health < 10%
-    # 3: init. health < 10%
-
-    if mode == 0 or mode == 1:
-        res = get_user_metrics_none(vat.users)
-        metrics_data = res["metrics_none"]
-        user_keys = res["user_keys"]
-    elif mode == 2:
-        res = get_user_metrics_initial(vat.users)
-        metrics_data = [x for x in res["metrics_initial"] if int(x["health"]) <= 10]
-        user_keys = [x["user_key"] for x in metrics_data]
-    elif mode == 3:
-        res = get_user_metrics_maintenance(vat.users)
-        metrics_data = [x for x in res["metrics_maintenance"] if int(x["health"]) <= 10]
-        user_keys = [x["user_key"] for x in metrics_data]
-    else:
+
+def get_composition_matrix(compositions: list[dict], num_markets: int) -> np.ndarray:
+    """
+    Dense (users x markets) matrix of sparse `{market_index: value}` dicts.
+    """
+    rows, market_indexes, values = get_composition_coo(compositions)
+    matrix = np.zeros((len(compositions), num_markets))
+    matrix[rows, market_indexes] = values
+    return matrix
+
+
+def composition_to_wire(compositions: list[dict]) -> dict:
+    """
+    Compositions as COO columns, with rows in the order of the matrix frame.
+    """
+    rows, market_indexes, values = get_composition_coo(compositions)
+    return {
+        "row": rows.tolist(),
+        "market_index": market_indexes.tolist(),
+        "value": values.tolist(),
+    }
+
+
+@dataclass
+class AssetLiabilityCube:
+    """
+    Everything needed to build the matrix for any perp market, from one pass
+    over the user map.
+
+    The spot x perp x {long, short} cube is kept factorized: each user's
+    long/short cell for a pair of markets is their collateral share of the
+    spot market times their net position in the perp market, so slicing out
+    one perp market is a single broadcast.
+    """
+
+    df: pd.DataFrame
+    # (users x spot markets)
+    value_mod: np.ndarray
+    collateral_share: np.ndarray
+    included: np.ndarray
+    # (users x 1)
+    spot_asset: np.ndarray
+    perp_liability: np.ndarray
+    spot_liability: np.ndarray
+    # (users x perp markets)
+    net_p: np.ndarray
+
+
+# The modes are:
+# 0: None
+# 1: liq within 50% of oracle
+# 2: maint. health < 10%
+# 3: init. health < 10%
+MODE_MARGIN_CATEGORIES = {
+    0: None,
+    1: None,
+    2: MarginCategory.INITIAL,
+    3: MarginCategory.MAINTENANCE,
+}
+HEALTH_FILTERED_MODES = [2, 3]
+LIQ_ORACLE_DISTANCE = 0.5
+ASSET_LIABILITY_PAGE_SIZE = 100
+
+
+def get_mode_margin_category(mode: int) -> MarginCategory | None:
+    if mode not in MODE_MARGIN_CATEGORIES:
         raise ValueError(f"Invalid mode: {mode}")
+    return MODE_MARGIN_CATEGORIES[mode]
 
-    df = pd.DataFrame(metrics_data, index=user_keys)
-
-    new_columns = {}
-    for i in range(NUMBER_OF_SPOT):
-        prefix = f"spot_{i}"
-        column_names = [
-            f"{prefix}_all_assets",
-            f"{prefix}_all",
-            f"{prefix}_all_perp",
-            f"{prefix}_all_spot",
-            f"{prefix}_perp_{perp_market_index}_long",
-            f"{prefix}_perp_{perp_market_index}_short",
+
+def get_stable_metrics_table(
+    vat: Vat, table: Optional[UserMetricsTable] = None
+) -> list[dict]:
+    """
+    The metrics every margin category shares, with the maintenance health
+    that categories other than initial report. Read from the snapshot's
+    `table` where it has them.
+    """
+    if table is None:
+        return [
+            {**get_stable_metrics(user), "health": user.get_health()}
+            for user in vat.users.values()
         ]
-        for col in column_names:
-            new_columns[col] = pd.Series(0.0, index=df.index)
 
-    for idx, row in df.iterrows():
-        spot_asset = row["spot_asset"]
+    columns = zip(
+        table.valid.tolist(),
+        table.is_high_leverage.tolist(),
+        table.leverage.tolist(),
+        table.upnl.tolist(),
+        table.net_usd_value.tolist(),
+        table.health.tolist(),
+    )
+    stable_metrics = []
+    for user, (valid, is_high_leverage, leverage, upnl, net_usd_value, health) in zip(
+        table.users, columns
+    ):
+        if not valid:
+            stable_metrics.append(
+                {**get_stable_metrics(user), "health": user.get_health()}
+            )
+            continue
+        stable_metrics.append(
+            {
+                "user_key": user.user_public_key,
+                "is_high_leverage": is_high_leverage,
+                "leverage": leverage,
+                "upnl": upnl,
+                "net_usd_value": net_usd_value,
+                "health": health,
+            }
+        )
+    return stable_metrics
 
-        for market_id, value in row["net_v"].items():
-            value_mod = value
-            if toggle_upnl and "upnl" in row and market_id == 0:
-                value_mod = row["upnl"] + value
 
-            if value_mod < 0:
-                # print(f"value: {value}, type: {type(value)}")
-                continue
+def build_asset_liability_cube(
+    vat: Vat,
+    margin_category: MarginCategory | None,
+    stable_metrics: list[dict],
+    toggle_upnl: bool = True,
+) -> AssetLiabilityCube:
+    """
+    The cube of every user at one margin category. Only the category weighted
+    metrics are computed here, the rest comes from `stable_metrics`.
+    """
+    NUMBER_OF_SPOT = len(mainnet_spot_market_configs)
+    NUMBER_OF_PERP = len(mainnet_perp_market_configs)
 
-            if value_mod == 0:
-                continue
+    metrics_data = []
+    for user, metrics_stable in zip(vat.users.values(), stable_metrics):
+        metrics_stable = dict(metrics_stable)
+        health = metrics_stable.pop("health")
+        if margin_category == MarginCategory.INITIAL:
+            health = get_health_for_asset_liability(user, margin_category)
+        metrics_data.append(
+            combine_asset_liability_metrics(
+                metrics_stable,
+                get_category_metrics_for_asset_liability(user, margin_category),
+                health,
+            )
+        )
 
-            base_name = f"spot_{market_id}"
+    def get_column(key: str) -> np.ndarray:
+        return np.array([x[key] for x in metrics_data], dtype=float)[:, None]
 
-            if row["spot_asset"] == 0:
-                continue
+    net_v = get_composition_matrix([x["net_v"] for x in metrics_data], NUMBER_OF_SPOT)
+    spot_asset = get_column("spot_asset")
 
-            metrics = {
-                f"{base_name}_all_assets": value_mod,
-                f"{base_name}_all": value_mod
-                / spot_asset
-                * (row["perp_liability"] + row["spot_liability"]),
-                f"{base_name}_all_perp": value_mod / spot_asset * row["perp_liability"],
-                f"{base_name}_all_spot": value_mod / spot_asset * row["spot_liability"],
-            }
+    value_mod = net_v.copy()
+    if toggle_upnl:
+        value_mod[:, 0] = get_column("upnl")[:, 0] + net_v[:, 0]
+
+    # Excluded cells may divide by zero, they are masked out when slicing
+    with np.errstate(divide="ignore", invalid="ignore"):
+        collateral_share = net_v / spot_asset
+
+    return AssetLiabilityCube(
+        df=pd.DataFrame(metrics_data, index=list(vat.users.user_map.keys())),
+        value_mod=value_mod,
+        collateral_share=collateral_share,
+        # Only positive collateral of users with any assets counts towards a market
+        included=(value_mod > 0) & (spot_asset != 0),
+        spot_asset=spot_asset,
+        perp_liability=get_column("perp_liability"),
+        spot_liability=get_column("spot_liability"),
+        net_p=get_composition_matrix(
+            [x["net_p"] for x in metrics_data], NUMBER_OF_PERP
+        ),
+    )
+
+
+def select_cube_rows(cube: AssetLiabilityCube, rows: np.ndarray):
+    return replace(
+        cube,
+        **{field.name: getattr(cube, field.name)[rows] for field in fields(cube)},
+    )
+
+
+def filter_asset_liability_cube(
+    cube: AssetLiabilityCube,
+    mode: int,
+    liquidation_index: Optional[LiquidationPriceIndex] = None,
+):
+    """
+    The users `mode` shows. Health filtered modes are indexed by user key like
+    their metrics. Mode 1 needs the snapshot's `liquidation_index`.
+    """
+    if mode == 1:
+        if liquidation_index is None:
+            raise ValueError("Mode 1 needs a liquidation price index")
+        rows = np.zeros(len(cube.df), dtype=bool)
+        rows[
+            get_users_with_liq_price_within(liquidation_index, LIQ_ORACLE_DISTANCE)
+        ] = True
+        return select_cube_rows(cube, rows)
+    if mode in HEALTH_FILTERED_MODES:
+        rows = np.array([int(health) <= 10 for health in cube.df["health"]])
+        cube = select_cube_rows(cube, rows.astype(bool))
+        return replace(cube, df=cube.df.set_axis(cube.df["user_key"].tolist()))
+    return cube
+
+
+def get_cube_metrics(
+    cube: AssetLiabilityCube, perp_market_index: int
+) -> dict[str, np.ndarray]:
+    """
+    The (users x spot markets) values of each `spot_{i}_*` metric.
+    """
+    if not 0 <= perp_market_index < cube.net_p.shape[1]:
+        raise ValueError(f"Unknown perp market: {perp_market_index}")
+    net_perp = cube.net_p[:, perp_market_index][:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = cube.value_mod / cube.spot_asset
+        perp_share = cube.collateral_share * net_perp
+        metrics = {
+            "all_assets": cube.value_mod,
+            "all": share * (cube.perp_liability + cube.spot_liability),
+            "all_perp": share * cube.perp_liability,
+            "all_spot": share * cube.spot_liability,
+            f"perp_{perp_market_index}_long": np.where(net_perp > 0, perp_share, 0.0),
+            f"perp_{perp_market_index}_short": np.where(net_perp < 0, perp_share, 0.0),
+        }
+    return {
+        name: np.where(cube.included, values, 0.0) for name, values in metrics.items()
+    }
+
+
+def slice_asset_liability_cube(
+    cube: AssetLiabilityCube, perp_market_index: int
+) -> pd.DataFrame:
+    """
+    The matrix frame of one perp market, as `/matrix` serves it.
+    """
+    metrics = get_cube_metrics(cube, perp_market_index)
+    new_columns = {
+        f"spot_{i}_{name}": values[:, i]
+        for i in range(cube.value_mod.shape[1])
+        for name, values in metrics.items()
+    }
+    return pd.concat([cube.df, pd.DataFrame(new_columns, index=cube.df.index)], axis=1)
+
+
+@dataclass
+class AssetLiabilityTables:
+    """
+    Per snapshot: the shared metrics are computed once, and each margin
+    category's cube the first time a mode needs it. Modes only filter cubes.
+    """
 
-            net_perp = float(row["net_p"][perp_market_index])
-            # print(f"net_perp value: {net_perp}")
+    stable_metrics: list[dict]
+    cubes: dict[tuple[MarginCategory | None, bool], AssetLiabilityCube]
 
-            if net_perp > 0:
-                metrics[f"{base_name}_perp_{perp_market_index}_long"] = (
-                    value / spot_asset * net_perp
+
+_loaded_tables: dict[str, AssetLiabilityTables] = {}
+# Routes build cubes off the event loop, one at a time
+_tables_lock = threading.Lock()
+
+
+def load_asset_liability_cube(
+    pickle_path: str, vat: Vat, mode: int = 0, toggle_upnl: bool = True
+) -> AssetLiabilityCube:
+    """
+    The cube of the loaded snapshot for `mode`. Cubes already built are
+    read without waiting for another mode's build.
+    """
+    margin_category = get_mode_margin_category(mode)
+    key = (margin_category, toggle_upnl)
+    tables = _loaded_tables.get(pickle_path)
+    cube = None if tables is None else tables.cubes.get(key)
+    if cube is None:
+        with _tables_lock:
+            if pickle_path not in _loaded_tables:
+                # Tables of older snapshots are never asked for again
+                _loaded_tables.clear()
+                table = get_user_metrics_table()
+                if table is not None and table.snapshot_id != pickle_path:
+                    table = None
+                _loaded_tables[pickle_path] = AssetLiabilityTables(
+                    stable_metrics=get_stable_metrics_table(vat, table), cubes={}
                 )
-            if net_perp < 0:
-                metrics[f"{base_name}_perp_{perp_market_index}_short"] = (
-                    value / spot_asset * net_perp
+            tables = _loaded_tables[pickle_path]
+
+            if key not in tables.cubes:
+                tables.cubes[key] = build_asset_liability_cube(
+                    vat, margin_category, tables.stable_metrics, toggle_upnl
                 )
+            cube = tables.cubes[key]
+    liquidation_index = None
+    if mode == 1:
+        liquidation_index = load_liquidation_price_index(pickle_path, vat)
+    return filter_asset_liability_cube(cube, mode, liquidation_index)
+
+
+# The page's default cube, built off the event loop right after a snapshot loads
+_cube_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def _build_asset_liability_cube(pickle_path: str, vat: Vat) -> AssetLiabilityCube:
+    with waiting_for(f"asset-liability cube of {pickle_path}"):
+        return load_asset_liability_cube(pickle_path, vat, 0)
+
+
+def start_asset_liability_cube(pickle_path: str, vat: Vat) -> Future:
+    """
+    Builds the mode 0 cube, which every perp market of the Asset-Liability
+    page is sliced from, in the background. It reads the snapshot's metrics
+    table, waiting for it if it's still being built.
+    """
+    return _cube_executor.submit(_build_asset_liability_cube, pickle_path, vat)
+
+
+def filter_cube_users(
+    cube: AssetLiabilityCube, min_leverage: float = 0.0, only_high_leverage=False
+) -> np.ndarray:
+    """
+    Rows of the users passing the Asset-Liability page's filters.
+    """
+    rows = cube.df["leverage"].to_numpy(dtype=float) >= min_leverage
+    if only_high_leverage:
+        rows &= cube.df["is_high_leverage"].to_numpy(dtype=bool)
+    return rows
+
+
+def get_asset_liability_summary(
+    cube: AssetLiabilityCube, perp_market_index: int, rows: np.ndarray
+) -> pd.DataFrame:
+    """
+    Per spot market totals over the users in `rows`.
+    """
+    totals = {
+        name: values[rows].sum(axis=0)
+        for name, values in get_cube_metrics(cube, perp_market_index).items()
+    }
+    symbols = [config.symbol for config in mainnet_spot_market_configs]
+    summary = pd.DataFrame(
+        {
+            "all_assets": totals["all_assets"],
+            "all_liabilities": totals["all"],
+            "effective_leverage": [
+                calculate_effective_leverage(assets, liabilities)
+                for assets, liabilities in zip(totals["all_assets"], totals["all"])
+            ],
+            "all_spot": totals["all_spot"],
+            "all_perp": totals["all_perp"],
+            f"perp_{perp_market_index}_long": totals[f"perp_{perp_market_index}_long"],
+            f"perp_{perp_market_index}_short": totals[
+                f"perp_{perp_market_index}_short"
+            ],
+        },
+        index=[f"spot{i} ({symbol})" for i, symbol in enumerate(symbols)],
+    )
+    return summary
+
+
+def get_asset_liability_users(
+    cube: AssetLiabilityCube,
+    perp_market_index: int,
+    rows: np.ndarray,
+    spot_market_index: Optional[int] = None,
+    sort_by: Optional[str] = None,
+    ascending: bool = False,
+    page: int = 0,
+    page_size: int = ASSET_LIABILITY_PAGE_SIZE,
+) -> tuple[pd.DataFrame, int]:
+    """
+    One page of the users in `rows`, sorted by `sort_by`, and how many there
+    are in total.
+
+    Without `spot_market_index` pages have every column of the matrix and sort
+    by leverage. With it they only have that spot market's columns, skip users
+    with nothing in them, and sort by its `_all` column.
+    """
+    metrics = get_cube_metrics(cube, perp_market_index)
+    df = cube.df.drop(columns=["net_v", "net_p"])
+    if spot_market_index is None:
+        spot_market_indexes = range(cube.value_mod.shape[1])
+        sort_by = sort_by or "leverage"
+    else:
+        if not 0 <= spot_market_index < cube.value_mod.shape[1]:
+            raise ValueError(f"Unknown spot market: {spot_market_index}")
+        spot_market_indexes = [spot_market_index]
+        df = df[["user_key", "spot_asset", "net_usd_value"]]
+        sort_by = sort_by or f"spot_{spot_market_index}_all"
+        held = np.zeros(len(df), dtype=bool)
+        for values in metrics.values():
+            held |= values[:, spot_market_index] != 0
+        rows = rows & held
+
+    columns = {
+        f"spot_{i}_{name}": values[:, i]
+        for i in spot_market_indexes
+        for name, values in metrics.items()
+    }
+    if sort_by in df.columns:
+        sort_values = df[sort_by].to_numpy()
+    elif sort_by in columns:
+        sort_values = columns[sort_by]
+    else:
+        raise ValueError(f"Unknown column: {sort_by}")
 
-            for col, val in metrics.items():
-                new_columns[col][idx] = val
+    (matching,) = np.nonzero(rows)
+    order = pd.Series(sort_values[matching]).sort_values(ascending=ascending).index
+    page_rows = matching[order[page * page_size : (page + 1) * page_size]]
 
-    df = pd.concat([df, pd.DataFrame(new_columns)], axis=1)
-    return df
+    page_df = pd.concat(
+        [
+            df.iloc[page_rows],
+            pd.DataFrame(
+                {name: values[page_rows] for name, values in columns.items()},
+                index=df.index[page_rows],
+            ),
+        ],
+        axis=1,
+    )
+    page_df["user_key"] = page_df["user_key"].astype(str)
+    return page_df, len(matching)
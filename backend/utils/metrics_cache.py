@@ -0,0 +1,77 @@
+import functools
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from driftpy.drift_user import DriftUser
+
+METRICS_CACHE_MAX_ENTRIES = int(os.getenv("METRICS_CACHE_MAX_ENTRIES", 1_000_000))
+
+
+class SnapshotMetricsCache:
+    """
+    Per-user metrics of the loaded snapshot, keyed by (snapshot id, user
+    pubkey, metric), evicting the least recently used entry past
+    `max_entries`.
+
+    Switching snapshots swaps in an empty store in one assignment, so no
+    reader ever sees a mix of two snapshots. Without a snapshot (e.g. while
+    bootstrapped on live data) nothing is cached.
+    """
+
+    def __init__(self, max_entries: int = METRICS_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.snapshot_id: Optional[str] = None
+        self._entries: OrderedDict[tuple, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def switch_snapshot(self, snapshot_id: Optional[str]):
+        with self._lock:
+            self.snapshot_id = snapshot_id
+            self._entries = OrderedDict()
+
+    def get_or_compute(
+        self, pubkey: str, metric: Hashable, compute: Callable[[], Any]
+    ) -> Any:
+        snapshot_id = self.snapshot_id
+        if snapshot_id is None:
+            return compute()
+
+        key = (snapshot_id, pubkey, metric)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        value = compute()
+        with self._lock:
+            # Values computed while the snapshot switched belong to neither
+            if self.snapshot_id == snapshot_id:
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+metrics_cache = SnapshotMetricsCache()
+
+
+def snapshot_cached(func: Callable) -> Callable:
+    """
+    Caches `func(user, *args)` in `metrics_cache` under the function's name
+    and `args`, which must be hashable.
+    """
+
+    @functools.wraps(func)
+    def wrapper(user: DriftUser, *args):
+        return metrics_cache.get_or_compute(
+            str(user.user_public_key),
+            (func.__name__, *args),
+            lambda: func(user, *args),
+        )
+
+    return wrapper
@@ -0,0 +1,134 @@
+import multiprocessing
+import os
+import threading
+from typing import Optional
+
+from driftpy.drift_client import DriftClient
+from driftpy.drift_user import DriftUser
+from driftpy.user_map.user_map import UserMap
+
+from backend.utils.user_metrics import (
+    OracleOverlay,
+    calculate_leverages_for_price_shock,
+    get_exposed_user_indices,
+    get_skipped_oracles,
+)
+from backend.utils.vectorized_price_shock import PRICE_SHOCK_COLUMNS
+from shared.types import PriceShockAssetGroup
+
+# Set in the parent right before the pool forks, so workers inherit the loaded
+# snapshot through copy-on-write instead of having it pickled to them.
+_shared_drift_client: Optional[DriftClient] = None
+_shared_users: list[DriftUser] = []
+_shared_exposed: list[int] = []
+# Routes run this off the event loop, so concurrent requests take turns
+# publishing their snapshot and forking
+_shared_lock = threading.Lock()
+
+
+# Workers are forked from a threaded server, so a child can inherit a lock some
+# other thread (an executor, logging, stdout) held at that moment and deadlock
+# on it. A pool that doesn't finish within PRICE_SHOCK_POOL_TIMEOUT seconds is
+# terminated and its scenarios are evaluated serially instead.
+def get_price_shock_workers() -> int:
+    return int(os.getenv("PRICE_SHOCK_WORKERS", min(8, os.cpu_count() or 1)))
+
+
+def get_price_shock_pool_timeout() -> float:
+    return float(os.getenv("PRICE_SHOCK_POOL_TIMEOUT", 300))
+
+
+def _evaluate_scenario(oracle_multipliers: Optional[dict[str, float]]) -> dict:
+    """
+    Runs in a forked worker. Returns the scenario as columns, without
+    `user_key` since pubkeys don't survive pickling back to the parent.
+
+    The baseline covers every user, shocked scenarios only the exposed ones.
+    """
+    users = _shared_users
+    overlay = None
+    if oracle_multipliers is not None:
+        users = [_shared_users[i] for i in _shared_exposed]
+        overlay = OracleOverlay.with_multipliers(
+            _shared_drift_client, oracle_multipliers
+        )
+    leverages = calculate_leverages_for_price_shock(users, None, overlay)
+    return {
+        key: [metrics[key] for metrics in leverages] for key in PRICE_SHOCK_COLUMNS[1:]
+    }
+
+
+def get_user_leverages_for_price_shock_parallel(
+    slot: int,
+    drift_client: DriftClient,
+    user_map: UserMap,
+    oracle_distortion: float = 0.1,
+    asset_group: PriceShockAssetGroup = PriceShockAssetGroup.IGNORE_STABLES,
+    scenarios: int = 5,
+    n_workers: Optional[int] = None,
+):
+    """
+    Same response as `get_user_leverages_for_price_shock`, with every
+    scenario/direction pair evaluated in its own forked worker. `n_workers`
+    is capped at `get_price_shock_workers()`.
+    """
+    global _shared_drift_client, _shared_users, _shared_exposed
+
+    user_keys = list(user_map.user_map.keys())
+    skipped_oracles = get_skipped_oracles(asset_group)
+    distorted_oracles = [
+        key
+        for key in drift_client.account_subscriber.cache["oracle_price_data"]
+        if key not in skipped_oracles
+    ]
+
+    tasks: list[Optional[dict[str, float]]] = [None]
+    for i in range(scenarios):
+        oracle_distort_up = max(1 + oracle_distortion * (i + 1), 1)
+        tasks.append({key: oracle_distort_up for key in distorted_oracles})
+    for i in range(scenarios):
+        oracle_distort_down = max(1 - oracle_distortion * (i + 1), 0)
+        tasks.append({key: oracle_distort_down for key in distorted_oracles})
+
+    max_workers = get_price_shock_workers()
+    n_workers = max(1, min(n_workers or max_workers, max_workers, len(tasks)))
+    print(f"Evaluating {len(tasks)} price shock scenarios on {n_workers} workers")
+
+    users = list(user_map.values())
+    exposed = get_exposed_user_indices(users, distorted_oracles)
+    with _shared_lock:
+        _shared_drift_client = drift_client
+        _shared_users = users
+        _shared_exposed = exposed
+        try:
+            with multiprocessing.get_context("fork").Pool(n_workers) as pool:
+                results = pool.map_async(_evaluate_scenario, tasks, chunksize=1).get(
+                    get_price_shock_pool_timeout()
+                )
+        except multiprocessing.TimeoutError:
+            print("==> Price shock pool timed out, evaluating scenarios serially")
+            results = [_evaluate_scenario(task) for task in tasks]
+        finally:
+            _shared_drift_client = None
+            _shared_users = []
+            _shared_exposed = []
+
+    baseline = results[0]
+    for i, result in enumerate(results[1:], start=1):
+        merged = {key: list(column) for key, column in baseline.items()}
+        for key, column in result.items():
+            for user_idx, value in zip(exposed, column):
+                merged[key][user_idx] = value
+        results[i] = merged
+
+    user_public_keys = [user.user_public_key for user in user_map.values()]
+    results = [{"user_key": user_public_keys, **result} for result in results]
+
+    return {
+        "slot": slot,
+        "leverages_none": results[0],
+        "leverages_up": tuple(results[1 : 1 + scenarios]),
+        "leverages_down": tuple(results[1 + scenarios :]),
+        "user_keys": user_keys,
+        "distorted_oracles": distorted_oracles,
+    }
@@ -0,0 +1,168 @@
+from dataclasses import dataclass
+
+import numpy as np
+from driftpy.constants import PRICE_PRECISION
+from driftpy.math.perp_position import is_available
+from driftpy.math.spot_position import is_spot_position_available
+from driftpy.pickle.vat import Vat
+from driftpy.types import is_variant
+
+PERP_POSITION_FIELDS = [
+    "base_asset_amount",
+    "quote_asset_amount",
+    "quote_break_even_amount",
+    "quote_entry_amount",
+    "last_cumulative_funding_rate",
+    "open_bids",
+    "open_asks",
+    "open_orders",
+    "lp_shares",
+]
+
+SPOT_POSITION_FIELDS = [
+    "scaled_balance",
+    "open_bids",
+    "open_asks",
+    "open_orders",
+]
+
+
+@dataclass
+class PerpPositions:
+    """
+    Every non-empty perp position of a snapshot, one array per field, in raw
+    on-chain units. Position `i` belongs to user `user_idx[i]`.
+    """
+
+    user_idx: np.ndarray
+    market_index: np.ndarray
+    base_asset_amount: np.ndarray
+    quote_asset_amount: np.ndarray
+    quote_break_even_amount: np.ndarray
+    quote_entry_amount: np.ndarray
+    last_cumulative_funding_rate: np.ndarray
+    open_bids: np.ndarray
+    open_asks: np.ndarray
+    open_orders: np.ndarray
+    lp_shares: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.user_idx)
+
+
+@dataclass
+class SpotPositions:
+    """
+    Every non-empty spot position of a snapshot, like `PerpPositions`.
+    """
+
+    user_idx: np.ndarray
+    market_index: np.ndarray
+    scaled_balance: np.ndarray
+    is_borrow: np.ndarray
+    open_bids: np.ndarray
+    open_asks: np.ndarray
+    open_orders: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.user_idx)
+
+
+@dataclass
+class PositionStore:
+    """
+    The positions of every user in one snapshot as structure-of-arrays, with
+    users numbered in `vat.users` order.
+
+    Authorities are interned: user `i` belongs to
+    `authorities[authority_idx[i]]`. Oracle prices are indexed by market
+    index, in UI units, and NaN for markets without an oracle.
+    """
+
+    user_keys: list[str]
+    authorities: list[str]
+    authority_idx: np.ndarray
+    perp: PerpPositions
+    spot: SpotPositions
+    perp_oracle_prices: np.ndarray
+    spot_oracle_prices: np.ndarray
+
+    def get_authority(self, user_idx: int) -> str:
+        return self.authorities[self.authority_idx[user_idx]]
+
+
+def get_oracle_price_array(oracles: dict) -> np.ndarray:
+    prices = np.full(max(oracles, default=-1) + 1, np.nan)
+    for market_index, oracle_price_data in oracles.items():
+        if oracle_price_data is not None:
+            prices[market_index] = oracle_price_data.price / PRICE_PRECISION
+    return prices
+
+
+def build_position_store(vat: Vat) -> PositionStore:
+    """
+    One pass over the user accounts.
+    """
+    user_keys = []
+    authority_ids: dict[str, int] = {}
+    authority_idx = []
+    perp_rows = []
+    spot_rows = []
+    for i, user in enumerate(vat.users.values()):
+        user_keys.append(str(user.user_public_key))
+        user_account = user.get_user_account()
+        authority = str(user_account.authority)
+        authority_idx.append(authority_ids.setdefault(authority, len(authority_ids)))
+
+        for position in user_account.perp_positions:
+            if not is_available(position):
+                perp_rows.append(
+                    (i, position.market_index)
+                    + tuple(getattr(position, key) for key in PERP_POSITION_FIELDS)
+                )
+        for position in user_account.spot_positions:
+            if not is_spot_position_available(position):
+                spot_rows.append(
+                    (
+                        i,
+                        position.market_index,
+                        is_variant(position.balance_type, "Borrow"),
+                    )
+                    + tuple(getattr(position, key) for key in SPOT_POSITION_FIELDS)
+                )
+
+    def get_columns(rows: list[tuple], n_columns: int) -> list[np.ndarray]:
+        if not rows:
+            return [np.array([], dtype=np.int64) for _ in range(n_columns)]
+        # A column with a u64 beyond int64 comes out as object dtype rather
+        # than wrapping around
+        return [np.array(column) for column in zip(*rows)]
+
+    perp_columns = get_columns(perp_rows, 2 + len(PERP_POSITION_FIELDS))
+    spot_columns = get_columns(spot_rows, 3 + len(SPOT_POSITION_FIELDS))
+    return PositionStore(
+        user_keys=user_keys,
+        authorities=list(authority_ids),
+        authority_idx=np.array(authority_idx, dtype=np.int64),
+        perp=PerpPositions(
+            user_idx=perp_columns[0],
+            market_index=perp_columns[1],
+            **dict(zip(PERP_POSITION_FIELDS, perp_columns[2:])),
+        ),
+        spot=SpotPositions(
+            user_idx=spot_columns[0],
+            market_index=spot_columns[1],
+            is_borrow=spot_columns[2].astype(bool),
+            **dict(zip(SPOT_POSITION_FIELDS, spot_columns[3:])),
+        ),
+        perp_oracle_prices=get_oracle_price_array(vat.perp_oracles),
+        spot_oracle_prices=get_oracle_price_array(vat.spot_oracles),
+    )
+
+
+def get_oracle_prices(prices: np.ndarray, market_index: np.ndarray) -> np.ndarray:
+    """
+    Prices of `market_index`, NaN for markets the snapshot has no oracle of.
+    """
+    padded = np.append(prices, np.nan)
+    return padded[np.minimum(market_index, len(prices))]
@@ -1,11 +1,31 @@
-from typing import Any, TypedDict
+from functools import partial
+from typing import Any, Iterable, Iterator, Optional, TypedDict
 
+import numpy as np
 import pandas as pd
 from driftpy.drift_client import DriftClient
 from driftpy.pickle.vat import Vat
 
-from backend.utils.user_metrics import get_user_leverages_for_price_shock
-from shared.types import PriceShockAssetGroup
+from backend.utils.parallel_price_shock import (
+    get_user_leverages_for_price_shock_parallel,
+)
+from backend.utils.user_metrics import (
+    calculate_leverages_for_price_shock,
+    get_user_leverages_for_price_shock,
+)
+from backend.utils.vectorized_price_shock import (
+    PRICE_SHOCK_COLUMNS,
+    PriceShockArrays,
+    build_price_shock_arrays,
+    evaluate_fallback_users,
+    evaluate_price_shock,
+    get_perp_oracle_id,
+    get_scenario_multipliers,
+    get_spot_oracle_id,
+    get_user_leverages_for_price_shock_vectorized,
+)
+from shared.frames import encode_frame
+from shared.types import FrameFormat, PriceShockAssetGroup, PriceShockEngine
 
 
 class UserLeveragesResponse(TypedDict):
@@ -31,6 +51,72 @@ def calculate_total_bankruptcies(df):
     return -df[df["net_usd_value"] < 0]["net_usd_value"].sum()
 
 
+def calculate_scenario_bankruptcies(
+    metrics: dict[str, np.ndarray]
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Total and spot bankruptcy of every scenario row in `evaluate_price_shock` output.
+    """
+    net_usd_value = metrics["net_usd_value"]
+    bankrupt = net_usd_value < 0
+    total = -np.where(bankrupt, net_usd_value, 0).sum(axis=1)
+    spot_bankrupt = bankrupt & (metrics["spot_asset"] < metrics["spot_liability"])
+    spot = np.where(
+        spot_bankrupt, metrics["spot_liability"] - metrics["spot_asset"], 0
+    ).sum(axis=1)
+    return total, spot
+
+
+# Response fields that hold a DataFrame
+PRICE_SHOCK_FRAMES = [
+    "result",
+    "oracle_down_max",
+    "oracle_up_max",
+    "scenario_deltas",
+    "user_keys",
+]
+
+
+def calculate_scenario_deltas(
+    baseline: pd.DataFrame,
+    dfs: list[pd.DataFrame],
+    oracle_moves: list[float],
+    net_usd_value_threshold: float,
+    health_threshold: float,
+) -> pd.DataFrame:
+    """
+    Long-format list of the users whose net USD value or health moved by at
+    least the threshold in each scenario, as indexes into the user key table.
+    """
+    baseline_net_usd_value = baseline["net_usd_value"].to_numpy(dtype=np.float64)
+    baseline_health = baseline["health"].to_numpy(dtype=np.float64)
+
+    deltas = []
+    for oracle_move, df in zip(oracle_moves, dfs):
+        net_usd_value_change = (
+            df["net_usd_value"].to_numpy(dtype=np.float64) - baseline_net_usd_value
+        )
+        health_change = df["health"].to_numpy(dtype=np.float64) - baseline_health
+        changed = np.flatnonzero(
+            (np.abs(net_usd_value_change) >= net_usd_value_threshold)
+            | (np.abs(health_change) >= health_threshold)
+        )
+        deltas.append(
+            pd.DataFrame(
+                {
+                    "Oracle Move (%)": np.full(len(changed), oracle_move),
+                    "user_idx": changed.astype(np.int32),
+                    "net_usd_value": baseline_net_usd_value[changed]
+                    + net_usd_value_change[changed],
+                    "net_usd_value_change": net_usd_value_change[changed],
+                    "health": baseline_health[changed] + health_change[changed],
+                    "health_change": health_change[changed],
+                }
+            )
+        )
+    return pd.concat(deltas, ignore_index=True)
+
+
 def generate_oracle_moves(num_scenarios, oracle_distort):
     return (
         [-oracle_distort * (i + 1) * 100 for i in range(num_scenarios)]
@@ -46,8 +132,29 @@ def get_price_shock_df(
     oracle_distortion: float,
     asset_group: PriceShockAssetGroup,
     n_scenarios: int,
+    engine: PriceShockEngine = PriceShockEngine.VECTORIZED,
+    n_workers: Optional[int] = None,
+    net_usd_value_threshold: float = 100.0,
+    health_threshold: float = 5,
 ):
-    user_leverages = get_user_leverages_for_price_shock(
+    """
+    The scenario table and per-user frames are returned as DataFrames, see
+    `price_shock_frames_to_json` for the JSON response.
+
+    `scenario_deltas` lists, for every shocked scenario, only the users whose
+    net USD value or health moved past the thresholds, indexing into the
+    shared `user_keys` table.
+    """
+    if engine == PriceShockEngine.VECTORIZED:
+        get_user_leverages = get_user_leverages_for_price_shock_vectorized
+    elif engine == PriceShockEngine.PARALLEL:
+        get_user_leverages = partial(
+            get_user_leverages_for_price_shock_parallel, n_workers=n_workers
+        )
+    else:
+        get_user_leverages = get_user_leverages_for_price_shock
+
+    user_leverages = get_user_leverages(
         slot,
         drift_client,
         vat.users,
@@ -55,13 +162,41 @@ def get_price_shock_df(
         asset_group,
         n_scenarios,
     )
-    levs = user_leverages
-    dfs = (
+    return build_price_shock_frames(
+        slot,
+        user_leverages,
+        oracle_distortion,
+        n_scenarios,
+        net_usd_value_threshold,
+        health_threshold,
+    )
+
+
+def get_scenario_dataframes(levs: dict) -> list[pd.DataFrame]:
+    """
+    One frame of user leverages per scenario, in `generate_oracle_moves` order.
+    """
+    return (
         create_dataframes(levs["leverages_down"])
         + [pd.DataFrame(levs["leverages_none"])]
         + create_dataframes(levs["leverages_up"])
     )
 
+
+def build_price_shock_frames(
+    slot: int,
+    levs: dict,
+    oracle_distortion: float,
+    n_scenarios: int,
+    net_usd_value_threshold: float = 100.0,
+    health_threshold: float = 5,
+):
+    """
+    Turn per-scenario user leverages, as returned by the
+    `get_user_leverages_for_price_shock*` engines, into the response frames.
+    """
+    dfs = get_scenario_dataframes(levs)
+
     spot_bankruptcies = [calculate_spot_bankruptcies(df) for df in dfs]
     total_bankruptcies = [calculate_total_bankruptcies(df) for df in dfs]
 
@@ -83,10 +218,330 @@ def get_price_shock_df(
     oracle_down_max = pd.DataFrame(levs["leverages_down"][-1])
     oracle_up_max = pd.DataFrame(levs["leverages_up"][-1], index=levs["user_keys"])
 
+    shocked = [i for i, oracle_move in enumerate(oracle_moves) if oracle_move != 0]
+    scenario_deltas = calculate_scenario_deltas(
+        dfs[n_scenarios],
+        [dfs[i] for i in shocked],
+        [oracle_moves[i] for i in shocked],
+        net_usd_value_threshold,
+        health_threshold,
+    )
+
     return {
         "slot": slot,
-        "result": df_plot.to_json(),
+        "result": df_plot,
         "distorted_oracles": levs["distorted_oracles"],
-        "oracle_down_max": oracle_down_max.to_json(),
-        "oracle_up_max": oracle_up_max.to_json(),
+        "oracle_down_max": oracle_down_max,
+        "oracle_up_max": oracle_up_max,
+        "scenario_deltas": scenario_deltas,
+        "user_keys": pd.DataFrame({"user_key": list(map(str, levs["user_keys"]))}),
+    }
+
+
+def compare_price_shock_leverages(
+    expected: dict,
+    actual: dict,
+    oracle_distortion: float,
+    n_scenarios: int,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Parity harness for two engines' user leverages over the same scenarios:
+    per scenario, both bankruptcy totals and their absolute deviation, and per
+    scenario and user, the absolute deviation of every column. Columns that
+    are NaN in only one engine deviate by inf.
+    """
+    columns = PRICE_SHOCK_COLUMNS[1:]
+    oracle_moves = generate_oracle_moves(n_scenarios, oracle_distortion)
+    totals = []
+    deviations = []
+    for oracle_move, expected_df, actual_df in zip(
+        oracle_moves, get_scenario_dataframes(expected), get_scenario_dataframes(actual)
+    ):
+        user_keys = list(map(str, expected_df["user_key"]))
+        if user_keys != list(map(str, actual_df["user_key"])):
+            raise ValueError(f"The engines priced different users at {oracle_move}%")
+        totals.append(
+            {
+                "Oracle Move (%)": oracle_move,
+                "Expected Total Bankruptcy ($)": calculate_total_bankruptcies(
+                    expected_df
+                ),
+                "Actual Total Bankruptcy ($)": calculate_total_bankruptcies(actual_df),
+                "Expected Spot Bankruptcy ($)": calculate_spot_bankruptcies(
+                    expected_df
+                ),
+                "Actual Spot Bankruptcy ($)": calculate_spot_bankruptcies(actual_df),
+            }
+        )
+
+        expected_values = expected_df[columns].to_numpy(dtype=float)
+        actual_values = actual_df[columns].to_numpy(dtype=float)
+        with np.errstate(invalid="ignore"):
+            deviation = np.abs(actual_values - expected_values)
+        is_same = (actual_values == expected_values) | (
+            np.isnan(actual_values) & np.isnan(expected_values)
+        )
+        deviation = np.where(is_same, 0.0, deviation)
+        deviation = np.where(np.isnan(deviation), np.inf, deviation)
+        df = pd.DataFrame(deviation, columns=columns)
+        df.insert(0, "user_key", user_keys)
+        df.insert(0, "Oracle Move (%)", oracle_move)
+        df["max_deviation"] = deviation.max(axis=1, initial=0.0)
+        deviations.append(df)
+
+    totals_df = pd.DataFrame(totals)
+    totals_df["Total Deviation ($)"] = (
+        totals_df["Actual Total Bankruptcy ($)"]
+        - totals_df["Expected Total Bankruptcy ($)"]
+    ).abs()
+    totals_df["Spot Deviation ($)"] = (
+        totals_df["Actual Spot Bankruptcy ($)"]
+        - totals_df["Expected Spot Bankruptcy ($)"]
+    ).abs()
+    return totals_df, pd.concat(deviations, ignore_index=True)
+
+
+def price_shock_frames_to_json(frames: dict) -> dict:
+    return {
+        key: value.to_json() if key in PRICE_SHOCK_FRAMES else value
+        for key, value in frames.items()
+    }
+
+
+def encode_price_shock_frame(
+    frames: dict, frame: str, frame_format: FrameFormat
+) -> bytes:
+    """
+    One frame of `get_price_shock_df` in a columnar format, carrying the
+    non-frame fields (slot, distorted oracles) as metadata.
+    """
+    metadata = {
+        key: value for key, value in frames.items() if key not in PRICE_SHOCK_FRAMES
+    }
+    return encode_frame(frames[frame], frame_format, metadata)
+
+
+def iter_scenario_bankruptcies(
+    drift_client: DriftClient,
+    arrays: PriceShockArrays,
+    oracle_multiplier_batches: Iterable[np.ndarray],
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    Yield the total and spot bankruptcy of each (scenarios, oracles) batch.
+
+    Only one batch of per-user metrics is alive at a time, and the fallback
+    users' unshocked baseline is computed once for all of them.
+    """
+    fallback_baseline = calculate_leverages_for_price_shock(
+        [arrays.users[i] for i in arrays.fallback_users], None
+    )
+    for oracle_multipliers in oracle_multiplier_batches:
+        metrics = evaluate_price_shock(arrays, oracle_multipliers)
+        evaluate_fallback_users(
+            drift_client, arrays, oracle_multipliers, metrics, fallback_baseline
+        )
+        yield calculate_scenario_bankruptcies(metrics)
+
+
+# Scenarios are evaluated in batches of this many, so a large matrix doesn't
+# hold (scenarios x positions) intermediates for all of them at once
+SHOCK_MATRIX_BATCH_SIZE = 16
+
+
+def get_shock_matrix_df(
+    slot: int,
+    drift_client: DriftClient,
+    vat: Vat,
+    scenarios: list[dict],
+    batch_size: int = SHOCK_MATRIX_BATCH_SIZE,
+):
+    """
+    Bankruptcies for a matrix of custom scenarios, see `get_scenario_multipliers`.
+
+    Users are decoded and the unshocked baseline computed once for the whole
+    matrix, so each extra scenario only costs one vectorized pass.
+    """
+    arrays = build_price_shock_arrays(drift_client, vat.users)
+    oracle_multipliers = np.vstack(
+        [
+            np.ones((1, len(arrays.oracle_ids))),
+            get_scenario_multipliers(drift_client, arrays.oracle_ids, scenarios),
+        ]
+    )
+    print(
+        f"Evaluating {len(scenarios)} custom price shock scenarios over "
+        f"{arrays.n_users} users in batches of {batch_size}"
+    )
+
+    total_bankruptcies = []
+    spot_bankruptcies = []
+    batches = (
+        oracle_multipliers[start : start + batch_size]
+        for start in range(0, len(oracle_multipliers), batch_size)
+    )
+    for total, spot in iter_scenario_bankruptcies(drift_client, arrays, batches):
+        total_bankruptcies.extend(total.tolist())
+        spot_bankruptcies.extend(spot.tolist())
+
+    df_plot = pd.DataFrame(
+        {
+            "Scenario": ["baseline"]
+            + [
+                scenario.get("name") or f"scenario {i}"
+                for i, scenario in enumerate(scenarios)
+            ],
+            "Total Bankruptcy ($)": total_bankruptcies,
+            "Spot Bankruptcy ($)": spot_bankruptcies,
+        }
+    )
+    df_plot["Perpetual Bankruptcy ($)"] = (
+        df_plot["Total Bankruptcy ($)"] - df_plot["Spot Bankruptcy ($)"]
+    )
+
+    return {
+        "slot": slot,
+        "result": df_plot.to_json(),
+    }
+
+
+MONTE_CARLO_CONFIDENCE_LEVELS = [0.95, 0.99, 0.999]
+MONTE_CARLO_HISTOGRAM_BINS = 50
+
+
+def get_covariance_factor(covariance: np.ndarray) -> np.ndarray:
+    """
+    Matrix `L` with `L @ L.T == covariance`. Unlike a Cholesky factor this also
+    works for singular covariances, e.g. two perfectly correlated assets.
+    """
+    if covariance.ndim != 2 or covariance.shape[0] != covariance.shape[1]:
+        raise ValueError("Covariance must be a square matrix")
+    if not np.allclose(covariance, covariance.T):
+        raise ValueError("Covariance must be symmetric")
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    if eigenvalues.min(initial=0) < -1e-10 * max(1, np.abs(eigenvalues).max(initial=0)):
+        raise ValueError("Covariance must be positive semi-definite")
+    return eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+
+
+def calculate_tail_risk(
+    bankruptcies: np.ndarray, confidence_levels: list[float]
+) -> tuple[list[float], list[float]]:
+    """
+    Value at risk and expected shortfall of the sampled bankruptcies.
+    """
+    value_at_risk = np.quantile(bankruptcies, confidence_levels)
+    expected_shortfall = [
+        bankruptcies[bankruptcies >= var].mean() for var in value_at_risk
+    ]
+    return value_at_risk.tolist(), expected_shortfall
+
+
+def get_monte_carlo_price_shock(
+    slot: int,
+    drift_client: DriftClient,
+    vat: Vat,
+    covariance: list[list[float]],
+    oracle_ids: Optional[list[str]] = None,
+    spot_markets: Optional[list[int]] = None,
+    perp_markets: Optional[list[int]] = None,
+    n_samples: int = 10_000,
+    seed: int = 0,
+    confidence_levels: Optional[list[float]] = None,
+    batch_size: int = SHOCK_MATRIX_BATCH_SIZE,
+):
+    """
+    Sample joint oracle log-returns from N(0, covariance) and report the
+    bankruptcy distribution with its VaR and expected shortfall.
+
+    Rows and columns of `covariance` follow `oracle_ids`, then the oracles of
+    `spot_markets`, then those of `perp_markets`. Oracles not listed keep their
+    current price. Only the three bankruptcy totals of each sample are kept, so
+    memory does not grow with users times samples.
+    """
+    confidence_levels = confidence_levels or MONTE_CARLO_CONFIDENCE_LEVELS
+    if not all(0 < level < 1 for level in confidence_levels):
+        raise ValueError("Confidence levels must be between 0 and 1")
+
+    shocked_oracles = (
+        list(oracle_ids or [])
+        + [get_spot_oracle_id(drift_client, i) for i in spot_markets or []]
+        + [get_perp_oracle_id(drift_client, i) for i in perp_markets or []]
+    )
+    if len(set(shocked_oracles)) != len(shocked_oracles):
+        raise ValueError("Each oracle can only be listed once")
+    factor = get_covariance_factor(np.asarray(covariance, dtype=float))
+    if len(factor) != len(shocked_oracles):
+        raise ValueError(
+            f"Covariance is {len(factor)}x{len(factor)} "
+            f"but {len(shocked_oracles)} oracles are shocked"
+        )
+
+    arrays = build_price_shock_arrays(drift_client, vat.users)
+    oracle_index = {oracle_id: i for i, oracle_id in enumerate(arrays.oracle_ids)}
+    unknown = [
+        oracle_id for oracle_id in shocked_oracles if oracle_id not in oracle_index
+    ]
+    if unknown:
+        raise ValueError(f"Unknown oracles {unknown}")
+    columns = [oracle_index[oracle_id] for oracle_id in shocked_oracles]
+    print(
+        f"Sampling {n_samples} price shock scenarios over {len(columns)} oracles "
+        f"and {arrays.n_users} users"
+    )
+
+    rng = np.random.default_rng(seed)
+
+    def sample_batches() -> Iterator[np.ndarray]:
+        yield np.ones((1, len(arrays.oracle_ids)))
+        for start in range(0, n_samples, batch_size):
+            size = min(batch_size, n_samples - start)
+            log_returns = rng.standard_normal((size, len(columns))) @ factor.T
+            oracle_multipliers = np.ones((size, len(arrays.oracle_ids)))
+            oracle_multipliers[:, columns] = np.exp(log_returns)
+            yield oracle_multipliers
+
+    batches = iter_scenario_bankruptcies(drift_client, arrays, sample_batches())
+    baseline_total, baseline_spot = next(batches)
+    total_bankruptcies = np.empty(n_samples)
+    spot_bankruptcies = np.empty(n_samples)
+    start = 0
+    for total, spot in batches:
+        total_bankruptcies[start : start + len(total)] = total
+        spot_bankruptcies[start : start + len(spot)] = spot
+        start += len(total)
+
+    bankruptcies = {
+        "Total Bankruptcy ($)": total_bankruptcies,
+        "Spot Bankruptcy ($)": spot_bankruptcies,
+        "Perpetual Bankruptcy ($)": total_bankruptcies - spot_bankruptcies,
+    }
+    df_risk = pd.DataFrame({"Confidence": confidence_levels})
+    for name, values in bankruptcies.items():
+        kind = name.removesuffix(" Bankruptcy ($)")
+        value_at_risk, expected_shortfall = calculate_tail_risk(
+            values, confidence_levels
+        )
+        df_risk[f"{kind} VaR ($)"] = value_at_risk
+        df_risk[f"{kind} ES ($)"] = expected_shortfall
+
+    counts, bin_edges = np.histogram(
+        total_bankruptcies, bins=MONTE_CARLO_HISTOGRAM_BINS
+    )
+
+    return {
+        "slot": slot,
+        "n_samples": n_samples,
+        "seed": seed,
+        "shocked_oracles": shocked_oracles,
+        "baseline": {
+            "Total Bankruptcy ($)": float(baseline_total[0]),
+            "Spot Bankruptcy ($)": float(baseline_spot[0]),
+            "Perpetual Bankruptcy ($)": float(baseline_total[0] - baseline_spot[0]),
+        },
+        "mean": {name: float(values.mean()) for name, values in bankruptcies.items()},
+        "result": df_risk.to_json(),
+        "distribution": {
+            "bin_edges": bin_edges.tolist(),
+            "counts": counts.tolist(),
+        },
     }
@@ -0,0 +1,280 @@
+import os
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+from driftpy.drift_client import DriftClient
+from driftpy.pickle.vat import Vat
+
+from backend.utils.price_shock import (
+    SHOCK_MATRIX_BATCH_SIZE,
+    calculate_scenario_bankruptcies,
+    generate_oracle_moves,
+)
+from backend.utils.user_metrics import (
+    calculate_leverages_for_price_shock,
+    get_skipped_oracles,
+)
+from backend.utils.vectorized_price_shock import (
+    PRICE_SHOCK_COLUMNS,
+    build_price_shock_arrays,
+    evaluate_fallback_users,
+    evaluate_price_shock,
+)
+from shared.types import PriceShockAssetGroup
+
+# Every 1% between -100% and +100%, which covers all the oracle_distortion x
+# n_scenarios combinations we generate exactly. Users that go through driftpy
+# (see `needs_fallback`) are evaluated once per level, so keep this coarse.
+SHOCK_SURFACE_STEP = 0.01
+SHOCK_SURFACE_MAX_MOVE = 1.0
+
+
+@dataclass
+class ShockSurface:
+    """
+    Total and spot bankruptcy of one snapshot at every level of a uniform
+    oracle shock on a fine grid, for one asset group.
+    """
+
+    slot: int
+    asset_group: PriceShockAssetGroup
+    distorted_oracles: list[str]
+    levels: np.ndarray
+    total_bankruptcy: np.ndarray
+    spot_bankruptcy: np.ndarray
+
+
+def get_shock_surface_levels(
+    step: float = SHOCK_SURFACE_STEP, max_move: float = SHOCK_SURFACE_MAX_MOVE
+) -> np.ndarray:
+    n_steps = int(round(max_move / step))
+    return np.arange(-n_steps, n_steps + 1) * step
+
+
+def get_level_key(level: float) -> float:
+    # Grid levels and requested moves only need to agree up to float noise
+    return round(float(level), 6)
+
+
+def compute_shock_surface(
+    slot: int,
+    drift_client: DriftClient,
+    vat: Vat,
+    asset_group: PriceShockAssetGroup,
+    user_levels: Iterable[float] = (),
+    step: float = SHOCK_SURFACE_STEP,
+    max_move: float = SHOCK_SURFACE_MAX_MOVE,
+    batch_size: int = SHOCK_MATRIX_BATCH_SIZE,
+) -> tuple[ShockSurface, dict[float, dict]]:
+    """
+    Evaluate every level of the grid once, in vectorized batches.
+
+    Per-user metrics are only kept for `user_levels`, which must lie on the
+    grid, so the per-user frames of any scenario set built from those levels
+    come out of the same pass.
+    """
+    levels = get_shock_surface_levels(step, max_move)
+    level_keys = [get_level_key(level) for level in levels]
+    kept_levels = {get_level_key(level) for level in user_levels}
+    off_grid = kept_levels - set(level_keys)
+    if off_grid:
+        raise ValueError(f"Levels {sorted(off_grid)} are not on the surface grid")
+
+    arrays = build_price_shock_arrays(drift_client, vat.users)
+    skipped_oracles = get_skipped_oracles(asset_group)
+    distorted = ~np.isin(np.array(arrays.oracle_ids, dtype=object), skipped_oracles)
+    print(
+        f"Computing {len(levels)} level shock surface for {asset_group.value} "
+        f"over {arrays.n_users} users"
+    )
+
+    fallback_baseline = calculate_leverages_for_price_shock(
+        [arrays.users[i] for i in arrays.fallback_users], None
+    )
+    user_keys = [user.user_public_key for user in arrays.users]
+    total_bankruptcy = np.empty(len(levels))
+    spot_bankruptcy = np.empty(len(levels))
+    user_metrics: dict[float, dict] = {}
+    for start in range(0, len(levels), batch_size):
+        batch_levels = levels[start : start + batch_size]
+        oracle_multipliers = np.where(
+            distorted, np.maximum(1 + batch_levels[:, None], 0), 1.0
+        )
+        metrics = evaluate_price_shock(arrays, oracle_multipliers)
+        evaluate_fallback_users(
+            drift_client, arrays, oracle_multipliers, metrics, fallback_baseline
+        )
+        total, spot = calculate_scenario_bankruptcies(metrics)
+        total_bankruptcy[start : start + len(batch_levels)] = total
+        spot_bankruptcy[start : start + len(batch_levels)] = spot
+
+        for row, level_key in enumerate(level_keys[start : start + batch_size]):
+            if level_key in kept_levels:
+                user_metrics[level_key] = {
+                    "user_key": user_keys,
+                    **{key: metrics[key][row] for key in PRICE_SHOCK_COLUMNS[1:]},
+                }
+
+    surface = ShockSurface(
+        slot=slot,
+        asset_group=asset_group,
+        distorted_oracles=[
+            oracle_id
+            for oracle_id, is_distorted in zip(arrays.oracle_ids, distorted)
+            if is_distorted
+        ],
+        levels=levels,
+        total_bankruptcy=total_bankruptcy,
+        spot_bankruptcy=spot_bankruptcy,
+    )
+    return surface, user_metrics
+
+
+def get_surface_scenario_levels(
+    oracle_distortion: float, n_scenarios: int
+) -> list[float]:
+    return [
+        get_level_key(move / 100)
+        for move in generate_oracle_moves(n_scenarios, oracle_distortion)
+    ]
+
+
+def get_user_leverages_from_surface(
+    surface: ShockSurface,
+    user_metrics: dict[float, dict],
+    user_keys: list[str],
+    oracle_distortion: float,
+    n_scenarios: int,
+):
+    """
+    Same response as `get_user_leverages_for_price_shock`, assembled from the
+    per-user metrics kept by `compute_shock_surface`.
+    """
+    scenarios = [
+        user_metrics[get_level_key(oracle_distortion * (i + 1) * sign)]
+        for sign in (1, -1)
+        for i in range(n_scenarios)
+    ]
+    return {
+        "slot": surface.slot,
+        "leverages_none": user_metrics[get_level_key(0)],
+        "leverages_up": tuple(scenarios[:n_scenarios]),
+        "leverages_down": tuple(scenarios[n_scenarios:]),
+        "user_keys": user_keys,
+        "distorted_oracles": surface.distorted_oracles,
+    }
+
+
+def lookup_price_shock_result(
+    surface: ShockSurface, oracle_distortion: float, n_scenarios: int
+) -> pd.DataFrame:
+    """
+    The `result` frame of `get_price_shock_df`, read off the surface. Exact on
+    grid levels and linearly interpolated in between. Moves below -100% are
+    the same as -100%, since prices floor at zero.
+    """
+    oracle_moves = generate_oracle_moves(n_scenarios, oracle_distortion)
+    shock_levels = np.array(oracle_moves) / 100
+    if shock_levels.max() > surface.levels[-1] + 1e-9:
+        raise ValueError(
+            f"Shock of {shock_levels.max():.0%} is beyond the surface's "
+            f"{surface.levels[-1]:.0%}"
+        )
+
+    total = np.interp(shock_levels, surface.levels, surface.total_bankruptcy)
+    spot = np.interp(shock_levels, surface.levels, surface.spot_bankruptcy)
+    df_plot = pd.DataFrame(
+        {
+            "Oracle Move (%)": oracle_moves,
+            "Total Bankruptcy ($)": total,
+            "Spot Bankruptcy ($)": spot,
+        }
+    )
+    df_plot = df_plot.sort_values("Oracle Move (%)")
+    df_plot["Perpetual Bankruptcy ($)"] = (
+        df_plot["Total Bankruptcy ($)"] - df_plot["Spot Bankruptcy ($)"]
+    )
+    return df_plot
+
+
+def get_shock_surface_path(pickle_path: str, asset_group: PriceShockAssetGroup) -> str:
+    file_name = f"shock_surface_{asset_group.value.replace(' ', '_')}.npz"
+    return os.path.join(pickle_path, file_name)
+
+
+def save_shock_surface(surface: ShockSurface, pickle_path: str):
+    """
+    Store the surface next to the snapshot it was computed from.
+    """
+    path = get_shock_surface_path(pickle_path, surface.asset_group)
+    # Write then rename, so a backend never loads a partially written surface
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(
+        tmp_path,
+        slot=surface.slot,
+        distorted_oracles=np.array(surface.distorted_oracles, dtype=str),
+        levels=surface.levels,
+        total_bankruptcy=surface.total_bankruptcy,
+        spot_bankruptcy=surface.spot_bankruptcy,
+    )
+    os.replace(tmp_path, path)
+
+
+_loaded_surfaces: dict[tuple[str, PriceShockAssetGroup], ShockSurface] = {}
+
+
+def load_shock_surface(
+    pickle_path: str, asset_group: PriceShockAssetGroup
+) -> Optional[ShockSurface]:
+    """
+    The surface generated for this snapshot, if there is one yet.
+    """
+    key = (pickle_path, asset_group)
+    if key in _loaded_surfaces:
+        return _loaded_surfaces[key]
+
+    path = get_shock_surface_path(pickle_path, asset_group)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        surface = ShockSurface(
+            slot=int(data["slot"]),
+            asset_group=asset_group,
+            distorted_oracles=data["distorted_oracles"].tolist(),
+            levels=data["levels"],
+            total_bankruptcy=data["total_bankruptcy"],
+            spot_bankruptcy=data["spot_bankruptcy"],
+        )
+    # Surfaces of older snapshots are never asked for again
+    for loaded_key in list(_loaded_surfaces):
+        if loaded_key[0] != pickle_path:
+            del _loaded_surfaces[loaded_key]
+    _loaded_surfaces[key] = surface
+    return surface
+
+
+def get_price_shock_frames_from_surface(
+    pickle_path: str,
+    asset_group: PriceShockAssetGroup,
+    oracle_distortion: float,
+    n_scenarios: int,
+) -> Optional[dict]:
+    """
+    The scenario table of `get_price_shock_df` without recomputing anything,
+    or None if the snapshot has no surface covering these scenarios.
+    """
+    surface = load_shock_surface(pickle_path, asset_group)
+    if surface is None:
+        return None
+    try:
+        result = lookup_price_shock_result(surface, oracle_distortion, n_scenarios)
+    except ValueError as e:
+        print(f"Not using shock surface: {e}")
+        return None
+    return {
+        "slot": surface.slot,
+        "result": result,
+        "distorted_oracles": surface.distorted_oracles,
+    }
@@ -1,9 +1,11 @@
 import copy
-import functools
 from typing import List, Optional
 
-from driftpy.accounts.cache import DriftClientCache
-from driftpy.constants.numeric_constants import MARGIN_PRECISION, QUOTE_PRECISION
+from driftpy.constants.numeric_constants import (
+    MARGIN_PRECISION,
+    QUOTE_PRECISION,
+    QUOTE_SPOT_MARKET_INDEX,
+)
 from driftpy.constants.perp_markets import mainnet_perp_market_configs
 from driftpy.constants.spot_markets import mainnet_spot_market_configs
 from driftpy.drift_client import DriftClient
@@ -13,9 +15,85 @@ from driftpy.oracles.oracle_id import get_oracle_id
 from driftpy.types import OraclePriceData
 from driftpy.user_map.user_map import UserMap
 
+from backend.utils.metrics_cache import snapshot_cached
 from shared.types import PriceShockAssetGroup
 
 
+def unwrap_oracle_price_data(oracle_price_data) -> OraclePriceData:
+    """
+    The oracle cache holds either `OraclePriceData` or `DataAndSlot` wrappers.
+    """
+    if isinstance(oracle_price_data, OraclePriceData):
+        return oracle_price_data
+    return oracle_price_data.data
+
+
+class OracleOverlay:
+    """
+    Read-through view of a `DriftClient` with some oracle prices overridden.
+
+    Only the overridden oracles are stored, everything else is served by the
+    base client, whose cache is never touched. Bind users to the overlay with
+    `bind` to run margin calculations against the shocked prices.
+    """
+
+    def __init__(
+        self,
+        drift_client: DriftClient,
+        oracle_price_data: dict[str, OraclePriceData],
+    ):
+        self.drift_client = drift_client
+        self.oracle_price_data = oracle_price_data
+
+    @classmethod
+    def with_multipliers(
+        cls, drift_client: DriftClient, multipliers: dict[str, float]
+    ) -> "OracleOverlay":
+        base_oracles = drift_client.account_subscriber.cache["oracle_price_data"]
+        oracle_price_data = {}
+        for oracle_id, multiplier in multipliers.items():
+            shocked = copy.copy(unwrap_oracle_price_data(base_oracles[oracle_id]))
+            shocked.price *= multiplier
+            oracle_price_data[oracle_id] = shocked
+        return cls(drift_client, oracle_price_data)
+
+    def __getattr__(self, name):
+        return getattr(self.drift_client, name)
+
+    def get_oracle_price_data(self, oracle_id: str) -> Optional[OraclePriceData]:
+        if oracle_id in self.oracle_price_data:
+            return self.oracle_price_data[oracle_id]
+        return self.drift_client.get_oracle_price_data(oracle_id)
+
+    def get_oracle_price_data_for_perp_market(
+        self, market_index: int
+    ) -> Optional[OraclePriceData]:
+        market = self.drift_client.get_perp_market_account(market_index)
+        if market is not None:
+            oracle_id = get_oracle_id(market.amm.oracle, market.amm.oracle_source)
+            if oracle_id in self.oracle_price_data:
+                return self.oracle_price_data[oracle_id]
+        return self.drift_client.get_oracle_price_data_for_perp_market(market_index)
+
+    def get_oracle_price_data_for_spot_market(
+        self, market_index: int
+    ) -> Optional[OraclePriceData]:
+        market = self.drift_client.get_spot_market_account(market_index)
+        if market is not None:
+            oracle_id = get_oracle_id(market.oracle, market.oracle_source)
+            if oracle_id in self.oracle_price_data:
+                return self.oracle_price_data[oracle_id]
+        return self.drift_client.get_oracle_price_data_for_spot_market(market_index)
+
+    def bind(self, user: DriftUser) -> DriftUser:
+        """
+        Returns a shallow copy of the user that reads oracles through this overlay.
+        """
+        bound_user = copy.copy(user)
+        bound_user.drift_client = self
+        return bound_user
+
+
 def get_init_health(user: DriftUser):
     """
     Returns the initial health of the user.
@@ -41,6 +119,14 @@ def combine_asset_liability(asset_liability_tuple):
 
 
 def get_collateral_composition(user: DriftUser, margin_category, num_markets: int):
+    """
+    Net value of each spot market the user holds, plus the quote market, which
+    also carries the quote side of open orders. Other markets are left out:
+    all they would show is the open order margin of the held ones.
+    """
+    market_indexes = {QUOTE_SPOT_MARKET_INDEX} | {
+        position.market_index for position in user.get_active_spot_positions()
+    }
     spot_market_net_values = {
         market_index: combine_asset_liability(
             user.get_spot_market_asset_and_liability_value(
@@ -48,23 +134,31 @@ def get_collateral_composition(user: DriftUser, margin_category, num_markets: in
             )
         )
         / QUOTE_PRECISION
-        for market_index in range(num_markets)
+        for market_index in sorted(market_indexes)
+        if market_index < num_markets
     }
     return spot_market_net_values
 
 
 def get_perp_liab_composition(user: DriftUser, margin_category, num_markets: int):
+    """
+    Signed liability of each perp market the user has a position in.
+    """
+    market_indexes = {
+        position.market_index for position in user.get_active_perp_positions()
+    }
     perp_net_liabilities = {
         market_index: user.get_perp_market_liability(
             market_index, margin_category, signed=True
         )
         / QUOTE_PRECISION
-        for market_index in range(num_markets)
+        for market_index in sorted(market_indexes)
+        if market_index < num_markets
     }
     return perp_net_liabilities
 
 
-@functools.cache
+@snapshot_cached
 def get_stable_metrics(x: DriftUser):
     unrealized_pnl = x.get_unrealized_pnl(True)
     net_spot_market_value = x.get_net_spot_market_value(None)
@@ -78,59 +172,61 @@ def get_stable_metrics(x: DriftUser):
     }
 
 
-def get_user_metrics_for_asset_liability(
+def get_health_for_asset_liability(
+    x: DriftUser, margin_category: MarginCategory | None
+) -> int:
+    if margin_category == MarginCategory.INITIAL:
+        return get_init_health(x)
+    return x.get_health()
+
+
+def get_category_metrics_for_asset_liability(
     x: DriftUser,
     margin_category: MarginCategory | None,
 ):
     """
-    Returns a dictionary of the user's health, leverage, and other metrics.
+    The user's asset-liability metrics that are weighted by the margin
+    category.
     """
-
     asset_value, liability_value = x.get_spot_market_asset_and_liability_value(
         None, margin_category
     )
-    asset_value = asset_value / QUOTE_PRECISION
-    liability_value = liability_value / QUOTE_PRECISION
-
-    perp_liability = (
-        x.get_total_perp_position_liability(margin_category) / QUOTE_PRECISION
-    )
-
-    metrics_stable = get_stable_metrics(x)
-    metrics_unstable = {
-        "perp_liability": perp_liability,
-        "spot_asset": asset_value,
-        "spot_liability": liability_value,
+    NUMBER_OF_SPOT = len(mainnet_spot_market_configs)
+    NUMBER_OF_PERP = len(mainnet_perp_market_configs)
+    return {
+        "perp_liability": x.get_total_perp_position_liability(margin_category)
+        / QUOTE_PRECISION,
+        "spot_asset": asset_value / QUOTE_PRECISION,
+        "spot_liability": liability_value / QUOTE_PRECISION,
+        "net_v": get_collateral_composition(x, margin_category, NUMBER_OF_SPOT),
+        "net_p": get_perp_liab_composition(x, margin_category, NUMBER_OF_PERP),
     }
 
-    metrics = {
+
+def combine_asset_liability_metrics(
+    metrics_stable: dict, metrics_category: dict, health: int
+):
+    return {
         **metrics_stable,
-        **metrics_unstable,
+        "perp_liability": metrics_category["perp_liability"],
+        "spot_asset": metrics_category["spot_asset"],
+        "spot_liability": metrics_category["spot_liability"],
+        "health": health,
+        "net_v": metrics_category["net_v"],
+        "net_p": metrics_category["net_p"],
     }
 
-    if margin_category == MarginCategory.INITIAL:
-        metrics["health"] = get_init_health(x)
-    else:
-        metrics["health"] = x.get_health()
-
-    NUMBER_OF_SPOT = len(mainnet_spot_market_configs)
-    NUMBER_OF_PERP = len(mainnet_perp_market_configs)
-    metrics["net_v"] = get_collateral_composition(x, margin_category, NUMBER_OF_SPOT)
-    metrics["net_p"] = get_perp_liab_composition(x, margin_category, NUMBER_OF_PERP)
-
-    return metrics
-
 
 def get_user_metrics_for_price_shock(
     x: DriftUser,
     margin_category: MarginCategory | None,
-    oracle_cache: Optional[DriftClientCache] = None,
+    oracle_overlay: Optional[OracleOverlay] = None,
 ):
     """
     Returns a dictionary of the user's health, leverage, and other metrics.
     """
-    if oracle_cache is not None:
-        x.drift_client.account_subscriber.cache = oracle_cache
+    if oracle_overlay is not None:
+        x = oracle_overlay.bind(x)
 
     asset_value = x.get_spot_market_asset_value(None, margin_category) / QUOTE_PRECISION
     liability_value = (
@@ -193,66 +289,69 @@ def get_skipped_oracles(asset_group: PriceShockAssetGroup) -> List[str]:
         return []
 
 
-def calculate_leverages_for_asset_liability(
-    user_values: list[DriftUser], maintenance_category: MarginCategory | None
-):
+def get_user_oracles(user: DriftUser) -> set[str]:
     """
-    Calculate the leverages for all users at a given maintenance category
+    Returns the ids of every oracle whose price feeds into the user's margin.
+    """
+    drift_client = user.drift_client
+    oracles = set()
+    for position in user.get_active_spot_positions():
+        market = drift_client.get_spot_market_account(position.market_index)
+        oracles.add(get_oracle_id(market.oracle, market.oracle_source))
+
+    perp_positions = user.get_active_perp_positions()
+    if perp_positions:
+        # perp pnl and margin are converted at the quote oracle price
+        quote_market = drift_client.get_spot_market_account(QUOTE_SPOT_MARKET_INDEX)
+        oracles.add(get_oracle_id(quote_market.oracle, quote_market.oracle_source))
+    for position in perp_positions:
+        market = drift_client.get_perp_market_account(position.market_index)
+        oracles.add(get_oracle_id(market.amm.oracle, market.amm.oracle_source))
+    return oracles
+
+
+def get_exposed_user_indices(
+    user_values: list[DriftUser], distorted_oracles: list[str]
+) -> list[int]:
     """
+    Indices of the users holding anything priced by one of the distorted oracles.
+
+    Every other user has the same metrics in a shocked scenario as in the baseline.
+    """
+    distorted = set(distorted_oracles)
     return [
-        get_user_metrics_for_asset_liability(x, maintenance_category)
-        for x in user_values
+        i
+        for i, user in enumerate(user_values)
+        if not get_user_oracles(user).isdisjoint(distorted)
     ]
 
 
+def merge_with_baseline(
+    baseline: list[dict], exposed: list[int], shocked: list[dict]
+) -> list[dict]:
+    """
+    Baseline metrics with the recomputed exposed users swapped in.
+    """
+    leverages = list(baseline)
+    for user_idx, metrics in zip(exposed, shocked):
+        leverages[user_idx] = metrics
+    return leverages
+
+
 def calculate_leverages_for_price_shock(
     user_values: list[DriftUser],
     maintenance_category: MarginCategory | None,
-    oracle_cache: Optional[DriftClientCache] = None,
+    oracle_overlay: Optional[OracleOverlay] = None,
 ):
     """
     Calculate the leverages for all users at a given maintenance category
     """
     return [
-        get_user_metrics_for_price_shock(x, maintenance_category, oracle_cache)
+        get_user_metrics_for_price_shock(x, maintenance_category, oracle_overlay)
         for x in user_values
     ]
 
 
-def get_user_metrics_none(user_map: UserMap):
-    user_keys = list(user_map.user_map.keys())
-    user_values = list(user_map.values())
-    metrics_none = calculate_leverages_for_asset_liability(user_values, None)
-    return {
-        "metrics_none": metrics_none,
-        "user_keys": user_keys,
-    }
-
-
-def get_user_metrics_initial(user_map: UserMap):
-    user_keys = list(user_map.user_map.keys())
-    user_values = list(user_map.values())
-    metrics_initial = calculate_leverages_for_asset_liability(
-        user_values, MarginCategory.INITIAL
-    )
-    return {
-        "metrics_initial": metrics_initial,
-        "user_keys": user_keys,
-    }
-
-
-def get_user_metrics_maintenance(user_map: UserMap):
-    user_keys = list(user_map.user_map.keys())
-    user_values = list(user_map.values())
-    metrics_maintenance = calculate_leverages_for_asset_liability(
-        user_values, MarginCategory.MAINTENANCE
-    )
-    return {
-        "metrics_maintenance": metrics_maintenance,
-        "user_keys": user_keys,
-    }
-
-
 def get_user_leverages_for_price_shock(
     slot: int,
     drift_client: DriftClient,
@@ -266,59 +365,46 @@ def get_user_leverages_for_price_shock(
     all_configs = mainnet_spot_market_configs + mainnet_perp_market_configs
 
     print(f"User keys : {len(user_keys)}")
-    new_oracles_dat_up = []
-    new_oracles_dat_down = []
     skipped_oracles = get_skipped_oracles(asset_group)
     print(
         f"Skipping {len(skipped_oracles)} oracles (from a total of {len(all_configs)}) for asset group {asset_group}"
     )
 
-    for i in range(scenarios):
-        new_oracles_dat_up.append({})
-        new_oracles_dat_down.append({})
-
-    distorted_oracles = []
-    cache_up = copy.deepcopy(drift_client.account_subscriber.cache)
-    cache_down = copy.deepcopy(drift_client.account_subscriber.cache)
-
-    for key, val in drift_client.account_subscriber.cache["oracle_price_data"].items():
-        for i in range(scenarios):
-            new_oracles_dat_up[i][key] = copy.deepcopy(val)
-            new_oracles_dat_down[i][key] = copy.deepcopy(val)
-        if key in skipped_oracles:
-            continue
-
-        distorted_oracles.append(key)
-        for i in range(scenarios):
-            oracle_distort_up = max(1 + oracle_distortion * (i + 1), 1)
-            oracle_distort_down = max(1 - oracle_distortion * (i + 1), 0)
-
-            if isinstance(new_oracles_dat_up[i][key], OraclePriceData):
-                new_oracles_dat_up[i][key].price *= oracle_distort_up
-                new_oracles_dat_down[i][key].price *= oracle_distort_down
-            else:
-                new_oracles_dat_up[i][key].data.price *= oracle_distort_up
-                new_oracles_dat_down[i][key].data.price *= oracle_distort_down
+    distorted_oracles = [
+        key
+        for key in drift_client.account_subscriber.cache["oracle_price_data"]
+        if key not in skipped_oracles
+    ]
+
+    exposed = get_exposed_user_indices(user_vals, distorted_oracles)
+    exposed_users = [user_vals[i] for i in exposed]
+    print(f"Recomputing {len(exposed)} users exposed to the distorted oracles")
 
     leverages_none = calculate_leverages_for_price_shock(user_vals, None)
     leverages_up = []
     leverages_down = []
 
     for i in range(scenarios):
-        cache_up["oracle_price_data"] = new_oracles_dat_up[i]
-        cache_down["oracle_price_data"] = new_oracles_dat_down[i]
+        oracle_distort_up = max(1 + oracle_distortion * (i + 1), 1)
+        oracle_distort_down = max(1 - oracle_distortion * (i + 1), 0)
+        overlay_up = OracleOverlay.with_multipliers(
+            drift_client, {key: oracle_distort_up for key in distorted_oracles}
+        )
+        overlay_down = OracleOverlay.with_multipliers(
+            drift_client, {key: oracle_distort_down for key in distorted_oracles}
+        )
         leverages_up_i = calculate_leverages_for_price_shock(
-            user_vals,
-            None,
-            cache_up,
+            exposed_users, None, overlay_up
         )
         leverages_down_i = calculate_leverages_for_price_shock(
-            user_vals,
-            None,
-            cache_down,
+            exposed_users, None, overlay_down
+        )
+        leverages_up.append(
+            merge_with_baseline(leverages_none, exposed, leverages_up_i)
+        )
+        leverages_down.append(
+            merge_with_baseline(leverages_none, exposed, leverages_down_i)
         )
-        leverages_up.append(leverages_up_i)
-        leverages_down.append(leverages_down_i)
 
     return {
         "slot": slot,
@@ -0,0 +1,256 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from driftpy.constants.numeric_constants import MARGIN_PRECISION, QUOTE_PRECISION
+from driftpy.drift_user import DriftUser
+from driftpy.math.margin import MarginCategory
+from driftpy.pickle.vat import Vat
+
+from backend.utils.margin_calculator import (
+    build_margin_arrays,
+    calculate_margin_metrics,
+)
+from backend.utils.position_store import PositionStore
+from backend.utils.waiting_for import waiting_for
+
+# "vectorized" computes margin for all users at once and only asks driftpy
+# about the users it can't price; "driftpy" asks driftpy about everyone
+MARGIN_ENGINE = os.getenv("MARGIN_ENGINE", "vectorized")
+
+FLOAT_COLUMNS = [
+    "total_collateral_initial",
+    "total_collateral_maintenance",
+    "margin_requirement_initial",
+    "margin_requirement_maintenance",
+    "leverage",
+    "upnl",
+    "net_usd_value",
+    "spot_asset",
+    "spot_liability",
+    "perp_liability",
+    "settled_perp_pnl",
+]
+
+
+@dataclass
+class UserMetricsTable:
+    """
+    Core metrics of every user in one snapshot, one array per metric, in
+    `vat.users` order. Values are in QUOTE_PRECISION units (i.e. dollars).
+
+    Users whose metrics couldn't be computed have `valid` False and NaN
+    values.
+    """
+
+    snapshot_id: str
+    users: list[DriftUser]
+    user_keys: list[str]
+    rows_by_key: dict[str, int]
+    valid: np.ndarray
+    is_being_liquidated: np.ndarray
+    is_high_leverage: np.ndarray
+    total_collateral_initial: np.ndarray
+    total_collateral_maintenance: np.ndarray
+    margin_requirement_initial: np.ndarray
+    margin_requirement_maintenance: np.ndarray
+    health: np.ndarray
+    init_health: np.ndarray
+    leverage: np.ndarray
+    upnl: np.ndarray
+    net_usd_value: np.ndarray
+    spot_asset: np.ndarray
+    spot_liability: np.ndarray
+    perp_liability: np.ndarray
+    settled_perp_pnl: np.ndarray
+
+
+def calculate_health(
+    is_being_liquidated: bool, total_collateral: int, margin_requirement: int
+) -> int:
+    """
+    `DriftUser.get_health` from its components.
+    """
+    if is_being_liquidated:
+        return 0
+    if margin_requirement == 0 and total_collateral >= 0:
+        return 100
+    elif total_collateral <= 0:
+        return 0
+    return round(min(100, max(0, (1 - margin_requirement / total_collateral) * 100)))
+
+
+def get_user_metrics_row(user: DriftUser) -> dict:
+    is_being_liquidated = user.is_being_liquidated()
+    collateral = {
+        category: user.get_total_collateral(category)
+        for category in (MarginCategory.INITIAL, MarginCategory.MAINTENANCE)
+    }
+    margin_requirement = {
+        category: user.get_margin_requirement(category)
+        for category in (MarginCategory.INITIAL, MarginCategory.MAINTENANCE)
+    }
+    unrealized_pnl = user.get_unrealized_pnl(True)
+    asset_value, liability_value = user.get_spot_market_asset_and_liability_value(
+        None, None
+    )
+    return {
+        "is_being_liquidated": is_being_liquidated,
+        "is_high_leverage": user.is_high_leverage_mode(),
+        "total_collateral_initial": collateral[MarginCategory.INITIAL]
+        / QUOTE_PRECISION,
+        "total_collateral_maintenance": collateral[MarginCategory.MAINTENANCE]
+        / QUOTE_PRECISION,
+        "margin_requirement_initial": margin_requirement[MarginCategory.INITIAL]
+        / QUOTE_PRECISION,
+        "margin_requirement_maintenance": margin_requirement[MarginCategory.MAINTENANCE]
+        / QUOTE_PRECISION,
+        "health": calculate_health(
+            is_being_liquidated,
+            collateral[MarginCategory.MAINTENANCE],
+            margin_requirement[MarginCategory.MAINTENANCE],
+        ),
+        "init_health": calculate_health(
+            is_being_liquidated,
+            collateral[MarginCategory.INITIAL],
+            margin_requirement[MarginCategory.INITIAL],
+        ),
+        "leverage": user.get_leverage() / MARGIN_PRECISION,
+        "upnl": unrealized_pnl / QUOTE_PRECISION,
+        "net_usd_value": (asset_value - liability_value + unrealized_pnl)
+        / QUOTE_PRECISION,
+        "spot_asset": asset_value / QUOTE_PRECISION,
+        "spot_liability": liability_value / QUOTE_PRECISION,
+        "perp_liability": user.get_total_perp_position_liability(None)
+        / QUOTE_PRECISION,
+        "settled_perp_pnl": user.get_user_account().settled_perp_pnl / QUOTE_PRECISION,
+    }
+
+
+def get_vectorized_columns(
+    vat: Vat, users: list[DriftUser], store: PositionStore
+) -> tuple[dict[str, np.ndarray], np.ndarray]:
+    """
+    Table columns from the vectorized margin calculator, and the users it
+    can't price, whose rows have to come from driftpy.
+    """
+    arrays = build_margin_arrays(vat.drift_client, users, store)
+    metrics = calculate_margin_metrics(arrays)
+    columns = {
+        key: metrics[key] / QUOTE_PRECISION
+        for key in FLOAT_COLUMNS
+        if key in metrics and key != "leverage"
+    }
+    columns["leverage"] = metrics["leverage"] / MARGIN_PRECISION
+    columns["net_usd_value"] = (
+        metrics["spot_asset"] - metrics["spot_liability"] + metrics["upnl"]
+    ) / QUOTE_PRECISION
+    columns["settled_perp_pnl"] = (
+        np.array(
+            [user.get_user_account().settled_perp_pnl for user in users], dtype=float
+        )
+        / QUOTE_PRECISION
+    )
+    columns["is_being_liquidated"] = arrays.being_liquidated
+    columns["is_high_leverage"] = np.array(
+        [user.is_high_leverage_mode() for user in users], dtype=bool
+    )
+    columns["health"] = metrics["health"]
+    columns["init_health"] = metrics["init_health"]
+    return columns, arrays.fallback_users
+
+
+def build_user_metrics_table(
+    snapshot_id: str, vat: Vat, store: Optional[PositionStore] = None
+) -> UserMetricsTable:
+    """
+    With a position store and the vectorized engine, one vectorized pass plus
+    driftpy for the users it can't price. Otherwise one pass over the user
+    map.
+    """
+    users = list(vat.users.values())
+    user_keys = [str(user.user_public_key) for user in users]
+    dtypes = {
+        "is_being_liquidated": bool,
+        "is_high_leverage": bool,
+        "health": np.int64,
+        "init_health": np.int64,
+        **{key: float for key in FLOAT_COLUMNS},
+    }
+
+    columns = None
+    driftpy_users = np.arange(len(users))
+    if MARGIN_ENGINE == "vectorized" and store is not None:
+        try:
+            columns, driftpy_users = get_vectorized_columns(vat, users, store)
+        except Exception as e:
+            print(f"==> Error from vectorized margin [{snapshot_id}] ", e)
+    if columns is None:
+        columns = {
+            key: np.full(len(users), np.nan if dtype is float else 0, dtype=dtype)
+            for key, dtype in dtypes.items()
+        }
+
+    valid = np.ones(len(users), dtype=bool)
+    for i in driftpy_users.tolist():
+        user = users[i]
+        try:
+            row = get_user_metrics_row(user)
+        except Exception as e:
+            print(f"==> Error from user metrics table [{user.user_public_key}] ", e)
+            valid[i] = False
+            for key, dtype in dtypes.items():
+                columns[key][i] = np.nan if dtype is float else 0
+            continue
+        for key in dtypes:
+            columns[key][i] = row[key]
+
+    return UserMetricsTable(
+        snapshot_id=snapshot_id,
+        users=users,
+        user_keys=user_keys,
+        rows_by_key={user_key: i for i, user_key in enumerate(user_keys)},
+        valid=valid,
+        **columns,
+    )
+
+
+# One table at a time, built off the event loop right after a snapshot loads
+_table_executor = ThreadPoolExecutor(max_workers=1)
+_current_table: Optional[tuple[str, Future]] = None
+
+
+def _build_user_metrics_table(
+    snapshot_id: str, vat: Vat, store: Optional[PositionStore]
+) -> UserMetricsTable:
+    with waiting_for(f"user metrics table of {snapshot_id}"):
+        return build_user_metrics_table(snapshot_id, vat, store)
+
+
+def start_user_metrics_table(
+    snapshot_id: str, vat: Vat, store: Optional[PositionStore] = None
+) -> Future:
+    global _current_table
+    future = _table_executor.submit(_build_user_metrics_table, snapshot_id, vat, store)
+    _current_table = (snapshot_id, future)
+    return future
+
+
+def clear_user_metrics_table():
+    global _current_table
+    _current_table = None
+
+
+def get_user_metrics_table(wait: bool = True) -> Optional[UserMetricsTable]:
+    """
+    The table of the loaded snapshot, or None if no snapshot is loaded.
+    Without `wait`, also None while the table is still being built.
+    """
+    if _current_table is None:
+        return None
+    _, future = _current_table
+    if not wait and not future.done():
+        return None
+    return future.result()
@@ -0,0 +1,602 @@
+from dataclasses import dataclass, fields, replace
+from typing import Optional
+
+import numpy as np
+from driftpy.constants.numeric_constants import (
+    AMM_RESERVE_PRECISION,
+    BASE_PRECISION,
+    MARGIN_PRECISION,
+    MAX_PREDICTION_PRICE,
+    OPEN_ORDER_MARGIN_REQUIREMENT,
+    PRICE_PRECISION,
+    QUOTE_PRECISION,
+    QUOTE_SPOT_MARKET_INDEX,
+    SPOT_WEIGHT_PRECISION,
+)
+from driftpy.drift_client import DriftClient
+from driftpy.drift_user import DriftUser
+from driftpy.math.margin import (
+    MarginCategory,
+    calculate_asset_weight,
+    calculate_liability_weight,
+    calculate_market_margin_ratio,
+)
+from driftpy.math.perp_position import (
+    calculate_position_funding_pnl,
+    calculate_worst_case_perp_liability_value,
+)
+from driftpy.math.spot_market import get_signed_token_amount, get_token_amount
+from driftpy.oracles.oracle_id import get_oracle_id
+from driftpy.types import is_variant
+from driftpy.user_map.user_map import UserMap
+
+from backend.utils.user_metrics import (
+    OracleOverlay,
+    calculate_leverages_for_price_shock,
+    get_exposed_user_indices,
+    get_skipped_oracles,
+    merge_with_baseline,
+    unwrap_oracle_price_data,
+)
+from shared.types import PriceShockAssetGroup
+
+PRICE_SHOCK_COLUMNS = [
+    "user_key",
+    "leverage",
+    "upnl",
+    "net_usd_value",
+    "perp_liability",
+    "spot_asset",
+    "spot_liability",
+    "health",
+]
+
+
+@dataclass
+class PriceShockArrays:
+    """
+    Columnar view of every user's spot balances and perp positions.
+
+    Everything that does not depend on the oracle price (token amounts, funding,
+    size-based margin weights) is resolved once with driftpy's own math, so a
+    scenario only has to multiply positions by their shocked oracle price.
+    Users whose margin depends on the price in ways we don't model (lp shares,
+    spot open orders, prediction markets with open orders) are listed in
+    `fallback_users` and evaluated through `DriftUser` instead.
+    """
+
+    users: list[DriftUser]
+    oracle_ids: list[str]
+    oracle_prices: np.ndarray
+    quote_oracle: int
+    being_liquidated: np.ndarray
+    fallback_users: np.ndarray
+
+    spot_user: np.ndarray
+    spot_oracle: np.ndarray
+    spot_token_amount: np.ndarray
+    spot_precision: np.ndarray
+    spot_is_quote: np.ndarray
+    spot_maintenance_weight: np.ndarray
+    spot_open_orders_margin: np.ndarray
+
+    perp_user: np.ndarray
+    perp_oracle: np.ndarray
+    perp_base_asset_amount: np.ndarray
+    perp_worst_case_base_asset_amount: np.ndarray
+    perp_quote_with_funding: np.ndarray
+    perp_is_prediction: np.ndarray
+    perp_expiry_price: np.ndarray
+    perp_maintenance_margin_ratio: np.ndarray
+    perp_open_orders_margin: np.ndarray
+    perp_unrealized_maintenance_weight: np.ndarray
+
+    @property
+    def n_users(self) -> int:
+        return len(self.users)
+
+
+def needs_fallback(user: DriftUser, drift_client: DriftClient) -> bool:
+    """
+    Whether the user holds anything whose margin we can't express as a
+    position times its oracle price.
+    """
+    user_account = user.get_user_account()
+    for position in user_account.spot_positions:
+        if position.open_bids != 0 or position.open_asks != 0:
+            return True
+    for position in user_account.perp_positions:
+        if position.lp_shares != 0:
+            return True
+        if position.open_orders != 0 and is_variant(
+            drift_client.get_perp_market_account(position.market_index).contract_type,
+            "Prediction",
+        ):
+            return True
+    return False
+
+
+def build_price_shock_arrays(
+    drift_client: DriftClient, user_map: UserMap
+) -> PriceShockArrays:
+    """
+    Walk the user map once and pull every spot and perp position into arrays.
+    """
+    oracle_cache = drift_client.account_subscriber.cache["oracle_price_data"]
+    oracle_ids = list(oracle_cache.keys())
+    oracle_index = {oracle_id: i for i, oracle_id in enumerate(oracle_ids)}
+    oracle_prices = np.array(
+        [
+            unwrap_oracle_price_data(oracle_cache[oracle_id]).price
+            for oracle_id in oracle_ids
+        ],
+        dtype=np.float64,
+    )
+
+    spot_market_oracles: dict[int, int] = {}
+    perp_market_oracles: dict[int, int] = {}
+
+    def spot_oracle_for(market_index: int) -> int:
+        if market_index not in spot_market_oracles:
+            market = drift_client.get_spot_market_account(market_index)
+            spot_market_oracles[market_index] = oracle_index[
+                get_oracle_id(market.oracle, market.oracle_source)
+            ]
+        return spot_market_oracles[market_index]
+
+    def perp_oracle_for(market_index: int) -> int:
+        if market_index not in perp_market_oracles:
+            market = drift_client.get_perp_market_account(market_index)
+            perp_market_oracles[market_index] = oracle_index[
+                get_oracle_id(market.amm.oracle, market.amm.oracle_source)
+            ]
+        return perp_market_oracles[market_index]
+
+    users = list(user_map.values())
+    being_liquidated = []
+    fallback_users = []
+    spot_rows = []
+    perp_rows = []
+
+    for user_idx, user in enumerate(users):
+        being_liquidated.append(user.is_being_liquidated())
+        if needs_fallback(user, drift_client):
+            fallback_users.append(user_idx)
+            continue
+
+        user_account = user.get_user_account()
+        for position in user.get_active_spot_positions():
+            market = drift_client.get_spot_market_account(position.market_index)
+            token_amount = get_signed_token_amount(
+                get_token_amount(
+                    position.scaled_balance, market, position.balance_type
+                ),
+                position.balance_type,
+            )
+            if token_amount >= 0:
+                weight = calculate_asset_weight(
+                    token_amount, 0, market, MarginCategory.MAINTENANCE
+                )
+            else:
+                weight = calculate_liability_weight(
+                    token_amount, market, MarginCategory.MAINTENANCE
+                )
+            is_quote = position.market_index == QUOTE_SPOT_MARKET_INDEX
+            spot_rows.append(
+                (
+                    user_idx,
+                    spot_oracle_for(position.market_index),
+                    token_amount,
+                    10**market.decimals,
+                    is_quote,
+                    weight,
+                    0
+                    if is_quote
+                    else position.open_orders * OPEN_ORDER_MARGIN_REQUIREMENT,
+                )
+            )
+
+        for position in user.get_active_perp_positions():
+            market = drift_client.get_perp_market_account(position.market_index)
+            oracle = perp_oracle_for(position.market_index)
+            worst_case_base = calculate_worst_case_perp_liability_value(
+                position, market, oracle_prices[oracle]
+            )["worst_case_base_asset_amount"]
+            is_settled = is_variant(market.status, "Settlement")
+            perp_rows.append(
+                (
+                    user_idx,
+                    oracle,
+                    position.base_asset_amount,
+                    worst_case_base,
+                    position.quote_asset_amount
+                    + calculate_position_funding_pnl(market, position),
+                    is_variant(market.contract_type, "Prediction"),
+                    market.expiry_price if is_settled else np.nan,
+                    calculate_market_margin_ratio(
+                        market,
+                        abs(worst_case_base),
+                        MarginCategory.MAINTENANCE,
+                        user_account.max_margin_ratio,
+                    ),
+                    position.open_orders * OPEN_ORDER_MARGIN_REQUIREMENT,
+                    market.unrealized_pnl_maintenance_asset_weight,
+                )
+            )
+
+    spot_columns = list(zip(*spot_rows)) or [()] * 7
+    perp_columns = list(zip(*perp_rows)) or [()] * 10
+
+    return PriceShockArrays(
+        users=users,
+        oracle_ids=oracle_ids,
+        oracle_prices=oracle_prices,
+        quote_oracle=spot_oracle_for(QUOTE_SPOT_MARKET_INDEX),
+        being_liquidated=np.array(being_liquidated, dtype=bool),
+        fallback_users=np.array(fallback_users, dtype=np.int64),
+        spot_user=np.array(spot_columns[0], dtype=np.int64),
+        spot_oracle=np.array(spot_columns[1], dtype=np.int64),
+        spot_token_amount=np.array(spot_columns[2], dtype=np.float64),
+        spot_precision=np.array(spot_columns[3], dtype=np.float64),
+        spot_is_quote=np.array(spot_columns[4], dtype=bool),
+        spot_maintenance_weight=np.array(spot_columns[5], dtype=np.float64),
+        spot_open_orders_margin=np.array(spot_columns[6], dtype=np.float64),
+        perp_user=np.array(perp_columns[0], dtype=np.int64),
+        perp_oracle=np.array(perp_columns[1], dtype=np.int64),
+        perp_base_asset_amount=np.array(perp_columns[2], dtype=np.float64),
+        perp_worst_case_base_asset_amount=np.array(perp_columns[3], dtype=np.float64),
+        perp_quote_with_funding=np.array(perp_columns[4], dtype=np.float64),
+        perp_is_prediction=np.array(perp_columns[5], dtype=bool),
+        perp_expiry_price=np.array(perp_columns[6], dtype=np.float64),
+        perp_maintenance_margin_ratio=np.array(perp_columns[7], dtype=np.float64),
+        perp_open_orders_margin=np.array(perp_columns[8], dtype=np.float64),
+        perp_unrealized_maintenance_weight=np.array(perp_columns[9], dtype=np.float64),
+    )
+
+
+def select_users(
+    arrays: PriceShockArrays, user_indices: np.ndarray
+) -> PriceShockArrays:
+    """
+    Restrict `arrays` to the sorted `user_indices`, keeping their positions.
+    """
+    remap = np.full(arrays.n_users, -1, dtype=np.int64)
+    remap[user_indices] = np.arange(len(user_indices))
+    spot_rows = remap[arrays.spot_user] >= 0
+    perp_rows = remap[arrays.perp_user] >= 0
+    fallback_users = remap[arrays.fallback_users]
+
+    selected = {}
+    for field in fields(arrays):
+        if field.name.startswith("spot_"):
+            selected[field.name] = getattr(arrays, field.name)[spot_rows]
+        elif field.name.startswith("perp_"):
+            selected[field.name] = getattr(arrays, field.name)[perp_rows]
+    selected["spot_user"] = remap[selected["spot_user"]]
+    selected["perp_user"] = remap[selected["perp_user"]]
+
+    return replace(
+        arrays,
+        users=[arrays.users[i] for i in user_indices],
+        being_liquidated=arrays.being_liquidated[user_indices],
+        fallback_users=fallback_users[fallback_users >= 0],
+        **selected,
+    )
+
+
+def sum_by_user(values: np.ndarray, user_idx: np.ndarray, n_users: int) -> np.ndarray:
+    """
+    Sum a (scenarios, positions) matrix into (scenarios, users).
+
+    Positions are appended user by user, so `user_idx` is sorted and a
+    `reduceat` over the run starts is enough.
+    """
+    out = np.zeros((values.shape[0], n_users), dtype=np.float64)
+    if len(user_idx) == 0:
+        return out
+    starts = np.flatnonzero(np.r_[True, np.diff(user_idx) != 0])
+    out[:, user_idx[starts]] = np.add.reduceat(values, starts, axis=1)
+    return out
+
+
+def perp_liability_value(
+    base_asset_amount: np.ndarray, price: np.ndarray, is_prediction: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized `calculate_perp_liability_value`.
+    """
+    regular = np.floor(np.abs(base_asset_amount) * price / BASE_PRECISION)
+    prediction = np.where(
+        base_asset_amount > 0,
+        np.floor(base_asset_amount * price / BASE_PRECISION),
+        np.floor(
+            np.abs(base_asset_amount) * (MAX_PREDICTION_PRICE - price) / BASE_PRECISION
+        ),
+    )
+    return np.where(is_prediction, prediction, regular)
+
+
+def calculate_health(
+    total_collateral: np.ndarray,
+    margin_requirement: np.ndarray,
+    being_liquidated: np.ndarray,
+) -> np.ndarray:
+    """
+    Vectorized `DriftUser.get_health`.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.clip((1 - margin_requirement / total_collateral) * 100, 0, 100)
+    health = np.where(total_collateral <= 0, 0, np.round(ratio))
+    health = np.where((margin_requirement == 0) & (total_collateral >= 0), 100, health)
+    health = np.where(being_liquidated, 0, health)
+    return health.astype(np.int64)
+
+
+def evaluate_price_shock(
+    arrays: PriceShockArrays, oracle_multipliers: np.ndarray
+) -> dict[str, np.ndarray]:
+    """
+    Evaluate the price shock metrics for every user under every scenario.
+
+    `oracle_multipliers` has shape (scenarios, oracles) and scales the base
+    oracle prices. Returns (scenarios, users) arrays keyed like
+    `get_user_metrics_for_price_shock`.
+    """
+    prices = arrays.oracle_prices[None, :] * oracle_multipliers
+    quote_price = prices[:, arrays.quote_oracle][:, None]
+    n_users = arrays.n_users
+
+    # Spot: signed token value, quote balances are netted before splitting
+    spot_value = np.floor(
+        arrays.spot_token_amount * prices[:, arrays.spot_oracle] / arrays.spot_precision
+    )
+    spot_value_maintenance = np.floor(
+        spot_value * arrays.spot_maintenance_weight / SPOT_WEIGHT_PRECISION
+    )
+
+    def split_spot(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        base = np.where(arrays.spot_is_quote, 0, values)
+        quote = np.where(arrays.spot_is_quote, values, 0)
+        net_quote = sum_by_user(quote, arrays.spot_user, n_users)
+        assets = sum_by_user(np.maximum(base, 0), arrays.spot_user, n_users)
+        liabilities = sum_by_user(
+            np.maximum(-base, 0) + arrays.spot_open_orders_margin,
+            arrays.spot_user,
+            n_users,
+        )
+        return (
+            assets + np.maximum(net_quote, 0),
+            liabilities + np.maximum(-net_quote, 0),
+        )
+
+    spot_asset, spot_liability = split_spot(spot_value)
+    spot_asset_maintenance, spot_liability_maintenance = split_spot(
+        spot_value_maintenance
+    )
+
+    # Perp: settled markets are valued at their expiry price
+    perp_price = np.where(
+        np.isnan(arrays.perp_expiry_price),
+        prices[:, arrays.perp_oracle],
+        arrays.perp_expiry_price,
+    )
+    base_sign = np.sign(arrays.perp_base_asset_amount)
+    position_upnl = (
+        base_sign
+        * np.floor(
+            np.abs(arrays.perp_base_asset_amount) * perp_price / AMM_RESERVE_PRECISION
+        )
+        + arrays.perp_quote_with_funding
+    )
+    position_upnl = np.floor(position_upnl * quote_price / PRICE_PRECISION)
+    upnl = sum_by_user(position_upnl, arrays.perp_user, n_users)
+    upnl_maintenance = sum_by_user(
+        np.where(
+            position_upnl > 0,
+            np.floor(
+                position_upnl
+                * arrays.perp_unrealized_maintenance_weight
+                / SPOT_WEIGHT_PRECISION
+            ),
+            position_upnl,
+        ),
+        arrays.perp_user,
+        n_users,
+    )
+
+    perp_liability = sum_by_user(
+        perp_liability_value(
+            arrays.perp_base_asset_amount, perp_price, arrays.perp_is_prediction
+        ),
+        arrays.perp_user,
+        n_users,
+    )
+    worst_case_liability = perp_liability_value(
+        arrays.perp_worst_case_base_asset_amount, perp_price, arrays.perp_is_prediction
+    )
+    perp_liability_worst_case = sum_by_user(
+        worst_case_liability, arrays.perp_user, n_users
+    )
+    perp_margin_requirement = sum_by_user(
+        np.floor(
+            np.floor(worst_case_liability * quote_price / PRICE_PRECISION)
+            * arrays.perp_maintenance_margin_ratio
+            / MARGIN_PRECISION
+        )
+        + arrays.perp_open_orders_margin,
+        arrays.perp_user,
+        n_users,
+    )
+
+    net_assets = spot_asset + upnl - spot_liability
+    with np.errstate(divide="ignore", invalid="ignore"):
+        leverage = np.where(
+            net_assets == 0,
+            0,
+            np.floor_divide(
+                (perp_liability_worst_case + spot_liability) * MARGIN_PRECISION,
+                net_assets,
+            ),
+        )
+
+    health = calculate_health(
+        spot_asset_maintenance + upnl_maintenance,
+        perp_margin_requirement + spot_liability_maintenance,
+        arrays.being_liquidated[None, :],
+    )
+
+    return {
+        "leverage": leverage / MARGIN_PRECISION,
+        "upnl": upnl / QUOTE_PRECISION,
+        "net_usd_value": (spot_asset - spot_liability + upnl) / QUOTE_PRECISION,
+        "perp_liability": perp_liability / QUOTE_PRECISION,
+        "spot_asset": spot_asset / QUOTE_PRECISION,
+        "spot_liability": spot_liability / QUOTE_PRECISION,
+        "health": health,
+    }
+
+
+def get_oracle_multipliers(
+    oracle_ids: list[str],
+    skipped_oracles: list[str],
+    oracle_distortion: float,
+    scenarios: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Build the (scenarios, oracles) up and down multipliers for a uniform shock.
+    """
+    steps = oracle_distortion * np.arange(1, scenarios + 1)[:, None]
+    distorted = ~np.isin(np.array(oracle_ids, dtype=object), skipped_oracles)
+    up = np.where(distorted, np.maximum(1 + steps, 1), 1.0)
+    down = np.where(distorted, np.maximum(1 - steps, 0), 1.0)
+    return up, down
+
+
+def get_spot_oracle_id(drift_client: DriftClient, market_index: int) -> str:
+    market = drift_client.get_spot_market_account(int(market_index))
+    if market is None:
+        raise ValueError(f"Unknown spot market {market_index}")
+    return get_oracle_id(market.oracle, market.oracle_source)
+
+
+def get_perp_oracle_id(drift_client: DriftClient, market_index: int) -> str:
+    market = drift_client.get_perp_market_account(int(market_index))
+    if market is None:
+        raise ValueError(f"Unknown perp market {market_index}")
+    return get_oracle_id(market.amm.oracle, market.amm.oracle_source)
+
+
+def get_scenario_multipliers(
+    drift_client: DriftClient,
+    oracle_ids: list[str],
+    scenarios: list[dict],
+) -> np.ndarray:
+    """
+    Build the (scenarios, oracles) multipliers for arbitrary shocks.
+
+    Each scenario maps oracle ids (`oracle_moves`), spot market indexes
+    (`spot_moves`) and perp market indexes (`perp_moves`) to a relative move,
+    e.g. -0.2 for a 20% drop. Markets resolve to their oracle, so a move given
+    for a market also applies to every other market sharing that oracle.
+    """
+    oracle_index = {oracle_id: i for i, oracle_id in enumerate(oracle_ids)}
+    multipliers = np.ones((len(scenarios), len(oracle_ids)))
+    for scenario_idx, scenario in enumerate(scenarios):
+        moves = dict(scenario.get("oracle_moves") or {})
+        for market_index, move in (scenario.get("spot_moves") or {}).items():
+            moves[get_spot_oracle_id(drift_client, market_index)] = move
+        for market_index, move in (scenario.get("perp_moves") or {}).items():
+            moves[get_perp_oracle_id(drift_client, market_index)] = move
+        for oracle_id, move in moves.items():
+            if oracle_id not in oracle_index:
+                raise ValueError(f"Unknown oracle {oracle_id}")
+            multipliers[scenario_idx, oracle_index[oracle_id]] = max(1 + move, 0)
+    return multipliers
+
+
+def evaluate_fallback_users(
+    drift_client: DriftClient,
+    arrays: PriceShockArrays,
+    oracle_multipliers: np.ndarray,
+    metrics: dict[str, np.ndarray],
+    baseline: Optional[list[dict]] = None,
+):
+    """
+    Evaluate `arrays.fallback_users` through driftpy and write them into `metrics`.
+
+    Pass a precomputed unshocked `baseline` for the fallback users when calling
+    this repeatedly over batches of scenarios.
+    """
+    if len(arrays.fallback_users) == 0:
+        return
+
+    fallback_users = [arrays.users[i] for i in arrays.fallback_users]
+    if baseline is None:
+        baseline = calculate_leverages_for_price_shock(fallback_users, None)
+    for scenario, multipliers in enumerate(oracle_multipliers):
+        shocked_oracles = {
+            oracle_id: multiplier
+            for oracle_id, multiplier in zip(arrays.oracle_ids, multipliers)
+            if multiplier != 1
+        }
+        exposed = get_exposed_user_indices(fallback_users, list(shocked_oracles))
+        shocked = calculate_leverages_for_price_shock(
+            [fallback_users[i] for i in exposed],
+            None,
+            OracleOverlay.with_multipliers(drift_client, shocked_oracles),
+        )
+        results = merge_with_baseline(baseline, exposed, shocked)
+        for user_idx, result in zip(arrays.fallback_users, results):
+            for key in metrics:
+                metrics[key][scenario, user_idx] = result[key]
+
+
+def get_user_leverages_for_price_shock_vectorized(
+    slot: int,
+    drift_client: DriftClient,
+    user_map: UserMap,
+    oracle_distortion: float = 0.1,
+    asset_group: PriceShockAssetGroup = PriceShockAssetGroup.IGNORE_STABLES,
+    scenarios: int = 5,
+):
+    """
+    Same response as `get_user_leverages_for_price_shock`, with each scenario
+    given as a dict of columns instead of a list of per-user dicts.
+    """
+    arrays = build_price_shock_arrays(drift_client, user_map)
+    skipped_oracles = get_skipped_oracles(asset_group)
+    print(
+        f"Vectorized price shock over {arrays.n_users} users "
+        f"({len(arrays.fallback_users)} through driftpy), "
+        f"{len(arrays.spot_user)} spot and {len(arrays.perp_user)} perp positions"
+    )
+
+    up, down = get_oracle_multipliers(
+        arrays.oracle_ids, skipped_oracles, oracle_distortion, scenarios
+    )
+    oracle_multipliers = np.vstack([np.ones((1, len(arrays.oracle_ids))), up, down])
+    metrics = evaluate_price_shock(arrays, oracle_multipliers)
+    evaluate_fallback_users(drift_client, arrays, oracle_multipliers, metrics)
+
+    user_keys = [user.user_public_key for user in arrays.users]
+
+    def scenario_columns(scenario: int) -> dict:
+        return {
+            "user_key": user_keys,
+            **{key: metrics[key][scenario] for key in PRICE_SHOCK_COLUMNS[1:]},
+        }
+
+    return {
+        "slot": slot,
+        "leverages_none": scenario_columns(0),
+        "leverages_up": tuple(scenario_columns(1 + i) for i in range(scenarios)),
+        "leverages_down": tuple(
+            scenario_columns(1 + scenarios + i) for i in range(scenarios)
+        ),
+        "user_keys": list(user_map.user_map.keys()),
+        "distorted_oracles": [
+            oracle_id
+            for oracle_id in arrays.oracle_ids
+            if oracle_id not in skipped_oracles
+        ],
+    }
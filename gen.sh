@@ -11,34 +11,21 @@ python -m backend.scripts.generate_ucache \
 
 # The next ones will use the --use-snapshot flag, so they will reuse the pickle
 # We can run all commands in parallel by adding & at the end
+# One job per asset group: each computes a single shock surface for the
+# snapshot and serves every scenario set of that group from it
 python -m backend.scripts.generate_ucache \
     --use-snapshot \
     price-shock \
     --asset-group "ignore+stables" \
-    --oracle-distortion 0.05 \
-    --n-scenarios 5 &
+    --oracle-distortion 0.05 0.1 \
+    --n-scenarios 5 10 &
 
 python -m backend.scripts.generate_ucache \
     --use-snapshot \
     price-shock \
     --asset-group "jlp+only" \
-    --oracle-distortion 0.05 \
-    --n-scenarios 5 &
-
-python -m backend.scripts.generate_ucache \
-    --use-snapshot \
-    price-shock \
-    --asset-group "jlp+only" \
-    --oracle-distortion 0.1 \
-    --n-scenarios 10 &
-
-
-python -m backend.scripts.generate_ucache \
-    --use-snapshot \
-    price-shock \
-    --asset-group "ignore+stables" \
-    --oracle-distortion 0.1 \
-    --n-scenarios 10 &
+    --oracle-distortion 0.05 0.1 \
+    --n-scenarios 5 10 &
 
 # Wait for all background processes to complete
 wait
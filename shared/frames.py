@@ -0,0 +1,68 @@
+import io
+import json
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from shared.types import FrameFormat
+
+FRAME_MEDIA_TYPES = {
+    FrameFormat.ARROW: "application/vnd.apache.arrow.stream",
+    FrameFormat.PARQUET: "application/vnd.apache.parquet",
+}
+
+# Schema metadata key holding the JSON fields that travel alongside a frame
+METADATA_KEY = b"metadata"
+
+
+def get_frame_format(format: Optional[str], accept: Optional[str]) -> FrameFormat:
+    """
+    An explicit `format=` wins, otherwise the first columnar type in `Accept`.
+    """
+    if format:
+        return FrameFormat(format)
+    for frame_format, media_type in FRAME_MEDIA_TYPES.items():
+        if accept and media_type in accept:
+            return frame_format
+    return FrameFormat.JSON
+
+
+def encode_frame(df: pd.DataFrame, frame_format: FrameFormat, metadata: dict) -> bytes:
+    """
+    Serialize `df` as an Arrow IPC stream or Parquet file, with `metadata`
+    stored as JSON in the schema. Object columns (e.g. pubkeys) are sent as
+    strings.
+    """
+    df = df.astype({column: str for column in df.select_dtypes(include="object")})
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, METADATA_KEY: json.dumps(metadata).encode()}
+    )
+
+    sink = io.BytesIO()
+    if frame_format == FrameFormat.ARROW:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    elif frame_format == FrameFormat.PARQUET:
+        pq.write_table(table, sink)
+    else:
+        raise ValueError(f"{frame_format} is not a columnar format")
+    return sink.getvalue()
+
+
+def decode_frame(
+    content: bytes, frame_format: FrameFormat
+) -> tuple[pd.DataFrame, dict]:
+    """
+    Inverse of `encode_frame`.
+    """
+    if frame_format == FrameFormat.ARROW:
+        table = pa.ipc.open_stream(content).read_all()
+    elif frame_format == FrameFormat.PARQUET:
+        table = pq.read_table(io.BytesIO(content))
+    else:
+        raise ValueError(f"{frame_format} is not a columnar format")
+    metadata = json.loads(table.schema.metadata.get(METADATA_KEY, b"{}"))
+    return table.to_pandas(), metadata
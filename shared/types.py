@@ -7,6 +7,18 @@ class PriceShockAssetGroup(Enum):
     JLP_ONLY = "jlp only"
 
 
+class PriceShockEngine(Enum):
+    DRIFTPY = "driftpy"
+    VECTORIZED = "vectorized"
+    PARALLEL = "parallel"
+
+
+class FrameFormat(Enum):
+    JSON = "json"
+    ARROW = "arrow"
+    PARQUET = "parquet"
+
+
 class PriceShockParams(TypedDict):
     oracle_distortion: float
     asset_group: PriceShockAssetGroup
@@ -3,7 +3,7 @@ import streamlit as st
 from driftpy.constants.perp_markets import mainnet_perp_market_configs
 from driftpy.constants.spot_markets import mainnet_spot_market_configs
 
-from lib.api import fetch_cached_data
+from lib.api import fetch_api_data
 from utils import get_current_slot
 
 options = [0, 1, 2, 3]
@@ -15,10 +15,6 @@ labels = [
 ]
 
 
-def calculate_effective_leverage(assets: float, liabilities: float) -> float:
-    return liabilities / assets if assets != 0 else 0
-
-
 def format_metric(
     value: float, should_highlight: bool, mode: int, financial: bool = False
 ) -> str:
@@ -26,35 +22,17 @@ def format_metric(
     return f"{formatted} ✅" if should_highlight and mode > 0 else formatted
 
 
-def generate_summary_data(
-    df: pd.DataFrame, mode: int, perp_market_index: int
-) -> pd.DataFrame:
-    summary_data = {}
-    for i in range(len(mainnet_spot_market_configs)):
-        prefix = f"spot_{i}"
-        assets = df[f"{prefix}_all_assets"].sum()
-        liabilities = df[f"{prefix}_all"].sum()
-
-        summary_data[f"spot{i} ({mainnet_spot_market_configs[i].symbol})"] = {
-            "all_assets": assets,
-            "all_liabilities": format_metric(
-                liabilities, 0 < liabilities < 1_000_000, mode, financial=True
-            ),
-            "effective_leverage": format_metric(
-                calculate_effective_leverage(assets, liabilities),
-                0 < calculate_effective_leverage(assets, liabilities) < 2,
-                mode,
-            ),
-            "all_spot": df[f"{prefix}_all_spot"].sum(),
-            "all_perp": df[f"{prefix}_all_perp"].sum(),
-            f"perp_{perp_market_index}_long": df[
-                f"{prefix}_perp_{perp_market_index}_long"
-            ].sum(),
-            f"perp_{perp_market_index}_short": df[
-                f"{prefix}_perp_{perp_market_index}_short"
-            ].sum(),
-        }
-    return pd.DataFrame(summary_data).T
+def generate_summary_data(summary: dict, mode: int) -> pd.DataFrame:
+    summary_df = pd.DataFrame(summary)
+    summary_df["all_liabilities"] = [
+        format_metric(liabilities, 0 < liabilities < 1_000_000, mode, financial=True)
+        for liabilities in summary_df["all_liabilities"]
+    ]
+    summary_df["effective_leverage"] = [
+        format_metric(leverage, 0 < leverage < 2, mode)
+        for leverage in summary_df["effective_leverage"]
+    ]
+    return summary_df
 
 
 def asset_liab_matrix_cached_page():
@@ -82,73 +60,111 @@ def asset_liab_matrix_cached_page():
     )
     st.query_params.update({"perp_market_index": str(perp_market_index)})
 
-    result = fetch_cached_data(
-        "asset-liability/matrix",
-        _params={"mode": mode, "perp_market_index": perp_market_index},
-        key=f"asset-liability/matrix_{mode}_{perp_market_index}",
+    st.checkbox(
+        "Only show high leverage mode users", key="only_high_leverage_mode_users"
+    )
+    st.slider(
+        "Filter by minimum leverage",
+        0.0,
+        110.0,
+        key="min_leverage",
     )
-    df = pd.DataFrame(result["df"])
-
-    if st.session_state.only_high_leverage_mode_users:
-        df = df[df["is_high_leverage"]]
 
-    filtered_df = df[df["leverage"] >= st.session_state.min_leverage].sort_values(
-        "leverage", ascending=False
+    # Filtering, totals and paging all happen in the backend, so each change
+    # only moves the summary and one page of users
+    filter_params = {
+        "mode": mode,
+        "perp_market_index": perp_market_index,
+        "min_leverage": st.session_state.min_leverage,
+        "only_high_leverage": st.session_state.only_high_leverage_mode_users,
+    }
+    result = fetch_api_data(
+        "asset-liability", "summary", params=filter_params, retry=True
     )
+    if result is None:
+        st.error("Asset-liability summary is not available yet, try again shortly")
+        return
 
-    summary_df = generate_summary_data(filtered_df, mode, perp_market_index)
     slot = result["slot"]
     current_slot = get_current_slot()
 
     st.info(
         f"This data is for slot {slot}, which is now {int(current_slot) - int(slot)} slots old"
     )
-    st.write(f"{df.shape[0]} users")
-    st.checkbox(
-        "Only show high leverage mode users", key="only_high_leverage_mode_users"
+    st.write(f"{result['n_users']} users")
+    st.write(generate_summary_data(result["summary"], mode))
+
+    spot_market_index = st.selectbox(
+        "Users",
+        [None] + [x.market_index for x in mainnet_spot_market_configs],
+        format_func=lambda x: (
+            "FULL" if x is None else mainnet_spot_market_configs[int(x)].symbol
+        ),
     )
-    st.slider(
-        "Filter by minimum leverage",
-        0.0,
-        110.0,
-        key="min_leverage",
+    if spot_market_index is None:
+        sort_options = ["leverage", "net_usd_value", "spot_asset", "spot_liability"]
+    else:
+        sort_options = [
+            f"spot_{spot_market_index}_all",
+            f"spot_{spot_market_index}_all_assets",
+            "spot_asset",
+            "net_usd_value",
+        ]
+    sort_col, order_col, page_col = st.columns(3)
+    sort_by = sort_col.selectbox("Sort by", sort_options)
+    ascending = order_col.checkbox("Ascending", value=False)
+    page = page_col.number_input("Page", min_value=1, value=1, step=1)
+
+    users = fetch_api_data(
+        "asset-liability",
+        "users",
+        params={
+            **filter_params,
+            "spot_market_index": spot_market_index,
+            "sort_by": sort_by,
+            "ascending": ascending,
+            "page": page - 1,
+        },
+        retry=True,
     )
-    st.write(summary_df)
-
-    tabs = st.tabs(["FULL"] + [x.symbol for x in mainnet_spot_market_configs])
+    if users is None:
+        st.error("Asset-liability users are not available yet, try again shortly")
+        return
+    n_pages = max(1, -(-users["total"] // users["page_size"]))
+    df = pd.DataFrame(users["df"])
 
-    with tabs[0]:
+    if spot_market_index is None:
         if st.session_state.only_high_leverage_mode_users:
             st.write(
-                f"There are **{len(filtered_df)}** users with high leverage mode and {st.session_state.min_leverage}x leverage or more"
+                f"There are **{result['n_filtered']}** users with high leverage mode and {st.session_state.min_leverage}x leverage or more"
             )
         else:
             st.write(
-                f"There are **{len(filtered_df)}** users with this **{st.session_state.min_leverage}x** leverage or more"
+                f"There are **{result['n_filtered']}** users with this **{st.session_state.min_leverage}x** leverage or more"
             )
-        st.write(f"Total USD value: **{filtered_df['net_usd_value'].sum():,.2f}**")
-        st.write(f"Total collateral: **{filtered_df['spot_asset'].sum():,.2f}**")
-        st.write(f"Total liabilities: **{filtered_df['spot_liability'].sum():,.2f}**")
-        st.dataframe(filtered_df, hide_index=True)
-
-    for idx, tab in enumerate(tabs[1:]):
-        important_cols = [x for x in filtered_df.columns if "spot_" + str(idx) in x]
-        filtered_df["Link"] = filtered_df["user_key"].apply(
-            lambda x: f"https://app.drift.trade/overview?userAccount={x}"
-        )
-        toshow = filtered_df[
-            ["user_key", "Link", "spot_asset", "net_usd_value"] + important_cols
-        ]
-        toshow = toshow[toshow[important_cols].abs().sum(axis=1) != 0].sort_values(
-            by="spot_" + str(idx) + "_all", ascending=False
-        )
-        tab.write(
-            f"{len(toshow)} users with this asset to cover liabilities (with {st.session_state.min_leverage}x leverage or more)"
-        )
-        tab.dataframe(
-            toshow,
-            hide_index=True,
-            column_config={
-                "Link": st.column_config.LinkColumn("Link", display_text="View"),
-            },
+        st.write(f"Total USD value: **{result['net_usd_value']:,.2f}**")
+        st.write(f"Total collateral: **{result['spot_asset']:,.2f}**")
+        st.write(f"Total liabilities: **{result['spot_liability']:,.2f}**")
+        st.write(f"Page {page} of {n_pages}")
+        st.dataframe(df, hide_index=True)
+        return
+
+    st.write(
+        f"{users['total']} users with this asset to cover liabilities (with {st.session_state.min_leverage}x leverage or more)"
+    )
+    st.write(f"Page {page} of {n_pages}")
+    if not df.empty:
+        df.insert(
+            1,
+            "Link",
+            df["user_key"].apply(
+                lambda x: f"https://app.drift.trade/overview?userAccount={x}"
+            ),
         )
+    st.dataframe(
+        df,
+        hide_index=True,
+        column_config={
+            "Link": st.column_config.LinkColumn("Link", display_text="View"),
+        },
+    )
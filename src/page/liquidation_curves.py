@@ -1,6 +1,4 @@
-from collections import defaultdict
-
-import numpy as np
+import pandas as pd
 import plotly.graph_objects as go
 import streamlit as st
 from driftpy.constants.perp_markets import mainnet_perp_market_configs
@@ -8,101 +6,71 @@ from driftpy.constants.perp_markets import mainnet_perp_market_configs
 from lib.api import fetch_api_data
 
 
-def plot_liquidation_curves(liquidation_data):
-    liquidations_long = liquidation_data["liquidations_long"]
-    liquidations_short = liquidation_data["liquidations_short"]
-    market_price_ui = liquidation_data["market_price_ui"]
-
-    def filter_outliers(
-        liquidations, upper_bound_multiplier=2.0, lower_bound_multiplier=0.5
-    ):
-        """Filter out liquidations based on a range multiplier of the market price."""
-        return [
-            (price, notional, pubkey)
-            for price, notional, pubkey in liquidations
-            if lower_bound_multiplier * market_price_ui
-            <= price
-            <= upper_bound_multiplier * market_price_ui
-        ]
-
-    def aggregate_liquidations(liquidations):
-        """Aggregate liquidations to calculate cumulative notional amounts and track pubkeys with their sizes."""
-        price_to_data = defaultdict(lambda: {"notional": 0.0, "positions": []})
-        for price, notional, pubkey in liquidations:
-            price_to_data[price]["notional"] += notional
-            price_to_data[price]["positions"].append((pubkey, notional))
-        return price_to_data
-
-    def prepare_data_for_plot(aggregated_data, reverse=False):
-        sorted_prices = sorted(aggregated_data.keys(), reverse=reverse)
-        cumulative_notional = np.cumsum(
-            [aggregated_data[price]["notional"] for price in sorted_prices]
-        )
-        cumulative_positions = []
-        current_positions = []
-        for price in sorted_prices:
-            current_positions.extend(aggregated_data[price]["positions"])
-            cumulative_positions.append(list(current_positions))
-        return sorted_prices, cumulative_notional, cumulative_positions
-
-    liquidations_long = filter_outliers(liquidations_long, 2, 0.2)
-    liquidations_short = filter_outliers(liquidations_short, 5, 0.5)
-
-    aggregated_long = aggregate_liquidations(liquidations_long)
-    aggregated_short = aggregate_liquidations(liquidations_short)
-
-    long_prices, long_cum_notional, long_pubkeys = prepare_data_for_plot(
-        aggregated_long, reverse=True
-    )
-    short_prices, short_cum_notional, short_pubkeys = prepare_data_for_plot(
-        aggregated_short
-    )
-
-    if not long_prices or not short_prices:
-        return None
-
-    long_fig = go.Figure()
-    short_fig = go.Figure()
-
-    long_fig.add_trace(
+def plot_liquidation_curve(curve, name, color):
+    """Plot one side's cumulative curve, binned by the backend."""
+    fig = go.Figure()
+    fig.add_trace(
         go.Scatter(
-            x=long_prices,
-            y=long_cum_notional,
+            x=curve["prices"],
+            y=curve["cumulative_notional"],
             mode="lines",
-            name="Long Positions",
-            line=dict(color="purple", width=2),
+            name=f"{name} Positions",
+            line=dict(color=color, width=2),
             hovertemplate="Price: %{x}<br>Cumulative Notional: %{y}<br>Accounts: %{text}<extra></extra>",
-            text=[f"{len(pubkeys)} accounts" for pubkeys in long_pubkeys],
+            text=[f"{accounts} accounts" for accounts in curve["cumulative_accounts"]],
         )
     )
-    short_fig.add_trace(
-        go.Scatter(
-            x=short_prices,
-            y=short_cum_notional,
-            mode="lines",
-            name="Short Positions",
-            line=dict(color="turquoise", width=2),
-            hovertemplate="Price: %{x}<br>Cumulative Notional: %{y}<br>Accounts: %{text}<extra></extra>",
-            text=[f"{len(pubkeys)} accounts" for pubkeys in short_pubkeys],
-        )
-    )
-
-    long_fig.update_layout(
-        title="Long Liquidation Curve",
-        xaxis_title="Asset Price",
-        yaxis_title="Liquidations (Notional)",
-        xaxis=dict(showgrid=True),
-        yaxis=dict(showgrid=True),
-    )
-    short_fig.update_layout(
-        title="Short Liquidation Curve",
+    fig.update_layout(
+        title=f"{name} Liquidation Curve",
         xaxis_title="Asset Price",
         yaxis_title="Liquidations (Notional)",
         xaxis=dict(showgrid=True),
         yaxis=dict(showgrid=True),
     )
+    return fig
 
-    return long_fig, short_fig, long_pubkeys, short_pubkeys, long_prices, short_prices
+
+def show_curve_accounts(market_index, side, total_accounts):
+    """One page of the accounts on a curve, in the order they liquidate."""
+    if total_accounts == 0:
+        st.write(f"No {side} positions found")
+        return
+
+    st.write(f"Total Accounts: {total_accounts}")
+    page = st.number_input(
+        "Page", min_value=1, value=1, step=1, key=f"{side}_accounts_page"
+    )
+    accounts = fetch_api_data(
+        "liquidation",
+        "liquidation-curve-accounts",
+        params={"market_index": market_index, "side": side, "page": page - 1},
+        retry=True,
+    )
+    if accounts is None:
+        st.write("Fetching accounts for the first time, check again in one minute!")
+        return
+    n_pages = max(1, -(-accounts["total"] // accounts["page_size"]))
+    st.write(f"Page {page} of {n_pages}")
+    st.dataframe(
+        pd.DataFrame(
+            [
+                {
+                    "Price": f"{account['price']:.2f}",
+                    "Size": f"{account['notional']:,.2f}",
+                    "Account": account["user_key"],
+                    "Link": f"https://app.drift.trade/overview?userAccount={account['user_key']}",
+                }
+                for account in accounts["accounts"]
+            ]
+        ),
+        column_config={
+            "Price": st.column_config.TextColumn("Price"),
+            "Size": st.column_config.TextColumn("Size"),
+            "Account": st.column_config.TextColumn("Account", width="large"),
+            "Link": st.column_config.LinkColumn("Link", display_text="View"),
+        },
+        hide_index=True,
+    )
 
 
 def liquidation_curves_page():
@@ -126,8 +94,8 @@ def liquidation_curves_page():
     try:
         liquidation_data = fetch_api_data(
             "liquidation",
-            "liquidation-curve",
-            params=params,
+            "liquidation-curve-bins",
+            params={"market_index": market_index},
             retry=True,
         )
     except Exception as e:
@@ -142,100 +110,28 @@ def liquidation_curves_page():
         st.write("Check again in one minute!")
         st.stop()
 
-    (
-        long_fig,
-        short_fig,
-        long_pubkeys,
-        short_pubkeys,
-        long_prices,
-        short_prices,
-    ) = plot_liquidation_curves(liquidation_data) or (
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-    )
-
-    if long_prices is None:
+    long_curve = liquidation_data["long"]
+    short_curve = liquidation_data["short"]
+    if long_curve is None or (
+        long_curve["total_accounts"] == 0 and short_curve["total_accounts"] == 0
+    ):
         st.write("No liquidation data available")
         st.stop()
 
     long_col, short_col = st.columns([1, 1])
 
     with long_col:
-        st.plotly_chart(long_fig, use_container_width=True)
-
+        st.plotly_chart(
+            plot_liquidation_curve(long_curve, "Long", "purple"),
+            use_container_width=True,
+        )
         with st.expander("Long Position Accounts"):
-            if long_pubkeys and len(long_pubkeys[-1]) > 0:
-                st.write(f"Total Accounts: {len(long_pubkeys[-1])}")
-                long_data = []
-                for i, positions in enumerate(long_pubkeys):
-                    if i > 0:
-                        new_positions = set(positions) - set(long_pubkeys[i - 1])
-                        if new_positions:
-                            for pubkey, size in new_positions:
-                                long_data.append(
-                                    {
-                                        "Price": f"{long_prices[i]:.2f}",
-                                        "Size": f"{size:,.2f}",
-                                        "Account": pubkey,
-                                        "Link": f"https://app.drift.trade/overview?userAccount={pubkey}",
-                                    }
-                                )
-                if long_data:
-                    st.dataframe(
-                        long_data,
-                        column_config={
-                            "Price": st.column_config.TextColumn("Price"),
-                            "Size": st.column_config.TextColumn("Size"),
-                            "Account": st.column_config.TextColumn(
-                                "Account", width="large"
-                            ),
-                            "Link": st.column_config.LinkColumn(
-                                "Link", display_text="View"
-                            ),
-                        },
-                        hide_index=True,
-                    )
-            else:
-                st.write("No long positions found")
+            show_curve_accounts(market_index, "long", long_curve["total_accounts"])
 
     with short_col:
-        st.plotly_chart(short_fig, use_container_width=True)
-
+        st.plotly_chart(
+            plot_liquidation_curve(short_curve, "Short", "turquoise"),
+            use_container_width=True,
+        )
         with st.expander("Short Position Accounts"):
-            if short_pubkeys and len(short_pubkeys[-1]) > 0:
-                st.write(f"Total Accounts: {len(short_pubkeys[-1])}")
-                short_data = []
-                for i, positions in enumerate(short_pubkeys):
-                    if i > 0:
-                        new_positions = set(positions) - set(short_pubkeys[i - 1])
-                        if new_positions:
-                            for pubkey, size in new_positions:
-                                short_data.append(
-                                    {
-                                        "Price": f"{short_prices[i]:.2f}",
-                                        "Size": f"{size:,.2f}",
-                                        "Account": pubkey,
-                                        "Link": f"https://app.drift.trade/overview?userAccount={pubkey}",
-                                    }
-                                )
-                if short_data:
-                    st.dataframe(
-                        short_data,
-                        column_config={
-                            "Price": st.column_config.TextColumn("Price"),
-                            "Size": st.column_config.TextColumn("Size"),
-                            "Account": st.column_config.TextColumn(
-                                "Account", width="large"
-                            ),
-                            "Link": st.column_config.LinkColumn(
-                                "Link", display_text="View"
-                            ),
-                        },
-                        hide_index=True,
-                    )
-            else:
-                st.write("No short positions found")
+            show_curve_accounts(market_index, "short", short_curve["total_accounts"])
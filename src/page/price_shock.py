@@ -1,10 +1,7 @@
-import json
-
-import pandas as pd
 import plotly.graph_objects as go
 import streamlit as st
 
-from lib.api import fetch_cached_data
+from lib.api import fetch_cached_frame
 from shared.types import PriceShockAssetGroup
 from utils import get_current_slot
 
@@ -65,34 +62,28 @@ def price_shock_cached_page():
         oracle_distort = 0.05
     else:
         oracle_distort = 0.1
+    params = {
+        "asset_group": asset_group,
+        "oracle_distortion": oracle_distort,
+        "n_scenarios": n_scenarios,
+    }
     try:
-        result = fetch_cached_data(
-            "price-shock/usermap",
-            _params={
-                "asset_group": asset_group,
-                "oracle_distortion": oracle_distort,
-                "n_scenarios": n_scenarios,
-            },
-            key=f"price-shock/usermap_{asset_group}_{oracle_distort}_{n_scenarios}",
+        df_plot, result = fetch_cached_frame("price-shock/usermap", "result", params)
+        oracle_down_max, _ = fetch_cached_frame(
+            "price-shock/usermap", "oracle_down_max", params
+        )
+        oracle_up_max, _ = fetch_cached_frame(
+            "price-shock/usermap", "oracle_up_max", params
         )
     except Exception as e:
         print("HIT AN EXCEPTION...", e)
         st.error("Failed to fetch data")
         return
 
-    if "result" in result and result["result"] == "miss":
-        st.write("Fetching data for the first time...")
-        st.image(
-            "https://i.gifer.com/origin/8a/8a47f769c400b0b7d81a8f6f8e09a44a_w200.gif"
-        )
-        st.write("Check again in one minute!")
-        st.stop()
-
     current_slot = get_current_slot()
     st.info(
         f"This data is for slot {result['slot']}, which is now {int(current_slot) - int(result['slot'])} slots old"
     )
-    df_plot = pd.DataFrame(json.loads(result["result"]))
 
     fig = price_shock_plot(df_plot)
     st.plotly_chart(fig)
@@ -111,9 +102,6 @@ def price_shock_cached_page():
         )
         st.dataframe(df_liquidations)
 
-    oracle_down_max = pd.DataFrame(json.loads(result["oracle_down_max"]))
-    oracle_up_max = pd.DataFrame(json.loads(result["oracle_up_max"]))
-
     with col2:
         df_bad_debts = df_plot.drop(
             columns=["Perpetual Bankruptcy ($)", "Total Bankruptcy ($)"]